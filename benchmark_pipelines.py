@@ -0,0 +1,536 @@
+#!/usr/bin/env python2.7
+"""
+Offline benchmark of the Toil pipelines in this repository
+
+Synthetic inputs are served by a local HTTP server standing in for S3. It supports range requests and checks
+SSE-C headers against the master key. It also accepts simple and multipart uploads. Stub `docker` and `s3am`
+executables are put first on the PATH, and each pipeline is run under Toil's singleMachine batch system.
+Every tool takes a fixed, configurable time and writes synthetic output, so a run measures the pipelines' own
+overhead: job creation, FileStore staging, transfers, packaging and upload. No network is needed.
+
+Per-stage throughput is taken from the metrics_summary.tsv a pipeline writes to its output directory. Only
+toil_muse.py, toil_adtex_zygosity.py, toil_encrypted_varscan.py and toil_coverage.py write one; the other three
+pipelines are reported by their run totals only.
+
+Dependencies:
+Toil    -   pip install toil
+Curl    -   apt-get install curl
+"""
+import argparse
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+# Inputs of each pipeline: per-sample config columns (in order), which of them are SSE-C encrypted,
+# and the shared files passed as arguments
+PIPELINES = OrderedDict([
+    ('toil_muse.py', {'inputs': ['control.bam', 'tumor.bam'], 'encrypted': ['control.bam', 'tumor.bam'],
+                      'shared': [('--ref', 'ref.fa'), ('--fai', 'ref.fa.fai'), ('--dbsnp', 'dbsnp.vcf')]}),
+    ('toil_adtex_zygosity.py', {'inputs': ['sample.baf', 'control.bam', 'tumor.bam'],
+                                'encrypted': ['control.bam', 'tumor.bam'], 'shared': [('--white', 'white.bed')]}),
+    ('toil_encrypted_varscan.py', {'inputs': ['control.bam', 'tumor.bam'], 'encrypted': ['control.bam', 'tumor.bam'],
+                                   'shared': [('--ref', 'ref.fa'), ('--fai', 'ref.fa.fai'), ('--cent', 'cent.bed'),
+                                              ('--white', 'white.bed')]}),
+    ('toil_allFiles_varscan.py', {'inputs': ['control.bam', 'tumor.bam'], 'encrypted': ['control.bam', 'tumor.bam'],
+                                  'shared': [('--ref', 'ref.fa'), ('--fai', 'ref.fa.fai'), ('--cent', 'cent.bed'),
+                                             ('--white', 'white.bed')]}),
+    # toil_varscan.py downloads its bams without SSE-C headers
+    ('toil_varscan.py', {'inputs': ['control.bam', 'tumor.bam'], 'encrypted': [],
+                         'shared': [('--ref', 'ref.fa'), ('--fai', 'ref.fa.fai'), ('--cent', 'cent.bed'),
+                                    ('--white', 'white.bed')]}),
+    ('toil_adtex_coverage.py', {'inputs': ['control.bam', 'tumor.bam'], 'encrypted': ['control.bam', 'tumor.bam'],
+                                'shared': [('--white', 'white.bed')]}),
+    ('toil_coverage.py', {'inputs': ['sample.bam'], 'encrypted': ['sample.bam'], 'shared': [('--white', 'white.bed')]}),
+])
+# Default behaviour of the stub tool images: seconds of "compute", flags naming an output file or directory,
+# and the bytes written to each output and to stdout
+TOOLS = {'jeltje/musev1.0': {'seconds': 5, 'outputs': {'--outfile': 'file'}, 'output_bytes': 1024 ** 2},
+         'jvivian/bedtools': {'seconds': 5, 'stdout_bytes': 8 * 1024 ** 2},
+         'jeltje/adtex': {'seconds': 5, 'outputs': {'-o': 'dir'}, 'output_bytes': 1024 ** 2},
+         'jeltje/varscan': {'seconds': 5, 'stdout_bytes': 1024 ** 2}}
+BUCKET = 'bench-bucket'
+CHUNK = 1024 ** 2
+
+STUB_DOCKER = r'''#!{python}
+# Stub docker for benchmark_pipelines.py: "runs" a tool image by sleeping and writing synthetic output, either with
+# "docker run" or with "docker exec" in a persistent container started by "docker run -d"
+import json, os, signal, sys, time
+VALUE_FLAGS = set(['-v', '--cidfile', '--cpus', '--memory', '--cpuset-cpus', '-e', '--name', '--entrypoint', '-w'])
+# Persistent containers are files naming their image; the pid files of tools run in them are kept alongside
+STATE = os.path.join(os.path.dirname(os.environ['BENCH_TOOLS']), 'containers')
+
+
+def run_tool(image, params, data):
+    with open(os.environ['BENCH_TOOLS']) as f:
+        tool = json.load(f).get(image, {{}})
+    time.sleep(tool.get('seconds', 0))
+    for flag, kind in tool.get('outputs', {{}}).items():
+        if flag in params:
+            name = params[params.index(flag) + 1]
+            path = os.path.join(data, name[len('/data/'):] if name.startswith('/data/') else name)
+            if kind == 'dir':
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                path = os.path.join(path, 'result.txt')
+            with open(path, 'w') as f:
+                f.write('0' * tool.get('output_bytes', 0))
+    line = 'chr1\t1\t100\t1\t30\n'
+    sys.stdout.write(line * (tool.get('stdout_bytes', 0) // len(line)))
+
+
+def kill(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+args = sys.argv[1:]
+if args and args[0] == 'sudo':
+    args = args[1:]
+if not args or args[0] == 'pull':
+    sys.exit(0)
+if args[0] == 'rm':
+    for name in args[1:]:
+        if os.path.exists(os.path.join(STATE, name)):
+            os.remove(os.path.join(STATE, name))
+    sys.exit(0)
+if args[0] == 'inspect':
+    fmt = args[args.index('--format') + 1] if '--format' in args else ''
+    print('null' if 'Entrypoint' in fmt else args[-1] if fmt else '[{{}}]')
+    sys.exit(0)
+if args[0] == 'kill':
+    # Containers of "docker run" are named after the stub's pid (see --cidfile)
+    kill(int(args[-1][len('stub'):]))
+    sys.exit(0)
+if args[0] == 'exec':
+    i, data = 1, os.getcwd()
+    while args[i].startswith('-'):
+        if args[i] == '-w':
+            data = args[i + 1]
+        i += 2 if args[i] in VALUE_FLAGS else 1
+    name, command = args[i], args[i + 1:]
+    if not os.path.exists(os.path.join(STATE, name)):
+        sys.stderr.write('Error: No such container: {{}}\n'.format(name))
+        sys.exit(1)
+    if command[:2] != ['sh', '-c']:
+        sys.exit(0)
+    # "sh -c SCRIPT sh PIDFILE [TOOL ARGS]": the kill wrapper passes no tool arguments
+    pid_path = os.path.join(STATE, os.path.basename(command[4]))
+    if len(command) == 5:
+        if os.path.exists(pid_path):
+            with open(pid_path) as f:
+                kill(int(f.read()))
+        sys.exit(0)
+    with open(os.path.join(STATE, name)) as f:
+        image = f.read()
+    with open(pid_path, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        run_tool(image, command[5:], data)
+    finally:
+        os.remove(pid_path)
+    sys.exit(0)
+if args[0] != 'run':
+    sys.stderr.write('stub docker does not support "docker {{}}"\n'.format(args[0]))
+    sys.exit(1)
+mounts, name, i = {{}}, None, 1
+while args[i].startswith('-'):
+    if args[i] in VALUE_FLAGS:
+        if args[i] == '-v':
+            host, guest = args[i + 1].split(':')[:2]
+            mounts[guest] = host
+        elif args[i] == '--name':
+            name = args[i + 1]
+        elif args[i] == '--cidfile':
+            with open(args[i + 1], 'w') as f:
+                f.write('stub{{}}'.format(os.getpid()))
+        i += 2
+    else:
+        i += 1
+image = args[i].split('@')[0]
+if '-d' in args[:i]:
+    if not os.path.exists(STATE):
+        os.makedirs(STATE)
+    with open(os.path.join(STATE, name), 'w') as f:
+        f.write(image)
+    print(name)
+    sys.exit(0)
+run_tool(image, args[i + 1:], mounts.get('/data', os.getcwd()))
+'''
+
+STUB_S3AM = r'''#!{python}
+# Stub s3am for benchmark_pipelines.py: "s3am upload [--sse-key-file K] file://path bucket key" as a multipart
+# upload to the local S3 stand-in
+import os, re, sys
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+PART_SIZE = 8 * 1024 ** 2
+args = [a for a in sys.argv[1:] if a != 'upload']
+if '--sse-key-file' in args:
+    del args[args.index('--sse-key-file'):args.index('--sse-key-file') + 2]
+source, bucket, key = args[0][len('file://'):], args[1], args[2]
+url = '{{}}/{{}}/{{}}'.format(os.environ['BENCH_S3'], bucket, key)
+
+def call(method, target, data=None):
+    request = Request(target, data=data)
+    request.get_method = lambda: method
+    return urlopen(request).read().decode()
+
+upload_id = re.search('<UploadId>(.*)</UploadId>', call('POST', url + '?uploads', b'')).group(1)
+with open(source, 'rb') as f:
+    number = 0
+    while True:
+        part = f.read(PART_SIZE)
+        if not part and number:
+            break
+        number += 1
+        call('PUT', '{{}}?partNumber={{}}&uploadId={{}}'.format(url, number, upload_id), part)
+call('POST', '{{}}?uploadId={{}}'.format(url, upload_id), b'')
+'''
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pipelines', nargs='+', default=list(PIPELINES), choices=list(PIPELINES),
+                        help='Pipelines to benchmark (default: all)')
+    parser.add_argument('--samples', type=int, default=2, help='Number of samples in each config')
+    parser.add_argument('--bam_size', type=float, default=128, help='Size of each synthetic bam, in MiB')
+    parser.add_argument('--ref_size', type=float, default=4, help='Size of every other synthetic input, in MiB')
+    parser.add_argument('--tools', default=None, help='JSON file overriding the stub tool behaviour (see TOOLS)')
+    parser.add_argument('--tool_seconds', type=float, default=None, help='Seconds every stub tool takes')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter used to run the pipelines')
+    parser.add_argument('--work_dir', default=None, help='Directory for fixtures, job stores and outputs '
+                                                         '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--report', default=None, help='Write the per-stage table to this TSV file')
+    parser.add_argument('--toil_args', default='', help='Extra Toil options, e.g. "--maxCores 4"')
+    return parser
+
+
+class S3Server(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for S3. Objects are files under root/<bucket>/<key>; objects under the 'encrypted' bucket
+    must be requested with the SSE-C headers the pipelines derive from the master key.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, master_key):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), S3Handler)
+        self.root = root
+        self.master_key = master_key
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.stats = {'bytes_out': 0, 'bytes_in': 0, 'requests': 0}
+
+    def count(self, name, value):
+        with self.lock:
+            self.stats[name] += value
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def object_path(self):
+        return os.path.join(self.server.root, urlparse(self.path).path.lstrip('/'))
+
+    def sse_ok(self):
+        """
+        Objects in the 'encrypted' bucket need the SSE-C key derived from the master key and the object's URL
+        """
+        key = self.headers.get('x-amz-server-side-encryption-customer-key')
+        if not key:
+            return not urlparse(self.path).path.startswith('/encrypted/')
+        url = 'http://{}{}'.format(self.headers.get('Host'), self.path)
+        expected = hashlib.sha256((self.server.master_key + url).encode()).digest()
+        key_md5 = self.headers.get('x-amz-server-side-encryption-customer-key-md5')
+        return (key == base64.b64encode(expected).decode() and
+                key_md5 == base64.b64encode(hashlib.md5(expected).digest()).decode())
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        self.server.count('requests', 1)
+        path = self.object_path()
+        if not os.path.isfile(path):
+            return self.reply(404)
+        if not self.sse_ok():
+            return self.reply(400, b'SSE-C key mismatch')
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            first = int(match.group(1)) if match.group(1) else size - int(match.group(2))
+            last = min(int(match.group(2)), size - 1) if match.group(1) and match.group(2) else size - 1
+        self.send_response(206 if match else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(last - first + 1))
+        if match:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining:
+                data = f.read(min(CHUNK, remaining))
+                self.wfile.write(data)
+                remaining -= len(data)
+                self.server.count('bytes_out', len(data))
+
+    def read_body(self):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        chunks = []
+        while remaining:
+            data = self.rfile.read(min(CHUNK, remaining))
+            chunks.append(data)
+            remaining -= len(data)
+        self.server.count('bytes_in', sum(len(c) for c in chunks))
+        return b''.join(chunks)
+
+    def do_PUT(self):
+        self.server.count('requests', 1)
+        query = parse_qs(urlparse(self.path).query)
+        body = self.read_body()
+        if 'uploadId' in query:
+            self.server.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = body
+        else:
+            path = self.object_path()
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(body)
+        self.reply(200, headers=[('ETag', '"{}"'.format(hashlib.md5(body).hexdigest()))])
+
+    def do_POST(self):
+        self.server.count('requests', 1)
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        self.read_body()
+        if 'uploads' in query:
+            upload_id = hashlib.md5(self.path.encode() + str(time.time()).encode()).hexdigest()
+            self.server.uploads[upload_id] = {}
+            return self.reply(200, '<InitiateMultipartUploadResult><UploadId>{}</UploadId>'
+                                   '</InitiateMultipartUploadResult>'.format(upload_id).encode())
+        parts = self.server.uploads.pop(query['uploadId'][0])
+        path = self.object_path()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            for number in sorted(parts):
+                f.write(parts[number])
+        self.reply(200, b'<CompleteMultipartUploadResult/>')
+
+
+def write_fixture(path, size):
+    """
+    Writes a file of `size` bytes of random data (a random MiB, repeated)
+    """
+    block = bytearray(random.getrandbits(8) for _ in range(max(1, min(size, CHUNK))))
+    with open(path, 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.write(block[:size % len(block)])
+
+
+def make_fixtures(root, samples, bam_size, ref_size):
+    """
+    Creates the synthetic inputs for every pipeline: shared files in the 'plain' bucket and each sample's inputs
+    in both buckets. Files of the same kind are hard links to one fixture, so only a few are written.
+
+    Returns: list of sample UUIDs
+    """
+    templates = os.path.join(root, 'templates')
+    for directory in [templates, os.path.join(root, 'plain'), os.path.join(root, 'encrypted')]:
+        os.makedirs(directory)
+    names = set(['ref.fa', 'ref.fa.fai', 'dbsnp.vcf', 'cent.bed', 'white.bed'])
+    for spec in PIPELINES.values():
+        names.update(spec['inputs'])
+    for name in names:
+        write_fixture(os.path.join(templates, name),
+                      int((bam_size if name.endswith('.bam') else ref_size) * 1024 ** 2))
+        if name in ['ref.fa', 'ref.fa.fai', 'dbsnp.vcf', 'cent.bed', 'white.bed']:
+            os.link(os.path.join(templates, name), os.path.join(root, 'plain', name))
+    uuids = ['BENCH-{:04d}'.format(i) for i in range(samples)]
+    for uuid in uuids:
+        for name in names:
+            for bucket in ['plain', 'encrypted']:
+                os.link(os.path.join(templates, name), os.path.join(root, bucket, '{}.{}'.format(uuid, name)))
+    return uuids
+
+
+def make_stubs(bin_dir, python):
+    """
+    Writes the stub docker and s3am executables
+    """
+    os.makedirs(bin_dir)
+    for name, template in [('docker', STUB_DOCKER), ('s3am', STUB_S3AM)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(template.format(python=python))
+        os.chmod(path, 0o755)
+
+
+def read_summary(path):
+    """
+    Returns the rows of a pipeline's metrics_summary.tsv as dicts (empty if the pipeline wrote none)
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    return [dict(zip(lines[0], line)) for line in lines[1:]]
+
+
+def start_environment(base_dir, samples, bam_size, ref_size, tools, python):
+    """
+    Creates the fixtures, master key and stubs under base_dir and starts the S3 stand-in
+
+    Returns: (sample UUIDs, server, endpoint URL, master key path, environment for the pipelines)
+    """
+    root = os.path.join(base_dir, 's3')
+    uuids = make_fixtures(root, samples, bam_size, ref_size)
+    master_key = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
+    key_path = os.path.join(base_dir, 'master.key')
+    with open(key_path, 'w') as f:
+        f.write(master_key)
+    tools_path = os.path.join(base_dir, 'tools.json')
+    with open(tools_path, 'w') as f:
+        json.dump(tools, f)
+    bin_dir = os.path.join(base_dir, 'bin')
+    make_stubs(bin_dir, python)
+    server = S3Server(root, master_key)
+    endpoint = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+               BENCH_TOOLS=tools_path, BENCH_S3=endpoint)
+    return uuids, server, endpoint, key_path, env
+
+
+def pipeline_command(script, uuids, base_dir, endpoint, key_path, python, toil_args):
+    """
+    Writes the config for one pipeline run on the synthetic cohort and returns (command, run directory, output
+    directory)
+    """
+    spec = PIPELINES[script]
+    run_dir = os.path.join(base_dir, 'runs', '{}.{}'.format(script.replace('.py', ''), len(uuids)))
+    os.makedirs(os.path.join(run_dir, 'work'))
+    config = os.path.join(run_dir, 'config.csv')
+    with open(config, 'w') as f:
+        for uuid in uuids:
+            urls = ['{}/{}/{}.{}'.format(endpoint, 'encrypted' if name in spec['encrypted'] else 'plain', uuid, name)
+                    for name in spec['inputs']]
+            f.write(','.join([uuid] + urls) + '\n')
+    out_dir = os.path.join(run_dir, 'output')
+    command = [python, os.path.join(os.path.dirname(os.path.abspath(__file__)), script),
+               os.path.join(run_dir, 'jobstore'), '--config', config, '--ssec', key_path, '-o', out_dir,
+               '-3', '{}/{}/'.format(BUCKET, script.replace('.py', '')),
+               '--batchSystem', 'singleMachine', '--workDir', os.path.join(run_dir, 'work')]
+    for flag, name in spec['shared']:
+        command += [flag, '{}/plain/{}'.format(endpoint, name)]
+    return command + toil_args, run_dir, out_dir
+
+
+def run_pipeline(script, uuids, base_dir, endpoint, key_path, python, toil_args, env):
+    """
+    Runs one pipeline on the synthetic cohort and returns (exit status, wall seconds, summary rows)
+    """
+    command, run_dir, out_dir = pipeline_command(script, uuids, base_dir, endpoint, key_path, python, toil_args)
+    start = time.time()
+    with open(os.path.join(run_dir, 'toil.log'), 'w') as log:
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+    return status, time.time() - start, read_summary(os.path.join(out_dir, 'metrics_summary.tsv'))
+
+
+def main():
+    args = build_parser().parse_args()
+    base_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='toil_bench')
+    tools = dict(TOOLS)
+    if args.tools:
+        with open(args.tools) as f:
+            tools.update(json.load(f))
+    if args.tool_seconds is not None:
+        tools = dict((image, dict(spec, seconds=args.tool_seconds)) for image, spec in tools.items())
+    try:
+        uuids, server, endpoint, key_path, env = start_environment(base_dir, args.samples, args.bam_size,
+                                                                   args.ref_size, tools, args.python)
+        header = ['pipeline', 'kind', 'name', 'count', 'wall_p50', 'wall_p95', 'wall_total', 'bytes_total',
+                  'mb_per_sec', 'per_hour']
+        table = []
+        totals_only = []
+        for script in args.pipelines:
+            server.stats.update(bytes_out=0, bytes_in=0, requests=0)
+            status, wall, rows = run_pipeline(script, uuids, base_dir, endpoint, key_path, args.python,
+                                              args.toil_args.split(), env)
+            print('{}: {} in {:.1f}s ({:.1f} samples/hour), {:.1f} MiB served, {:.1f} MiB uploaded, {} requests'.format(
+                script, 'ok' if status == 0 else 'FAILED (exit {}, see runs/{}.{}/toil.log)'.format(
+                    status, script.replace('.py', ''), len(uuids)),
+                wall, len(uuids) * 3600 / wall, server.stats['bytes_out'] / 1024.0 ** 2,
+                server.stats['bytes_in'] / 1024.0 ** 2, server.stats['requests']))
+            table.append([script, 'run', 'total', len(uuids), '', '', '{:.2f}'.format(wall), server.stats['bytes_out'],
+                          '{:.2f}'.format(server.stats['bytes_out'] / 1024.0 ** 2 / wall),
+                          '{:.1f}'.format(len(uuids) * 3600 / wall)])
+            if status == 0 and not rows:
+                totals_only.append(script)
+            for row in rows:
+                wall_total, count = float(row['wall_total']), int(row['count'])
+                table.append([script, row['kind'], row['name'], count, row['wall_p50'], row['wall_p95'],
+                              row['wall_total'], row['bytes_total'],
+                              '{:.2f}'.format(int(row['bytes_total']) / 1024.0 ** 2 / wall_total) if wall_total else '',
+                              '{:.1f}'.format(count * 3600 / wall_total) if wall_total else ''])
+        server.shutdown()
+
+        widths = [max(len(str(row[i])) for row in [header] + table) for i in range(len(header))]
+        for row in [header] + table:
+            print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+        if totals_only:
+            print('No per-stage throughput for {} of {} pipelines, which write no metrics_summary.tsv: {}'.format(
+                len(totals_only), len(args.pipelines), ', '.join(totals_only)))
+        if args.report:
+            with open(args.report, 'w') as f:
+                for row in [header] + table:
+                    f.write('\t'.join(str(value) for value in row) + '\n')
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@
 # If --ssec is used, the program assumes input files are encrypted in S3 when retrieving them.
 # If --sudo flag is used, 'sudo' will be prepended to the Docker subprocess call
 # If --s3_dir is used, the final VCF will be uploaded to S3 using S3AM (pip install --pre s3am, need ~/.boto)
+# If --plan is used, nothing is run: the cohort is sized and its transfer volume, peak job disk and makespan on
+# --plan_nodes nodes are printed (add --node_disk to list samples that will not fit).
 #
 # Modify TMPDIR parameter to change location of tmp files.
 # Modify first argument to change location of the local fileStore
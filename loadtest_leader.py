@@ -0,0 +1,176 @@
+#!/usr/bin/env python2.7
+"""
+Leader scalability load test for the Toil pipelines in this repository
+
+Runs a pipeline's job graph on synthetic cohorts of growing size (e.g. 100, 1000, 10000 samples) against a local
+file job store. Inputs are tiny and every tool is a no-op, using the S3 stand-in and stub executables of
+benchmark_pipelines.py, so what is measured is the cost of parse_config / spawn_batch_jobs and the Toil leader.
+
+For each cohort size the job store and the leader process are sampled while the pipeline runs, and the report gives:
+    jobs            Jobs created (distinct job files seen in the job store)
+    jobs_per_sec    Mean and peak job creation rate
+    leader_rss      Peak resident memory of the leader (VmHWM)
+    pickle_bytes    p50, p95 and maximum size of the pickled jobs
+    first_sample    Seconds until the first sample's results were uploaded or written to the output directory
+
+Dependencies:
+Toil    -   pip install toil
+Curl    -   apt-get install curl
+"""
+import argparse
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark_pipelines import PIPELINES, TOOLS, BUCKET, pipeline_command, start_environment
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pipelines', nargs='+', default=['toil_muse.py', 'toil_adtex_zygosity.py'],
+                        choices=list(PIPELINES), help='Pipelines to load test')
+    parser.add_argument('--samples', nargs='+', type=int, default=[10, 100, 1000, 10000],
+                        help='Cohort sizes to run, in increasing order')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Stop each run after this many seconds (the report covers what happened until then)')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between samples of the job store')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter used to run the pipelines')
+    parser.add_argument('--work_dir', default=None, help='Directory for fixtures, job stores and outputs '
+                                                         '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--report', default=None, help='Write the results to this TSV file')
+    parser.add_argument('--toil_args', default='', help='Extra Toil options, e.g. "--maxCores 4"')
+    return parser
+
+
+def leader_hwm(pid):
+    """
+    Returns the peak resident memory (bytes) of a process so far, or None once it has exited
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+    return None
+
+
+def job_files(job_store):
+    """
+    Returns {path: size} of the pickled jobs in a file job store
+    """
+    jobs = {}
+    for root, _, files in os.walk(job_store):
+        if 'job' in files:
+            path = os.path.join(root, 'job')
+            try:
+                jobs[path] = os.path.getsize(path)
+            except OSError:
+                # The job finished and was deleted while we were walking the store
+                pass
+    return jobs
+
+
+def first_result(out_dir, upload_dir):
+    """
+    Returns True once a sample's results have been written to the output directory or uploaded
+    """
+    for directory in [out_dir, upload_dir]:
+        if os.path.isdir(directory):
+            for _, _, files in os.walk(directory):
+                if [f for f in files if not f.startswith('metrics') and f != 'trace.json']:
+                    return True
+    return False
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile (fraction between 0 and 1) of a non-empty list
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def load_test(script, uuids, base_dir, endpoint, key_path, args, env):
+    """
+    Runs one pipeline on a cohort while sampling its job store and leader
+
+    Returns: dict of measurements
+    """
+    command, run_dir, out_dir = pipeline_command(script, uuids, base_dir, endpoint, key_path, args.python,
+                                                 args.toil_args.split())
+    job_store = os.path.join(run_dir, 'jobstore')
+    upload_dir = os.path.join(base_dir, 's3', BUCKET, script.replace('.py', ''))
+    if os.path.exists(upload_dir):
+        shutil.rmtree(upload_dir)
+    seen, hwm, first_sample, peak_rate, timed_out = {}, 0, None, 0.0, False
+    start = time.time()
+    with open(os.path.join(run_dir, 'toil.log'), 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+        last_new = start
+        while process.poll() is None:
+            time.sleep(args.interval)
+            now = time.time()
+            hwm = max(hwm, leader_hwm(process.pid) or 0)
+            jobs = job_files(job_store)
+            new = [path for path in jobs if path not in seen]
+            if new:
+                peak_rate = max(peak_rate, len(new) / (now - last_new))
+                last_new = now
+            seen.update(jobs)
+            if first_sample is None and first_result(out_dir, upload_dir):
+                first_sample = now - start
+            if args.timeout and now - start > args.timeout:
+                process.terminate()
+                process.wait()
+                timed_out = True
+                break
+    wall = time.time() - start
+    sizes = list(seen.values())
+    return {'pipeline': script, 'samples': len(uuids),
+            'status': 'timeout' if timed_out else process.returncode,
+            'wall_sec': wall, 'jobs': len(seen),
+            'jobs_per_sec': len(seen) / (last_new - start) if seen else 0.0, 'peak_jobs_per_sec': peak_rate,
+            'leader_rss_mb': hwm / 1024.0 ** 2,
+            'pickle_p50': percentile(sizes, 0.5) if sizes else 0, 'pickle_p95': percentile(sizes, 0.95) if sizes else 0,
+            'pickle_max': max(sizes) if sizes else 0, 'first_sample_sec': first_sample}
+
+
+def main():
+    args = build_parser().parse_args()
+    base_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='toil_load')
+    tools = dict((image, dict(spec, seconds=0, output_bytes=1024, stdout_bytes=1024)) for image, spec in TOOLS.items())
+    columns = ['pipeline', 'samples', 'status', 'wall_sec', 'jobs', 'jobs_per_sec', 'peak_jobs_per_sec',
+               'leader_rss_mb', 'pickle_p50', 'pickle_p95', 'pickle_max', 'first_sample_sec']
+    try:
+        # Inputs are a few KiB so the cohort's fixtures (hard links) stay cheap at 10k samples
+        uuids, server, endpoint, key_path, env = start_environment(base_dir, max(args.samples), 4.0 / 1024,
+                                                                   1.0 / 1024, tools, args.python)
+        results = []
+        print('\t'.join(columns))
+        for script in args.pipelines:
+            for samples in sorted(args.samples):
+                result = load_test(script, uuids[:samples], base_dir, endpoint, key_path, args, env)
+                results.append(result)
+                print('\t'.join('{:.2f}'.format(result[c]) if isinstance(result[c], float) else str(result[c])
+                                for c in columns))
+                sys.stdout.flush()
+        server.shutdown()
+        if args.report:
+            with open(args.report, 'w') as f:
+                f.write('\t'.join(columns) + '\n')
+                for result in results:
+                    f.write('\t'.join('{:.2f}'.format(result[c]) if isinstance(result[c], float) else str(result[c])
+                                      for c in columns) + '\n')
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
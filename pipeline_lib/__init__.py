@@ -0,0 +1,4 @@
+"""
+Helpers shared by the Toil pipelines in this directory. Toil ships the directory of the pipeline script to its
+workers, so the package is importable wherever the pipeline's jobs run.
+"""
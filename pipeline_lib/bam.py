@@ -0,0 +1,285 @@
+"""
+Targeted bam fetching: reading a bam's header and index, and fetching and rewriting as BGZF only the blocks that
+hold reads overlapping a set of targets
+"""
+from multiprocessing.pool import ThreadPool
+import re
+import struct
+import subprocess
+import zlib
+from pipeline_lib.transfer import fetch_range
+
+# Largest BGZF block, uncompressed bytes written per block, ranges of the bam closer than RANGE_GAP fetched as one
+# (up to RANGE_MAX_SIZE), and concurrent range requests
+BGZF_MAX_BLOCK = 65536
+BGZF_BLOCK_DATA = 65280
+RANGE_GAP = 1024 ** 2
+RANGE_MAX_SIZE = 64 * 1024 ** 2
+RANGE_CONNECTIONS = 8
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+
+def read_targets(bed_path):
+    """
+    Returns the targets of a bed file as a dict mapping each chromosome to a list of (start, end) tuples
+    """
+    targets = {}
+    with open(bed_path) as f_in:
+        for line in f_in:
+            fields = line.split()
+            if len(fields) < 3 or fields[0] in ('track', 'browser') or fields[0].startswith('#'):
+                continue
+            targets.setdefault(fields[0], []).append((int(fields[1]), int(fields[2])))
+    return targets
+
+
+def parse_bam_header(data):
+    """
+    Parses the header at the start of a bam's decompressed data
+
+    Returns: (header bytes, list of reference names), or None if data doesn't hold the whole header yet
+    """
+    if len(data) < 8:
+        return None
+    if data[:4] != b'BAM\x01':
+        raise ValueError('Not a bam file')
+    pos = 8 + struct.unpack_from('<i', data, 4)[0]
+    if len(data) < pos + 4:
+        return None
+    n_ref = struct.unpack_from('<i', data, pos)[0]
+    pos += 4
+    names = []
+    for _ in range(n_ref):
+        if len(data) < pos + 4:
+            return None
+        l_name = struct.unpack_from('<i', data, pos)[0]
+        if len(data) < pos + 4 + l_name + 4:
+            return None
+        names.append(str(data[pos + 4:pos + 4 + l_name - 1].decode('ascii')))
+        pos += 4 + l_name + 4
+    return data[:pos], names
+
+
+def parse_bai(data):
+    """
+    Parses a bam index
+
+    Returns: list with, for each reference, a dict of bin -> list of (start, end) chunk virtual offsets and the
+    tuple of linear index offsets
+    """
+    if data[:4] != b'BAI\x01':
+        raise ValueError('Not a bam index')
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    pos = 8
+    index = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            bins[bin_id] = [struct.unpack_from('<QQ', data, pos + 16 * i) for i in range(n_chunk)]
+            pos += 16 * n_chunk
+        n_intv = struct.unpack_from('<i', data, pos)[0]
+        pos += 4
+        index.append((bins, struct.unpack_from('<{}Q'.format(n_intv), data, pos)))
+        pos += 8 * n_intv
+    return index
+
+
+def region_bins(start, end):
+    """
+    Returns the bins of the bam index (UCSC binning scheme) that may hold reads overlapping [start, end)
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(offset + (start >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+def target_chunks(index, names, targets):
+    """
+    Returns the sorted, merged chunks (start, end virtual offsets) holding the reads that overlap the targets
+
+    index: list             Parsed bam index (see parse_bai)
+    names: list             Reference names from the bam header
+    targets: dict           Targets per chromosome (see read_targets)
+    """
+    chunks = []
+    for ref_id, name in enumerate(names):
+        regions = targets.get(name) or targets.get(name[3:] if name.startswith('chr') else 'chr' + name) or []
+        if ref_id >= len(index):
+            continue
+        bins, offsets = index[ref_id]
+        for start, end in regions:
+            # No read overlapping the region lies before the first read of its 16kb window (the linear index),
+            # so chunks are trimmed to start there
+            window = start >> 14
+            min_offset = offsets[min(window, len(offsets) - 1)] if offsets else 0
+            for bin_id in region_bins(start, end):
+                chunks.extend((max(chunk[0], min_offset), chunk[1]) for chunk in bins.get(bin_id, [])
+                              if chunk[1] > min_offset)
+    merged = []
+    for start, end in sorted(chunks):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def chunk_ranges(chunks):
+    """
+    Groups chunks into the byte ranges of the bam to fetch, each including the whole block its last chunk ends in
+
+    Returns: list of (first byte, last byte, chunks in the range)
+    """
+    ranges = []
+    for start, end in chunks:
+        first, last = start >> 16, (end >> 16) + BGZF_MAX_BLOCK - 1
+        if ranges and first - ranges[-1][1] <= RANGE_GAP and last - ranges[-1][0] <= RANGE_MAX_SIZE:
+            ranges[-1][1] = max(ranges[-1][1], last)
+            ranges[-1][2].append((start, end))
+        else:
+            ranges.append([first, last, [(start, end)]])
+    return ranges
+
+
+def bgzf_block_size(data, pos):
+    """
+    Returns the size of the BGZF block whose header starts at pos of data, or None if there is no BGZF header there
+    """
+    if pos + 18 > len(data) or data[pos:pos + 4] != BGZF_MAGIC:
+        return None
+    xlen = struct.unpack_from('<H', data, pos + 10)[0]
+    extra = pos + 12
+    while extra + 4 <= min(pos + 12 + xlen, len(data)):
+        si1, si2, slen = struct.unpack_from('<BBH', data, extra)
+        if (si1, si2) == (66, 67) and slen == 2 and extra + 6 <= len(data):
+            return struct.unpack_from('<H', data, extra + 4)[0] + 1
+        extra += 4 + slen
+    return None
+
+
+def inflate_blocks(data, pos=0):
+    """
+    Yields (offset, decompressed data) for each complete BGZF block in data, starting at pos
+    """
+    while pos + 18 <= len(data):
+        size = bgzf_block_size(data, pos)
+        if size is None:
+            raise ValueError('Not a BGZF block at offset {}'.format(pos))
+        if pos + size > len(data):
+            return
+        xlen = struct.unpack_from('<H', data, pos + 10)[0]
+        yield pos, zlib.decompress(data[pos + 12 + xlen:pos + size - 8], -15)
+        pos += size
+
+
+def chunk_data(data, first, chunk):
+    """
+    Returns the decompressed records of a chunk, given the bytes of the bam from offset first
+    """
+    start, end = chunk
+    parts = []
+    for offset, block in inflate_blocks(data, (start >> 16) - first):
+        offset += first
+        begin = start & 0xffff if offset == start >> 16 else 0
+        if offset == end >> 16:
+            parts.append(block[begin:end & 0xffff])
+            return b''.join(parts)
+        parts.append(block[begin:])
+    raise ValueError('Chunk ending at block {} was not fetched completely'.format(end >> 16))
+
+
+def bgzf_block(data):
+    """
+    Compresses up to BGZF_BLOCK_DATA bytes as one BGZF block
+    """
+    deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = deflater.compress(data) + deflater.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+    return header + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    """
+    Writes data to a file as BGZF blocks, ending with the empty EOF block bam readers expect
+    """
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.buffer = b''
+
+    def write(self, data):
+        data = self.buffer + data
+        full = len(data) - len(data) % BGZF_BLOCK_DATA
+        for i in range(0, full, BGZF_BLOCK_DATA):
+            self.f_out.write(bgzf_block(data[i:i + BGZF_BLOCK_DATA]))
+        self.buffer = data[full:]
+
+    def close(self):
+        if self.buffer:
+            self.f_out.write(bgzf_block(self.buffer))
+        self.f_out.write(bgzf_block(b''))
+
+
+def fetch_targeted_bam(url, headers_for, bed_path, file_path, rate=None):
+    """
+    Writes to file_path a bam holding only the reads that overlap the targets, fetched with range requests
+    through the bam's .bai index
+
+    url: str                URL of the bam
+    headers_for: function   Returns the headers to send with a request for a URL (SSE-C keys are per URL)
+    bed_path: str           Bed file with the targets
+    file_path: str          Path the bam is written to
+    rate: int               Optional bandwidth limit in bytes/sec, split evenly over the concurrent range requests
+
+    Returns: number of bytes fetched, or None if the bam has no index
+    """
+    index = None
+    index_urls = [url + '.bai']
+    # Substituting into a URL that doesn't end in .bam gives back the bam itself, which would be read whole
+    if url.endswith('.bam'):
+        index_urls.append(re.sub(r'\.bam$', '.bai', url))
+    for index_url in index_urls:
+        try:
+            index = parse_bai(fetch_range(index_url, headers_for(index_url), rate=rate))
+            break
+        except (subprocess.CalledProcessError, ValueError):
+            continue
+    if index is None:
+        return None
+    # Read as much of the start of the bam as it takes to hold its header
+    size = BGZF_MAX_BLOCK * 4
+    while True:
+        data = fetch_range(url, headers_for(url), (0, size - 1), rate)
+        header = parse_bam_header(b''.join(block for _, block in inflate_blocks(data)))
+        if header or len(data) < size:
+            break
+        size *= 4
+    if not header:
+        raise ValueError('Could not read the header of {}'.format(url))
+    header_data, names = header
+    fetched = len(data)
+    ranges = chunk_ranges(target_chunks(index, names, read_targets(bed_path)))
+    connections = max(1, min(RANGE_CONNECTIONS, len(ranges)))
+    # curl treats a zero --limit-rate as unlimited
+    range_rate = max(1, rate // connections) if rate else None
+    pool = ThreadPool(connections)
+    try:
+        with open(file_path, 'wb') as f_out:
+            writer = BgzfWriter(f_out)
+            writer.write(header_data)
+            # imap keeps the ranges in file order, so the reads stay sorted
+            for (first, _, chunks), data in zip(ranges, pool.imap(
+                    lambda byte_range: fetch_range(url, headers_for(url), byte_range[:2], range_rate), ranges)):
+                fetched += len(data)
+                for chunk in chunks:
+                    writer.write(chunk_data(data, first, chunk))
+            writer.close()
+    finally:
+        pool.close()
+        pool.join()
+    return fetched
@@ -0,0 +1,88 @@
+"""
+Reading and checking the sample configuration file before launch
+"""
+from multiprocessing.pool import ThreadPool
+from pipeline_lib.transfer import HEAD_CONNECTIONS, check_url, encryption_headers
+
+
+def read_config(config, config_files):
+    """
+    Reads the configuration file and checks the shape of its rows: a UUID, unique in the file, followed by an
+    http(s) URL for each of config_files. Blank lines are skipped.
+
+    config: str             Path to the configuration file
+    config_files: list      (name, encrypted) of the files each row gives the URL of, in order
+
+    Returns: the good rows as (line number, uuid, urls), and the problems as (line number, uuid, message)
+    """
+    rows, problems, seen = [], [], {}
+    with open(config, 'r') as f_in:
+        for number, line in enumerate(f_in, 1):
+            if not line.strip():
+                continue
+            fields = [field.strip() for field in line.strip().split(',')]
+            uuid, urls = fields[0], fields[1:]
+            bad_urls = [name for (name, _), url in zip(config_files, urls)
+                        if not url.startswith(('http://', 'https://'))]
+            if len(urls) != len(config_files):
+                problems.append((number, uuid, 'expected a UUID and {} URLs ({}), found {} fields'.format(
+                    len(config_files), ', '.join(name for name, _ in config_files), len(fields))))
+            elif not uuid:
+                problems.append((number, uuid, 'missing UUID'))
+            elif uuid in seen:
+                problems.append((number, uuid, 'duplicate UUID, also on line {}'.format(seen[uuid])))
+            elif bad_urls:
+                problems.append((number, uuid, 'not an http(s) URL: {}'.format(', '.join(bad_urls))))
+            else:
+                rows.append((number, uuid, urls))
+            seen.setdefault(uuid, number)
+    return rows, problems
+
+
+def preflight_config(rows, config_files, key_path):
+    """
+    Checks that every URL of the config can be downloaded, with HEAD_CONNECTIONS concurrent HEAD requests sent with
+    the file's SSE-C headers when it is encrypted
+
+    rows: list              Rows of the config as (line number, uuid, urls), from read_config
+    config_files: list      (name, encrypted) of the files each row gives the URL of, in order
+    key_path: str           Path to the master key for SSE-C encryption
+
+    Returns: the checks of every file as (line number, uuid, name, url, status, size, etag), and the problems
+    as (line number, uuid, message)
+    """
+    files = [(number, uuid, name, url, encrypted and key_path)
+             for number, uuid, urls in rows for (name, encrypted), url in zip(config_files, urls)]
+
+    def check(entry):
+        number, uuid, name, url, key = entry
+        status, response = check_url(url, encryption_headers(key, url) if key else ())
+        size = int(response['content-length']) if status == 200 and 'content-length' in response else None
+        return number, uuid, name, url, status, size, response.get('etag', '').strip('"')
+
+    pool = ThreadPool(HEAD_CONNECTIONS)
+    try:
+        checks = pool.map(check, files)
+    finally:
+        pool.close()
+        pool.join()
+    problems = []
+    for (number, uuid, name, url, status, size, _), (_, _, _, _, key) in zip(checks, files):
+        if status is None:
+            message = 'no response'
+        elif status == 404:
+            message = 'not found (HTTP 404)'
+        elif key and status in (400, 403):
+            # S3 answers 403 to a wrong SSE-C key and 400 to an object that wasn't encrypted with one
+            message = 'SSE-C key rejected (HTTP {}): wrong master key, or not encrypted with the key derived for ' \
+                      'this URL'.format(status)
+        elif status == 403:
+            message = 'access denied (HTTP 403)'
+        elif status != 200:
+            message = 'HTTP {}'.format(status)
+        elif size == 0:
+            message = 'empty file'
+        else:
+            continue
+        problems.append((number, uuid, '{} {}: {}'.format(name, url, message)))
+    return checks, problems
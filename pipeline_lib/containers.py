@@ -0,0 +1,306 @@
+"""
+Running tools in Docker: image pulls and digests, persistent tool containers, CPU pinning and docker_call
+"""
+from contextlib import contextmanager
+import fcntl
+import functools
+import hashlib
+import json
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import socket
+import subprocess
+import time
+import uuid
+from pipeline_lib.filestore import race_lost
+from pipeline_lib.metrics import path_bytes, run_instrumented
+from pipeline_lib.transfer import GOVERNOR_POLL
+
+# Node-local directory used to serialize image pulls and persistent container starts
+IMAGE_LOCK_DIR = '/tmp/toil_images'
+# Node-local directory of per-CPU lock files used to pin containers
+CPU_LOCK_DIR = '/tmp/toil_cpus'
+# Seconds a persistent tool container may sit unused before it removes itself
+CONTAINER_IDLE = 600
+# Main process of a persistent container: exit once the heartbeat file is older than the idle limit
+CONTAINER_IDLE_LOOP = ('touch /tmp/.heartbeat; '
+                       'while [ $(( $(date +%s) - $(stat -c %Y /tmp/.heartbeat) )) -lt {} ]; do sleep 30; done')
+# Wrapper around each docker exec: keep the heartbeat fresh while the tool runs, record the tool's pid in the file
+# given first, and pass on its exit status
+CONTAINER_EXEC = ('pidfile=$1; shift; while true; do touch /tmp/.heartbeat; sleep 30; done & beat=$!; '
+                  '"$@" & tool=$!; echo $tool > $pidfile; wait $tool; status=$?; kill $beat; rm -f $pidfile; '
+                  'exit $status')
+# Kills the tool whose pid file is given, and the processes it started (stopped first so none escape)
+CONTAINER_KILL = ('kill_tree() { kill -STOP $1; for child in $(grep -l "^PPid:[[:space:]]*$1$" /proc/[0-9]*/status '
+                  '2>/dev/null | cut -d/ -f3); do kill_tree $child; done; kill -9 $1; }; kill_tree $(cat "$1")')
+# Per-process caches of the images known to be on the node, of their entrypoints, and of when each persistent
+# container was last seen running
+_images = set()
+_entrypoints = {}
+_containers = {}
+
+
+def docker_path(file_path):
+    """
+    Returns the path internal to the docker container (for standard reasons, this is always /data)
+    """
+    return os.path.join('/data', os.path.basename(file_path))
+
+
+def docker_command(sudo=False):
+    """
+    Returns the base docker command, prefixed with sudo if requested
+    """
+    return ['sudo', 'docker'] if sudo else ['docker']
+
+
+def ensure_image(tool, sudo=False):
+    """
+    Pulls a Docker image unless it is already present on this node, one pull per image at a time on the node
+
+    tool: str               Name (or name@digest) of the Docker image
+    sudo: bool              If the docker command should be executed as sudo
+
+    Returns: seconds spent pulling the image (0 if it was already present)
+    """
+    if tool in _images:
+        return 0
+    with open(os.devnull, 'w') as devnull:
+        inspect = docker_command(sudo) + ['inspect', '--type', 'image', tool]
+        if subprocess.call(inspect, stdout=devnull, stderr=devnull) == 0:
+            _images.add(tool)
+            return 0
+        if not os.path.exists(IMAGE_LOCK_DIR):
+            try:
+                os.makedirs(IMAGE_LOCK_DIR)
+            except OSError:
+                pass
+        with open(os.path.join(IMAGE_LOCK_DIR, tool.replace('/', '_').replace(':', '_')), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            start = time.time()
+            if subprocess.call(inspect, stdout=devnull, stderr=devnull) != 0:
+                try:
+                    subprocess.check_call(docker_command(sudo) + ['pull', tool], stdout=devnull)
+                except subprocess.CalledProcessError:
+                    raise RuntimeError('Failed to pull docker image {}'.format(tool))
+            _images.add(tool)
+            return time.time() - start
+
+
+def image_digest(tool, sudo=False):
+    """
+    Returns the image pinned by digest (e.g. jeltje/adtex@sha256:...), or the name itself if it has no digest
+    """
+    try:
+        digest = subprocess.check_output(docker_command(sudo) + ['inspect', '--type', 'image', '--format',
+                                                                 '{{index .RepoDigests 0}}', tool]).strip()
+    except subprocess.CalledProcessError:
+        return tool
+    return digest or tool
+
+
+def prepull_images(job, images, sudo=False):
+    """
+    Warm-up job that pulls the pipeline's Docker images concurrently, so that sample jobs don't pay for the pull
+
+    images: list            Names of the Docker images
+    sudo: bool              If the docker command should be executed as sudo
+
+    Returns: dict mapping each image name to its digest-pinned reference
+    """
+    pool = ThreadPool(len(images))
+    try:
+        pull_times = pool.map(lambda tool: ensure_image(tool, sudo), images)
+    finally:
+        pool.close()
+        pool.join()
+    for tool, seconds in zip(images, pull_times):
+        job.fileStore.logToMaster('Pulled {} in {:.1f}s'.format(tool, seconds))
+    return {tool: image_digest(tool, sudo) for tool in images}
+
+
+def pinned(input_args, tool):
+    """
+    Returns the digest-pinned reference recorded for an image by the warm-up job, or the image name
+    """
+    return (input_args.get('images') or {}).get(tool, tool)
+
+
+def image_entrypoint(tool, sudo=False):
+    """
+    Returns the entrypoint of a Docker image as a list (empty if it has none)
+    """
+    if tool in _entrypoints:
+        return _entrypoints[tool]
+    try:
+        output = subprocess.check_output(docker_command(sudo) + ['inspect', '--type', 'image', '--format',
+                                                                 '{{json .Config.Entrypoint}}', tool])
+    except subprocess.CalledProcessError:
+        raise RuntimeError('Failed to inspect docker image {}'.format(tool))
+    _entrypoints[tool] = json.loads(output) or []
+    return _entrypoints[tool]
+
+
+def tool_container(tool, root, sudo=False):
+    """
+    Returns the name of this node's long-lived container for an image, starting it if needed. It mounts root
+    (the Toil work directory) at the same path and removes itself after CONTAINER_IDLE seconds unused.
+
+    tool: str               Name (or name@digest) of the Docker image
+    root: str               Directory that contains the work directories of all jobs on this node
+    sudo: bool              If the docker command should be executed as sudo
+    """
+    name = 'toil-{}-{}'.format(re.sub('[^a-zA-Z0-9_.-]', '_', tool), hashlib.md5(root).hexdigest()[:8])
+    # A container lives at least CONTAINER_IDLE seconds past its last heartbeat, so a recent check still holds
+    if time.time() - _containers.get(name, 0) < CONTAINER_IDLE / 2:
+        return name
+    if not os.path.exists(IMAGE_LOCK_DIR):
+        try:
+            os.makedirs(IMAGE_LOCK_DIR)
+        except OSError:
+            pass
+    with open(os.devnull, 'w') as devnull, open(os.path.join(IMAGE_LOCK_DIR, name), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Refreshing the heartbeat doubles as the check that the container is still up
+        touch = docker_command(sudo) + ['exec', name, 'touch', '/tmp/.heartbeat']
+        if subprocess.call(touch, stdout=devnull, stderr=devnull) == 0:
+            _containers[name] = time.time()
+            return name
+        subprocess.call(docker_command(sudo) + ['rm', '-f', name], stdout=devnull, stderr=devnull)
+        try:
+            subprocess.check_call(docker_command(sudo) + ['run', '-d', '--rm', '--log-driver=none', '--name', name,
+                                                          '-v', '{0}:{0}'.format(root), '--entrypoint', 'sh', tool,
+                                                          '-c', CONTAINER_IDLE_LOOP.format(CONTAINER_IDLE)],
+                                  stdout=devnull)
+        except subprocess.CalledProcessError:
+            raise RuntimeError('Failed to start a persistent container for {}'.format(tool))
+    _containers[name] = time.time()
+    return name
+
+
+@contextmanager
+def cpu_pins(count):
+    """
+    Reserves `count` CPUs on this node, lock files in CPU_LOCK_DIR shared by all Toil workers, for the duration
+    of a tool call and yields their numbers (an empty list if count is 0)
+
+    count: int              Number of CPUs to reserve (capped at the number of CPUs on the node)
+    """
+    count = min(count, multiprocessing.cpu_count())
+    if not count:
+        yield []
+        return
+    if not os.path.exists(CPU_LOCK_DIR):
+        try:
+            os.makedirs(CPU_LOCK_DIR)
+        except OSError:
+            pass
+    while True:
+        held = []
+        for cpu in range(multiprocessing.cpu_count()):
+            lock_file = open(os.path.join(CPU_LOCK_DIR, 'cpu.{}'.format(cpu)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                continue
+            held.append((cpu, lock_file))
+            if len(held) == count:
+                break
+        if len(held) == count:
+            break
+        for _, lock_file in held:
+            lock_file.close()
+        time.sleep(GOVERNOR_POLL)
+    try:
+        yield [cpu for cpu, _ in held]
+    finally:
+        for _, lock_file in held:
+            lock_file.close()
+
+
+def container_limits(job, input_args):
+    """
+    Returns the resource arguments for docker_call: the watchdog's limits, the check that cancels an attempt of a
+    speculated job (--speculate), and with --limit_containers the Toil job's cores and memory
+
+    job: Job                Toil job whose cores and memory are enforced
+    input_args: dict        Input arguments
+    """
+    limits = dict(input_args['watchdog'])
+    if input_args.get('race'):
+        limits['cancelled'] = functools.partial(race_lost, job, input_args['race'])
+    if input_args['limit_containers']:
+        limits.update(cores=job.cores, memory=job.memory, pin_cpus=input_args['pin_cpus'])
+    return limits
+
+
+def docker_call(work_dir, tool_parameters, tool, java_opts=None, outfile=None, sudo=False,
+                persistent_root=None, cores=None, memory=None, pin_cpus=False, tags=None, stall_timeout=0,
+                max_runtime=0, max_runtime_per_gb=0, outputs=(), cancelled=None):
+    """
+    Makes subprocess call of a command to a docker container.
+
+
+    tool_parameters: list   An array of the parameters to be passed to the tool
+    tool: str               Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
+    java_opts: str          Optional commands to pass to a java jar execution. (e.g. '-Xmx15G')
+    outfile: file           Filehandle that stderr will be passed to
+    sudo: bool              If the user wants the docker command executed as sudo
+    persistent_root: str    If set, the tool is run with docker exec in this node's long-lived container for the
+                            image (see tool_container), which mounts persistent_root at its own path
+    cores: float            CPU limit for the container (--cpus); not applied to persistent containers
+    memory: int             Memory limit in bytes (--memory); not applied to persistent containers
+    pin_cpus: bool          Also pin the container to ceil(cores) CPUs reserved through cpu_pins
+    tags: dict              Fields (e.g. uuid, stage) added to the returned metrics record
+    stall_timeout: int      Kill the tool once it has gone this many seconds without writing to work_dir or outfile
+                            or using CPU (0: never); not applied to persistent containers
+    max_runtime: int        Kill the tool once it has run for this many seconds plus max_runtime_per_gb for each
+                            GiB in work_dir when it starts, i.e. its inputs (0: never)
+    max_runtime_per_gb: int Seconds added to max_runtime per GiB of input
+    outputs: list           Paths the tool must have written to (not empty) when it exits without an error
+    cancelled: function     Called during the run; the tool is killed (raising Superseded) once it returns True
+
+    Returns: metrics record of the call (see run_instrumented), tagged with image, host and tags
+    """
+    ensure_image(tool, sudo)
+    if persistent_root:
+        # Paths under /data refer to work_dir, which the long-lived container sees at its own path
+        tool_parameters = [os.path.join(work_dir, p[len('/data/'):]) if p.startswith('/data/') else p
+                           for p in tool_parameters]
+        container = tool_container(tool, persistent_root, sudo)
+        pid_file = '/tmp/.tool.{}'.format(uuid.uuid4().hex)
+        base_docker_call = docker_command(sudo) + ['exec', '-w', work_dir]
+        tool_call = [container, 'sh', '-c', CONTAINER_EXEC, 'sh', pid_file] + image_entrypoint(tool, sudo)
+        kill = docker_command(sudo) + ['exec', container, 'sh', '-c', CONTAINER_KILL, 'sh', pid_file]
+    else:
+        base_docker_call = 'docker run --log-driver=none --rm -v {}:/data'.format(work_dir).split()
+        if sudo:
+            base_docker_call = ['sudo'] + base_docker_call
+        tool_call = [tool]
+        kill = None
+        if cores:
+            base_docker_call = base_docker_call + ['--cpus', str(cores)]
+        if memory:
+            base_docker_call = base_docker_call + ['--memory', str(int(memory))]
+    if java_opts:
+        base_docker_call = base_docker_call + ['-e', 'JAVA_OPTS={}'.format(java_opts)]
+    with cpu_pins(int(math.ceil(cores)) if pin_cpus and cores and not persistent_root else 0) as cpus:
+        if cpus:
+            base_docker_call = base_docker_call + ['--cpuset-cpus', ','.join(str(cpu) for cpu in cpus)]
+        if max_runtime:
+            max_runtime += max_runtime_per_gb * path_bytes([work_dir]) / 1024.0 ** 3
+        watchdog = {'name': tool, 'stall_timeout': stall_timeout, 'max_runtime': max_runtime, 'paths': [work_dir],
+                    'cancelled': cancelled, 'kill': kill}
+        try:
+            usage = run_instrumented(base_docker_call + tool_call + tool_parameters, stdout=outfile,
+                                     watchdog=watchdog, outputs=outputs)
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError('{} returned a non-zero exit status ({}). Last lines of its log:\n{}'.format(
+                tool, e.returncode, e.output))
+        except OSError:
+            raise RuntimeError('docker not found on system. Install on all nodes.')
+    return dict(tags or {}, kind='tool', image=tool, host=socket.gethostname(), **usage)
@@ -0,0 +1,414 @@
+"""
+Native coverage engine (--coverage_engine numpy): per-base depth of a bam over a set of targets, as bedtools coverage
+-abam -d computes it, with the bam decoded by a process pool and the depth by NumPy
+"""
+from collections import OrderedDict
+import multiprocessing
+import os
+import resource
+import struct
+import time
+try:
+    import numpy as np
+except ImportError:
+    # The pipelines import this module without NumPy, as long as the native engine isn't used
+    np = None
+from pipeline_lib.bam import BGZF_MAGIC, BGZF_MAX_BLOCK, bgzf_block_size, inflate_blocks, parse_bam_header
+
+# Compressed bytes of the bam decoded per process pool task, records decoded per vectorized batch, and consecutive
+# records checked to find a task's first record
+COVERAGE_SEGMENT = 32 * 1024 ** 2
+COVERAGE_BATCH = 65536
+RECORD_CHECKS = 4
+# Fixed-size start of a bam record, and the CIGAR operations that consume the reference (M, D, N, =, X)
+BAM_RECORD_FIELDS = [('block_size', '<i4'), ('ref_id', '<i4'), ('pos', '<i4'), ('l_read_name', 'u1'),
+                     ('mapq', 'u1'), ('bin', '<u2'), ('n_cigar', '<u2'), ('flag', '<u2'), ('l_seq', '<i4'),
+                     ('next_ref_id', '<i4'), ('next_pos', '<i4'), ('tlen', '<i4')]
+REFERENCE_OPS = [0, 2, 3, 7, 8]
+
+
+def find_bgzf_block(data, pos=0):
+    """
+    Returns the offset of the first BGZF block starting at or after pos of data (a block header followed by another
+    one, or by the end of data), or None
+    """
+    while True:
+        pos = data.find(BGZF_MAGIC, pos)
+        if pos < 0:
+            return None
+        size = bgzf_block_size(data, pos)
+        if size and (pos + size >= len(data) or bgzf_block_size(data, pos + size)):
+            return pos
+        pos += 1
+
+
+def bam_record_size(data, pos, n_ref):
+    """
+    Returns the size of the bam record that plausibly starts at pos of decompressed data, or None. Used to find
+    record boundaries in the middle of a bam.
+    """
+    if pos + 36 > len(data):
+        return None
+    (block_size, ref_id, ref_pos, l_read_name, _, _, n_cigar, _, l_seq, next_ref_id,
+     next_pos) = struct.unpack_from('<3i2B3H3i', data, pos)
+    name_end = pos + 36 + l_read_name - 1
+    if (-1 <= ref_id < n_ref and -1 <= next_ref_id < n_ref and ref_pos >= -1 and next_pos >= -1 and l_read_name
+            and l_seq >= 0 and 32 + l_read_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq <= block_size < 1 << 24
+            and data[name_end:name_end + 1] == b'\x00'):
+        return 4 + block_size
+    return None
+
+
+def first_record(data, start, end, n_ref):
+    """
+    Returns the offset of the first bam record starting in [start, end) of decompressed data: the first offset from
+    which RECORD_CHECKS consecutive records (or the records up to the end of data) look valid. None if there is none.
+    """
+    pos = start
+    while pos < end:
+        record = pos
+        for _ in range(RECORD_CHECKS):
+            size = bam_record_size(data, record, n_ref)
+            if size is None:
+                break
+            record += size
+            if record == len(data):
+                return pos
+        else:
+            return pos
+        pos += 1
+    return None
+
+
+def read_bgzf(path, first, last, extra):
+    """
+    Decompresses the blocks of a bgzf file that start in [first, last), plus those starting in the next extra bytes
+
+    Returns: (data, list of (offset, start in data) of its non-empty blocks, offset after the last block, if the
+    file ended)
+    """
+    with open(path, 'rb') as f_in:
+        f_in.seek(first)
+        raw = f_in.read(last - first + extra)
+    pos = 0 if first == 0 else find_bgzf_block(raw)
+    parts, blocks, length, end = [], [], 0, first
+    for offset, block in inflate_blocks(raw, pos if pos is not None else len(raw)):
+        end = first + offset + bgzf_block_size(raw, offset)
+        if block:
+            parts.append(block)
+            blocks.append((first + offset, length))
+            length += len(block)
+    return b''.join(parts), blocks, end, len(raw) < last - first + extra
+
+
+def record_spans(data, offsets):
+    """
+    Decodes the bam records at offsets of decompressed data, vectorized
+
+    Returns: NumPy arrays of the reference ids, starts and ends (positions past their last aligned base, as
+    bedtools takes them) of the mapped records
+    """
+    buf = np.frombuffer(data, np.uint8)
+    fixed = buf[offsets[:, None] + np.arange(36)].view(np.dtype(BAM_RECORD_FIELDS))[:, 0]
+    n_cigar = fixed['n_cigar'].astype(np.int64)
+    first_op = np.cumsum(n_cigar) - n_cigar
+    op_pos = np.repeat(offsets + 36 + fixed['l_read_name'] - 4 * first_op, n_cigar) + 4 * np.arange(n_cigar.sum())
+    ops = buf[op_pos[:, None] + np.arange(4)].view('<u4')[:, 0]
+    lengths = np.where(np.isin(ops & 0xf, REFERENCE_OPS), ops >> 4, 0).astype(np.int64)
+    spans = np.zeros(len(offsets), np.int64)
+    has_cigar = n_cigar > 0
+    if has_cigar.any():
+        spans[has_cigar] = np.add.reduceat(lengths, first_op[has_cigar])
+    mapped = (fixed['flag'] & 4 == 0) & (fixed['ref_id'] >= 0)
+    starts = fixed['pos'][mapped].astype(np.int64)
+    return fixed['ref_id'][mapped], starts, starts + spans[mapped]
+
+
+def virtual_offset(blocks, end, length, pos):
+    """
+    Returns the virtual offset of position pos of data decompressed by read_bgzf. A position at the end of a block
+    is given as the start of the next block, so that every position has a single virtual offset.
+
+    blocks: list            (offset, start in data) of the non-empty blocks
+    end: int                Offset after the last block
+    length: int             Length of the data
+    """
+    if pos >= length:
+        return end << 16
+    offset, block_start = [block for block in blocks if block[1] <= pos][-1]
+    return offset << 16 | pos - block_start
+
+
+def coverage_segment(task):
+    """
+    Process pool task of the native coverage engine: decodes the bam records that start in the BGZF blocks beginning
+    in [first, last) of the file, finding the first one by its record structure unless given
+
+    task: tuple     (bam path, first, last, virtual offset of the first record or None, number of references)
+
+    Returns: (virtual offset of the first record, virtual offset after the last record, and NumPy arrays of the
+    reference ids, starts and ends of the mapped reads)
+    """
+    path, first, last, start, n_ref = task
+    empty = (start, start, np.zeros(0, np.int32), np.zeros(0, np.int64), np.zeros(0, np.int64))
+    extra = 4 * BGZF_MAX_BLOCK
+    while True:
+        data, blocks, end, at_eof = read_bgzf(path, first, last, extra)
+        offsets = [offset for offset, _ in blocks]
+        # Records starting before segment_end are this task's, the blocks after it are read ahead
+        segment_blocks = len([offset for offset in offsets if offset < last])
+        segment_end = blocks[segment_blocks][1] if segment_blocks < len(blocks) else len(data)
+        if start is None:
+            pos = first_record(data, 0, segment_end, n_ref)
+            if pos is None:
+                return empty
+        elif start >> 16 in offsets:
+            pos = blocks[offsets.index(start >> 16)][1] + (start & 0xffff)
+        else:
+            # The previous task's last record ran past all the blocks of this one
+            return empty
+        begin = pos
+        records = []
+        while pos < segment_end and pos + 4 <= len(data):
+            records.append(pos)
+            pos += 4 + struct.unpack_from('<i', data, pos)[0]
+        if pos <= len(data) and pos >= segment_end:
+            break
+        if at_eof:
+            raise ValueError('{} is truncated'.format(path))
+        # The last record runs past the blocks read ahead
+        extra *= 4
+    spans = [record_spans(data, np.array(records[i:i + COVERAGE_BATCH], np.int64))
+             for i in range(0, len(records), COVERAGE_BATCH)]
+    bounds = (virtual_offset(blocks, end, len(data), begin), virtual_offset(blocks, end, len(data), pos))
+    if not spans:
+        return bounds + empty[2:]
+    return bounds + tuple(np.concatenate(arrays) for arrays in zip(*spans))
+
+
+def bam_header(path):
+    """
+    Reads the header of a local bam
+
+    Returns: (header bytes, list of reference names, virtual offset of the first record)
+    """
+    size = BGZF_MAX_BLOCK * 4
+    while True:
+        data, blocks, end, at_eof = read_bgzf(path, 0, size, 0)
+        header = parse_bam_header(data)
+        # Past the header, the data must reach into the next block to place the first record in it
+        if header and len(header[0]) < len(data) or at_eof:
+            break
+        size *= 4
+    if not header:
+        raise ValueError('Could not read the header of {}'.format(path))
+    return header[0], header[1], virtual_offset(blocks, end, len(data), len(header[0]))
+
+
+def read_bed_rows(bed_path):
+    """
+    Returns the fields of each target of a bed file, in file order
+    """
+    rows = []
+    with open(bed_path) as f_in:
+        for line in f_in:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] not in ('track', 'browser') and not fields[0].startswith('#'):
+                rows.append(fields)
+    return rows
+
+
+class IntervalIndex(object):
+    """
+    Sorted, non-overlapping intervals (e.g. the prepared whitelist) held as NumPy arrays of starts and ends per
+    chromosome. Saved to and loaded from npz files.
+    """
+    def __init__(self, intervals):
+        """
+        intervals: list     Sorted, merged (chromosome, start, end) intervals (see prepare_targets)
+        """
+        self.chromosomes = OrderedDict()
+        for chromosome, start, end in intervals:
+            self.chromosomes.setdefault(chromosome, ([], []))
+            self.chromosomes[chromosome][0].append(start)
+            self.chromosomes[chromosome][1].append(end)
+        for chromosome, (starts, ends) in self.chromosomes.items():
+            self.chromosomes[chromosome] = (np.array(starts, np.int64), np.array(ends, np.int64))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f_in:
+            arrays = np.load(f_in)
+            names, counts, starts, ends = arrays['chromosomes'], arrays['counts'], arrays['starts'], arrays['ends']
+        index = cls([])
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        for i, name in enumerate(names):
+            index.chromosomes[str(name)] = (starts[bounds[i]:bounds[i + 1]], ends[bounds[i]:bounds[i + 1]])
+        return index
+
+    def save(self, path):
+        with open(path, 'wb') as f_out:
+            np.savez(f_out, chromosomes=np.array(list(self.chromosomes)),
+                     counts=np.array([len(starts) for starts, _ in self.chromosomes.values()], np.int64),
+                     starts=np.concatenate([starts for starts, _ in self.chromosomes.values()] or [[]]),
+                     ends=np.concatenate([ends for _, ends in self.chromosomes.values()] or [[]]))
+
+    def pack(self, chromosome, positions):
+        """
+        Lays a chromosome's intervals end to end and returns, for each position (a NumPy array), the offset there of
+        the first interval base at or after it, along with the total length of the intervals
+        """
+        starts, ends = self.chromosomes[chromosome]
+        offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+        interval = np.searchsorted(ends, positions, side='right')
+        clipped = np.minimum(interval, len(ends) - 1)
+        packed = np.where(interval < len(ends), offsets[clipped] + np.maximum(0, positions - starts[clipped]),
+                          offsets[-1])
+        return packed, int(offsets[-1])
+
+    def rows(self):
+        """
+        Returns the intervals as the fields of bed lines
+        """
+        return [[chromosome, str(start), str(end)] for chromosome, (starts, ends) in self.chromosomes.items()
+                for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def add_read_depths(index, differences, names, ref_ids, starts, ends):
+    """
+    Adds a segment's reads to the difference arrays of the targets' depth: reads are clipped to the intervals laid
+    end to end (see IntervalIndex.pack). Chromosomes are matched by name exactly, as bedtools does.
+
+    index: IntervalIndex    Targets
+    differences: dict       Difference array (int32, total length of the intervals + 1) per chromosome of the index
+    names: list             Reference names from the bam header
+    ref_ids: array          Reference ids of the reads
+    starts: array           Start positions of the reads
+    ends: array             End positions of the reads
+    """
+    for ref_id in np.unique(ref_ids).tolist():
+        if names[ref_id] not in differences:
+            continue
+        reads = ref_ids == ref_id
+        difference = differences[names[ref_id]]
+        for positions, sign in ((starts, 1), (ends, -1)):
+            packed = index.pack(names[ref_id], positions[reads])[0]
+            # Count over the span the segment's reads cover only, not the whole chromosome
+            low = packed.min()
+            counts = np.bincount(packed - low)
+            difference[low:low + len(counts)] += sign * counts.astype(np.int32)
+
+
+def target_depths(index, differences):
+    """
+    Returns the per-base depth over each interval of the index as NumPy arrays, in index order, from the difference
+    arrays filled by add_read_depths
+    """
+    depths = []
+    for chromosome, (starts, _) in index.chromosomes.items():
+        packed_targets, total = index.pack(chromosome, starts)
+        depths.extend(np.split(np.cumsum(differences[chromosome][:total], dtype=np.int32), packed_targets[1:]))
+    return depths
+
+
+def format_depth(task):
+    """
+    Formats per-base depth in the format of bedtools coverage -d: each target's fields, the 1-based position in the
+    target and the depth there
+
+    task: tuple     (list of targets' fields, list of their depth arrays)
+    """
+    rows, depths = task
+    lines = []
+    for fields, depth in zip(rows, depths):
+        prefix = '\t'.join(fields) + '\t'
+        lines.extend('{}{}\t{}\n'.format(prefix, position, value) for position, value in enumerate(depth.tolist(), 1))
+    return ''.join(lines)
+
+
+def write_depth_text(f_out, rows, depths, pool=None):
+    """
+    Writes per-base depth as text (see format_depth), formatting groups of targets of about COVERAGE_BATCH bases
+    in parallel if given a process pool
+
+    f_out: file             Filehandle the text is written to
+    rows: list              Targets (fields of the bed lines)
+    depths: list            Depth array of each target
+    pool: Pool              multiprocessing pool to format the text with
+    """
+    tasks, bases = [([], [])], 0
+    for fields, depth in zip(rows, depths):
+        if bases >= COVERAGE_BATCH:
+            tasks.append(([], []))
+            bases = 0
+        tasks[-1][0].append(fields)
+        tasks[-1][1].append(depth)
+        bases += len(depth)
+    # imap keeps the targets in order
+    for text in (pool.imap(format_depth, tasks) if pool else map(format_depth, tasks)):
+        f_out.write(text)
+
+
+def expand_depth_npz(cov_path):
+    """
+    Rewrites a coverage file in the binary format (--coverage_format npz) as bedtools coverage -d text, in place
+    """
+    with open(cov_path, 'rb') as f_in:
+        arrays = np.load(f_in)
+        targets, lengths, depth = arrays['targets'], arrays['lengths'], arrays['depth']
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    with open(cov_path, 'w') as f_out:
+        write_depth_text(f_out, [str(target).split('\t') for target in targets],
+                         [depth[bounds[i]:bounds[i + 1]] for i in range(len(targets))])
+
+
+def native_coverage(bam_path, index, cov_path, cores, binary=False):
+    """
+    Computes the per-base depth of a bam over targets as bedtools coverage -abam -d does, in a process pool. Memory:
+    one decompressed COVERAGE_SEGMENT per worker, and about 8 bytes per targeted base in this process.
+
+    bam_path: str           Path of the bam
+    index: IntervalIndex    Targets: the prepared whitelist, sorted and merged
+    cov_path: str           Path the coverage is written to
+    cores: int              Number of processes
+    binary: bool            Write the depth as NumPy arrays (targets, lengths, depth) in an npz file instead of text
+
+    Returns: metrics record of the computation (start, wall_sec, user_sec, sys_sec, peak_rss)
+    """
+    start = time.time()
+    times = os.times()
+    _, names, first_record_offset = bam_header(bam_path)
+    size = os.path.getsize(bam_path)
+    tasks = [(bam_path, first, min(first + COVERAGE_SEGMENT, size), first_record_offset if first == 0 else None,
+              len(names)) for first in range(0, size, COVERAGE_SEGMENT)]
+    pool = multiprocessing.Pool(max(1, cores))
+    try:
+        differences = dict((chromosome, np.zeros(int((ends - starts).sum()) + 1, np.int32))
+                           for chromosome, (starts, ends) in index.chromosomes.items())
+        previous_end = first_record_offset
+        for task, result in zip(tasks, pool.imap(coverage_segment, tasks)):
+            # Each task must start where the previous one's last record ended; a task whose first record was
+            # misidentified is decoded again from there
+            if result[0] != previous_end:
+                result = coverage_segment(task[:3] + (previous_end, task[4]))
+            previous_end = result[1]
+            add_read_depths(index, differences, names, *result[2:])
+        depths = target_depths(index, differences)
+        rows = index.rows()
+        if binary:
+            with open(cov_path, 'wb') as f_out:
+                np.savez(f_out, targets=np.array(['\t'.join(fields) for fields in rows]),
+                         lengths=np.array([len(depth) for depth in depths], np.int64),
+                         depth=np.concatenate(depths) if depths else np.zeros(0, np.int32))
+        else:
+            with open(cov_path, 'w') as f_out:
+                write_depth_text(f_out, rows, depths, pool)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = os.times()
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    return {'start': start, 'wall_sec': time.time() - start,
+            'user_sec': elapsed[0] - times[0] + elapsed[2] - times[2],
+            'sys_sec': elapsed[1] - times[1] + elapsed[3] - times[3], 'peak_rss': peak_rss}
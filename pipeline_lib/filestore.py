@@ -0,0 +1,160 @@
+"""
+Job-store files shared between jobs: releasing a sample's intermediates, and the small state files through which
+the attempts of a speculated job (--speculate) race
+"""
+import time
+
+# Seconds between checks of the other attempt's claim in claim_race, and seconds after which it is given up on
+CLAIM_POLL = 2
+CLAIM_TIMEOUT = 600
+# Speculative execution (--speculate): seconds between checks of a running attempt, seconds added to the deadline
+# for launching a duplicate, and the requirements of the job that watches the first attempt
+SPECULATE_POLL = 60
+SPECULATE_GRACE = 600
+SPECULATE_WATCHER = {'cores': 1, 'memory': '256M', 'disk': '16M'}
+
+
+def release_files(job, ids, *names):
+    """
+    Deletes a sample's intermediate files from the job store. Only their last consumer calls it, once its own
+    outputs are stored: Toil deletes the files at once, so a retry of the job could not read them again.
+
+    job: toil.job.Job       Last consumer of the files
+    ids: dict               jobstore id dictionary
+    names: str              Names in ids of the files to delete
+    """
+    for name in names:
+        job.fileStore.deleteGlobalFile(ids[name])
+
+
+def read_state(job, file_id):
+    """
+    Returns the contents of a small file that other jobs update (e.g. a race's 'done' file)
+    """
+    with job.fileStore.readGlobalFileStream(file_id) as f:
+        return f.read()
+
+
+def write_state(job, file_id, value):
+    """
+    Replaces the contents of a small file that other jobs read with read_state
+    """
+    with job.fileStore.updateGlobalFileStream(file_id) as f:
+        f.write(value)
+
+
+def new_race(job):
+    """
+    Creates the files through which the two attempts of a speculated job race: 'started' (set by attempt 0),
+    'done' (the winner's number), and the 'turn' and per-attempt 'claims' of claim_race
+    """
+    return {'started': job.fileStore.getEmptyFileStoreID(), 'done': job.fileStore.getEmptyFileStoreID(),
+            'turn': job.fileStore.getEmptyFileStoreID(),
+            'claims': [job.fileStore.getEmptyFileStoreID(), job.fileStore.getEmptyFileStoreID()]}
+
+
+def delete_race(job, race):
+    """
+    Deletes the files of a race once both attempts are done
+    """
+    for file_id in [race['started'], race['done'], race['turn']] + race['claims']:
+        job.fileStore.deleteGlobalFile(file_id)
+
+
+def race_lost(job, race):
+    """
+    Returns True if the other attempt of a speculated job has already finished
+
+    race: dict              The attempt's race (see new_race) and its number as 'attempt'
+    """
+    winner = read_state(job, race['done'])
+    return bool(winner) and winner != str(race['attempt'])
+
+
+def claim_race(job, race):
+    """
+    Records an attempt of a speculated job as the winner unless the other one finished first, made atomic with
+    Peterson's algorithm over the race's files. A claim held over CLAIM_TIMEOUT seconds is given up on.
+
+    Returns: True if the attempt won and should keep its output (also when a retry of the winner asks again)
+    """
+    me, other = str(race['attempt']), str(1 - race['attempt'])
+    write_state(job, race['claims'][race['attempt']], '1')
+    write_state(job, race['turn'], other)
+    deadline = time.time() + CLAIM_TIMEOUT
+    try:
+        while read_state(job, race['claims'][1 - race['attempt']]) == '1' and read_state(job, race['turn']) == other:
+            if time.time() > deadline:
+                job.fileStore.logToMaster('The other attempt has held its claim for over {} s, taking over'.format(
+                    CLAIM_TIMEOUT))
+                break
+            time.sleep(CLAIM_POLL)
+        winner = read_state(job, race['done'])
+        if not winner:
+            write_state(job, race['done'], me)
+            winner = me
+        return winner == me
+    finally:
+        write_state(job, race['claims'][race['attempt']], '')
+
+
+def start_race(job, attempt, watcher, args, requirements, deadline, ids=None, names=()):
+    """
+    Runs a job function with --speculate: attempt 0 now, and a watcher that launches attempt 1 if attempt 0 runs
+    past deadline (see watch_race). The race, and the files names in ids, are deleted once both are done.
+
+    job: toil.job.Job       Parent of the attempts
+    attempt: function       Job function of the attempts, given args and its race as the keyword race
+    watcher: function       Job function called as watcher(race, requirements, deadline, *args), which calls
+                            watch_race and launches attempt 1 if it returns True
+    args: tuple             Arguments of attempt
+    requirements: dict      Toil requirements of attempt
+    deadline: float         Seconds attempt 0 may run before it is duplicated
+    ids: dict               jobstore id dictionary, if the attempts share inputs that only they consume
+    names: tuple            Names in ids of those inputs
+
+    Returns: list of the promises of both attempts' return values
+    """
+    race = new_race(job)
+    results = [job.addChildJobFn(attempt, *args, race=dict(race, attempt=0), **requirements).rv()]
+    results.append(job.addChildJobFn(watcher, dict(race, attempt=1), requirements, deadline, *args,
+                                     **SPECULATE_WATCHER).rv())
+    job.addFollowOnJobFn(finish_race, race, ids, names)
+    return results
+
+
+def watch_race(job, race, deadline, name):
+    """
+    Waits for attempt 0 of a race to start, then for it to finish or run past deadline
+
+    race: dict              The race (see new_race)
+    deadline: float         Seconds attempt 0 may run before it is duplicated
+    name: str               The attempts' job and sample, for the log (e.g. 'run_muse for <uuid>')
+
+    Returns: True if attempt 1 should be launched
+    """
+    started = None
+    # The start is timed with this node's clock, when it is first seen; an attempt that hasn't started by the
+    # deadline plus SPECULATE_GRACE (e.g. it failed) is no longer watched
+    give_up = time.time() + deadline + SPECULATE_GRACE
+    while not read_state(job, race['done']):
+        if started is None and read_state(job, race['started']):
+            started = time.time()
+        if started is None and time.time() > give_up:
+            job.fileStore.logToMaster('{} has not started after {:.0f} s, no longer watching it'.format(
+                name, deadline + SPECULATE_GRACE))
+            return False
+        if started is not None and time.time() - started > deadline:
+            job.fileStore.logToMaster('{} has run for over {:.0f} s, launching a duplicate'.format(name, deadline))
+            return True
+        time.sleep(SPECULATE_POLL)
+    return False
+
+
+def finish_race(job, race, ids=None, names=()):
+    """
+    Follow-on of start_race: deletes the race's files and the attempts' inputs once both attempts are done
+    """
+    if ids:
+        release_files(job, ids, *names)
+    delete_race(job, race)
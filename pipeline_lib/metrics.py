@@ -0,0 +1,444 @@
+"""
+Instrumentation: cgroup counters and watchdog for tool containers, job and phase profiles, run summaries and traces
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pipeline_lib.resource_model import load_resource_model, save_resource_model, update_resource_model
+
+# Seconds between samples of a tool container's cgroup counters
+METRICS_INTERVAL = 2
+# Hung-tool watchdog: seconds between progress checks and between heartbeats in the log, and lines of a failed
+# tool's log given with the error
+WATCHDOG_INTERVAL = 30
+WATCHDOG_HEARTBEAT = 600
+WATCHDOG_LOG_LINES = 50
+# Where a container's cgroup lives, for the cgroupfs and systemd cgroup drivers ({controller} is '' on cgroup v2)
+CGROUP_PATHS = ['/sys/fs/cgroup/{controller}/docker/{id}', '/sys/fs/cgroup/{controller}/system.slice/docker-{id}.scope']
+
+
+def path_bytes(paths):
+    """
+    Returns the total size of the files (and directory trees) at paths; missing paths count as 0
+    """
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+class Profile(object):
+    """
+    Timings of one job: the records of its phases and tool calls. @profiled attaches one to the job as job.profile.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.uuid = None
+        self.start = time.time()
+        self.id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), int(self.start * 1000))
+        self.records = []
+
+    @contextmanager
+    def phase(self, name, paths=(), uuid=None):
+        """
+        Times a phase of the job (e.g. download, compute, upload)
+
+        name: str           Name of the phase
+        paths: list         Files the phase produced or moved; their total size is recorded as its bytes
+        uuid: str           Sample the phase works on, if not the job's (profile.uuid)
+        """
+        start = time.time()
+        yield
+        self.records.append({'kind': 'phase', 'stage': self.stage, 'phase': name, 'uuid': uuid or self.uuid,
+                             'host': socket.gethostname(), 'thread': threading.current_thread().name,
+                             'start': start, 'wall_sec': time.time() - start, 'bytes': path_bytes(paths)})
+
+
+def profiled(stage, output=False):
+    """
+    Decorator for job functions: gives the job a Profile (job.profile) and stores its records in a metrics file,
+    appended to the job's metrics list, or with output=True returned as (value, metrics list)
+
+    stage: str              Name of the stage in the metrics
+    output: bool            If the job returns a value other than metrics
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(job, *args, **kwargs):
+            job.profile = Profile(stage)
+            result = func(job, *args, **kwargs)
+            profile = job.profile
+            profile.records.append({'kind': 'job', 'stage': stage, 'uuid': profile.uuid, 'host': socket.gethostname(),
+                                    'cores': job.cores, 'memory': job.memory, 'start': profile.start,
+                                    'wall_sec': time.time() - profile.start})
+            # The job ID ties phases and tool calls to their job in the trace (see trace_events)
+            metrics = [write_metrics(job, [dict(record, job_id=profile.id) for record in profile.records])]
+            if output:
+                return result, metrics
+            if result is None:
+                return metrics
+            return (result if isinstance(result, list) else [result]) + metrics
+        return wrapper
+    return decorator
+
+
+def split_outputs(ids, *names):
+    """
+    Replaces the (FileStoreID, metrics) pairs that jobs decorated with @profiled(output=True) returned into ids
+    with the FileStoreIDs
+
+    ids: dict               jobstore id dictionary
+    names: str              Names in ids holding such pairs
+
+    Returns: list of the jobs' metrics
+    """
+    metrics = []
+    for name in names:
+        ids[name], job_metrics = ids[name]
+        metrics.append(job_metrics)
+    return metrics
+
+
+def cgroup_file(container_id, controller, name):
+    """
+    Returns the path of a container's cgroup file, or None if it can't be found
+
+    controller: str         cgroup v1 controller (e.g. 'memory'); '' for cgroup v2
+    name: str               File name within the container's cgroup (e.g. 'memory.peak')
+    """
+    for template in CGROUP_PATHS:
+        path = os.path.join(template.format(controller=controller, id=container_id), name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def cgroup_stats(container_id):
+    """
+    Reads a running container's CPU time, memory high-water mark and block I/O from its cgroup.
+    Counters that can't be found are left out.
+
+    container_id: str       Full ID of the container
+    """
+    stats = {}
+    cpu_stat = cgroup_file(container_id, '', 'cpu.stat')
+    try:
+        if cpu_stat:
+            # cgroup v2
+            with open(cpu_stat) as f:
+                values = dict((line.split()[0], int(line.split()[1])) for line in f if line.strip())
+            stats['user_sec'] = values.get('user_usec', 0) / 1e6
+            stats['sys_sec'] = values.get('system_usec', 0) / 1e6
+            memory = cgroup_file(container_id, '', 'memory.peak') or cgroup_file(container_id, '', 'memory.current')
+            io_stat = cgroup_file(container_id, '', 'io.stat')
+            if io_stat:
+                stats['read_bytes'] = stats['write_bytes'] = 0
+                with open(io_stat) as f:
+                    for field in f.read().split():
+                        if field.startswith('rbytes='):
+                            stats['read_bytes'] += int(field[len('rbytes='):])
+                        elif field.startswith('wbytes='):
+                            stats['write_bytes'] += int(field[len('wbytes='):])
+        else:
+            # cgroup v1: CPU time is reported in clock ticks
+            cpuacct = cgroup_file(container_id, 'cpuacct', 'cpuacct.stat')
+            if cpuacct:
+                ticks = float(os.sysconf('SC_CLK_TCK'))
+                with open(cpuacct) as f:
+                    values = dict((line.split()[0], int(line.split()[1])) for line in f if line.strip())
+                stats['user_sec'] = values.get('user', 0) / ticks
+                stats['sys_sec'] = values.get('system', 0) / ticks
+            memory = cgroup_file(container_id, 'memory', 'memory.max_usage_in_bytes')
+            blkio = cgroup_file(container_id, 'blkio', 'blkio.throttle.io_service_bytes')
+            if blkio:
+                stats['read_bytes'] = stats['write_bytes'] = 0
+                with open(blkio) as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) == 3 and fields[1] == 'Read':
+                            stats['read_bytes'] += int(fields[2])
+                        elif len(fields) == 3 and fields[1] == 'Write':
+                            stats['write_bytes'] += int(fields[2])
+        if memory:
+            with open(memory) as f:
+                stats['peak_rss'] = int(f.read().strip())
+    except (IOError, ValueError):
+        # The container exited (and its cgroup vanished) while we were reading
+        pass
+    return stats
+
+
+class Superseded(RuntimeError):
+    """
+    Raised when a tool is killed because another attempt of its speculated job (--speculate) finished first
+    """
+
+
+def docker_subcommand(command):
+    """
+    Returns the index of the docker subcommand (run, exec, ...) in a command line starting with [sudo] docker,
+    or None for other commands
+    """
+    index = 1 if command[:1] == ['sudo'] else 0
+    if index < len(command) - 1 and os.path.basename(command[index]) == 'docker':
+        return index + 1
+    return None
+
+
+def run_instrumented(command, stdout=None, watchdog=None, outputs=()):
+    """
+    Runs a docker command and measures it. For 'docker run' the container's cgroup is sampled every
+    METRICS_INTERVAL seconds; other commands only get their wall time recorded.
+
+    With a watchdog the command is killed, raising RuntimeError, once it has gone stall_timeout seconds without
+    its outputs growing or its container using CPU (only once its CPU time can be read), or has run longer than
+    max_runtime (0 disables either); and killed, raising Superseded, once cancelled() returns True.
+
+    command: list           docker command line
+    stdout: file            Filehandle the command's stdout is written to
+    watchdog: dict          name (for the log), stall_timeout, max_runtime, paths the command writes to (besides
+                            stdout), and optionally cancelled and kill (command that kills the tool of a docker exec)
+    outputs: list           Paths that must exist and not be empty once the command exits without an error
+
+    Returns: dict with start, wall_sec and, when available, user_sec, sys_sec, peak_rss, read_bytes, write_bytes
+    """
+    name = watchdog['name'] if watchdog else command[0]
+    log_dir = tempfile.mkdtemp()
+    cidfile = os.path.join(log_dir, 'cid')
+    subcommand = docker_subcommand(command)
+    if subcommand is not None and command[subcommand] == 'run':
+        command = command[:subcommand + 1] + ['--cidfile', cidfile] + command[subcommand + 1:]
+    usage = {}
+    container_id = None
+    start = time.time()
+    last_sample = last_check = last_heartbeat = last_progress = start
+    progress = None
+    reason = None
+    superseded = False
+    killed = True
+    stall_unarmed = False
+    # Only 'docker run' gets a container whose cgroup is sampled
+    sampled = subcommand is None or command[subcommand] != 'run'
+    try:
+        # stderr is kept so that the end of it can be given with a failure; it is copied to the Toil log after
+        with open(os.path.join(log_dir, 'stderr'), 'w+') as log:
+            process = subprocess.Popen(command, stdout=stdout, stderr=log)
+            while process.poll() is None:
+                now = time.time()
+                if not container_id and os.path.exists(cidfile):
+                    with open(cidfile) as f:
+                        container_id = f.read().strip() or None
+                if container_id and now - last_sample >= METRICS_INTERVAL:
+                    last_sample = now
+                    sample = cgroup_stats(container_id)
+                    sampled = True
+                    sample['peak_rss'] = max(usage.get('peak_rss', 0), sample.get('peak_rss', 0))
+                    usage.update(sample)
+                if watchdog and now - last_check >= WATCHDOG_INTERVAL:
+                    last_check = now
+                    written = path_bytes(watchdog['paths']) + (os.fstat(stdout.fileno()).st_size if stdout else 0)
+                    cpu_sec = usage.get('user_sec', 0) + usage.get('sys_sec', 0)
+                    if (written, cpu_sec) != progress:
+                        progress = (written, cpu_sec)
+                        last_progress = now
+                    if now - last_heartbeat >= WATCHDOG_HEARTBEAT:
+                        last_heartbeat = now
+                        sys.stderr.write('{}: running for {:.0f} s, {} bytes written, {:.0f} CPU seconds\n'.format(
+                            name, now - start, written, cpu_sec))
+                    # Without the container's CPU time a tool that only computes would look stalled
+                    stall_timeout = watchdog['stall_timeout'] if 'user_sec' in usage else 0
+                    if watchdog['stall_timeout'] and not stall_timeout and sampled and not stall_unarmed:
+                        stall_unarmed = True
+                        sys.stderr.write('{}: stall detection is off, the CPU time of its container cannot be '
+                                         'read\n'.format(name))
+                    if watchdog.get('cancelled') and watchdog['cancelled']():
+                        superseded = True
+                        reason = 'was superseded by another attempt'
+                    elif stall_timeout and now - last_progress > stall_timeout:
+                        reason = 'wrote no output and used no CPU for {:.0f} s'.format(now - last_progress)
+                    elif watchdog['max_runtime'] and now - start > watchdog['max_runtime']:
+                        reason = 'exceeded its maximum runtime of {:.0f} s'.format(watchdog['max_runtime'])
+                    if reason:
+                        # Killing the docker client would leave the container, or the exec'd tool, running
+                        if container_id:
+                            subprocess.call(command[:subcommand] + ['kill', container_id])
+                        elif subcommand is not None and command[subcommand] == 'exec':
+                            killed = bool(watchdog.get('kill')) and subprocess.call(watchdog['kill']) == 0
+                        process.kill()
+                        process.wait()
+                        break
+                time.sleep(0.2)
+            log.seek(0)
+            shutil.copyfileobj(log, sys.stderr)
+            log.seek(0)
+            tail = ''.join(log.readlines()[-WATCHDOG_LOG_LINES:])
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+    if reason:
+        message = '{} was {} after {:.0f} s: it {}. Last lines of its log:\n{}'.format(
+            name, 'killed' if killed else 'abandoned (it may still run in its container)', time.time() - start,
+            reason, tail)
+        raise Superseded(message) if superseded else RuntimeError(message)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output=tail)
+    missing = [path for path in outputs if not path_bytes([path])]
+    if missing:
+        raise RuntimeError('{} exited without an error but wrote nothing to {}. Last lines of its log:\n{}'.format(
+            name, ', '.join(missing), tail))
+    return dict(usage, start=start, wall_sec=time.time() - start)
+
+
+def write_metrics(job, records):
+    """
+    Writes instrumentation records to the FileStore as JSON lines and returns the FileStoreID
+
+    records: list           One dict per measured tool call (or phase)
+    """
+    path = os.path.join(job.fileStore.getLocalTempDir(), 'metrics.jsonl')
+    with open(path, 'w') as f_out:
+        for record in records:
+            f_out.write(json.dumps(record) + '\n')
+    return job.fileStore.writeGlobalFile(path)
+
+
+def flatten_metrics(metrics):
+    """
+    Flattens the nested lists of metrics FileStoreIDs returned by the jobs of each sample
+    """
+    if isinstance(metrics, (list, tuple)):
+        return [metrics_id for item in metrics for metrics_id in flatten_metrics(item)]
+    return [metrics] if metrics else []
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile (fraction between 0 and 1) of a non-empty list
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def summarize_metrics(records):
+    """
+    Groups metrics records into jobs (by stage), phases (stage/phase) and tool calls (stage/image) and returns one
+    row per group: count, p50/p95/max and total wall seconds, total bytes, total CPU seconds and maximum peak memory
+    """
+    groups = {}
+    for record in records:
+        kind = record.get('kind', 'tool')
+        if kind == 'job':
+            name = record['stage']
+        else:
+            name = '{}/{}'.format(record['stage'], record['phase'] if kind == 'phase' else record['image'])
+        groups.setdefault((kind, name), []).append(record)
+    rows = []
+    for (kind, name), group in sorted(groups.items()):
+        wall = [record['wall_sec'] for record in group]
+        rows.append(OrderedDict([('kind', kind), ('name', name), ('count', len(group)),
+                                 ('wall_p50', percentile(wall, 0.5)), ('wall_p95', percentile(wall, 0.95)),
+                                 ('wall_max', max(wall)), ('wall_total', sum(wall)),
+                                 ('bytes_total', sum(record.get('bytes', 0) for record in group)),
+                                 ('cpu_total', sum(record.get('user_sec', 0) + record.get('sys_sec', 0)
+                                                   for record in group)),
+                                 ('peak_rss_max', max(record.get('peak_rss', 0) for record in group))]))
+    return rows
+
+
+def trace_events(records):
+    """
+    Converts metrics records into a Chrome trace (chrome://tracing or Perfetto): one process per host and one row
+    per concurrently running job, with its phases and tool calls nested inside
+    """
+    if not records:
+        return {'traceEvents': []}
+    origin = min(record['start'] for record in records)
+    spans = {}
+    for record in records:
+        key = (record['host'], record.get('job_id'), record.get('thread', 'MainThread'))
+        start, end = record['start'], record['start'] + record['wall_sec']
+        if key in spans:
+            start, end = min(start, spans[key][0]), max(end, spans[key][1])
+        spans[key] = (start, end)
+    hosts = sorted(set(host for host, _, _ in spans))
+    rows = {}
+    for host in hosts:
+        row_ends = []
+        for key in sorted((key for key in spans if key[0] == host), key=lambda k: spans[k]):
+            start, end = spans[key]
+            free = [row for row, row_end in enumerate(row_ends) if row_end <= start]
+            row = free[0] if free else len(row_ends)
+            if free:
+                row_ends[row] = end
+            else:
+                row_ends.append(end)
+            rows[key] = row
+    events = [{'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0, 'args': {'name': host}}
+              for pid, host in enumerate(hosts)]
+    for record in records:
+        kind = record.get('kind', 'tool')
+        name = {'job': record['stage'], 'phase': record.get('phase')}.get(kind, record.get('image'))
+        args = dict((field, record[field]) for field in ['uuid', 'stage', 'cores', 'memory', 'bytes', 'user_sec',
+                                                         'sys_sec', 'peak_rss', 'read_bytes', 'write_bytes']
+                    if record.get(field) is not None)
+        events.append({'name': name, 'cat': kind, 'ph': 'X', 'pid': hosts.index(record['host']),
+                       'tid': rows[(record['host'], record.get('job_id'), record.get('thread', 'MainThread'))],
+                       'ts': (record['start'] - origin) * 1e6, 'dur': record['wall_sec'] * 1e6, 'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def collect_metrics(job, input_args, metrics):
+    """
+    Final job: writes every sample's metrics to metrics.jsonl, metrics_summary.tsv (per stage) and trace.json, updates
+    the --resource_model (if the pipeline has one), and copies the files to output_dir
+
+    input_args: dict        Input arguments
+    metrics: list           Nested lists of metrics FileStoreIDs returned by each sample's jobs
+
+    Returns: FileStoreID of metrics.jsonl
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    metrics_path = os.path.join(work_dir, 'metrics.jsonl')
+    records = []
+    with open(metrics_path, 'w') as f_out:
+        for i, metrics_id in enumerate(flatten_metrics(metrics)):
+            part = job.fileStore.readGlobalFile(metrics_id, os.path.join(work_dir, 'metrics.{}.jsonl'.format(i)))
+            with open(part) as f_in:
+                for line in f_in:
+                    f_out.write(line)
+                    records.append(json.loads(line))
+    summary_path = os.path.join(work_dir, 'metrics_summary.tsv')
+    rows = summarize_metrics(records)
+    with open(summary_path, 'w') as f_out:
+        if rows:
+            f_out.write('\t'.join(rows[0]) + '\n')
+        for row in rows:
+            f_out.write('\t'.join('{:.2f}'.format(v) if isinstance(v, float) else str(v) for v in row.values()) + '\n')
+    with open(summary_path) as f_in:
+        job.fileStore.logToMaster('Stage summary:\n' + f_in.read())
+    trace_path = os.path.join(work_dir, 'trace.json')
+    with open(trace_path, 'w') as f_out:
+        json.dump(trace_events(records), f_out)
+    outputs = [metrics_path, summary_path, trace_path]
+    if input_args.get('resource_model_path'):
+        model = update_resource_model(load_resource_model(input_args['resource_model_path']), records)
+        outputs.append(save_resource_model(model, input_args['resource_model_path'], work_dir))
+    if input_args['output_dir']:
+        if not os.path.exists(input_args['output_dir']):
+            os.makedirs(input_args['output_dir'])
+        for path in outputs:
+            shutil.copy(path, os.path.join(input_args['output_dir'], os.path.basename(path)))
+    return job.fileStore.writeGlobalFile(metrics_path)
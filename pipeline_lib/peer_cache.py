@@ -0,0 +1,278 @@
+"""
+Peer cache of shared files (--peer_cache): each node keeps one copy of the shared files and serves it over HTTP, so
+that nodes fetch them from each other rather than all from the job store
+"""
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from pipeline_lib.filestore import read_state, write_state
+from pipeline_lib.transfer import hedged_download
+
+# Default port of each node's server, seconds a server stays up without requests, seconds a node waits for another
+# node that is fetching a file, seconds between looks at the peers registry, peers tried before the job store,
+# bytes per write when serving, and the names of cache files
+PEER_CACHE_PORT = 8701
+PEER_CACHE_IDLE = 3600
+PEER_CACHE_WAIT = 900
+PEER_CACHE_POLL = 10
+PEER_CACHE_TRIES = 3
+PEER_CACHE_CHUNK = 1024 ** 2
+PEER_CACHE_KEY = r'^[0-9a-f]{16}-[\w.-]+$'
+
+
+class PeerCacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the complete files of a node's peer cache directory (--peer_cache) to the other nodes, with byte ranges.
+    Runs in its own process (see start_peer_server) until PEER_CACHE_IDLE seconds pass without a request.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, port):
+        HTTPServer.__init__(self, ('', port), PeerCacheHandler)
+        self.root = root
+        self.last_request = time.time()
+
+
+class PeerCacheHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        self.server.last_request = time.time()
+        key = self.path.lstrip('/')
+        path = os.path.join(self.server.root, key)
+        if not re.match(PEER_CACHE_KEY, key) or not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        first, last = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            first = int(match.group(1))
+            last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if first > last:
+                # The range starts past the end of the file (or ends before it starts)
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(206 if match else 200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(last - first + 1))
+        if match:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+        self.end_headers()
+        if not send_body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining:
+                data = f.read(min(PEER_CACHE_CHUNK, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+def serve_peer_cache(root, port):
+    """
+    Runs a node's peer cache server until it has been idle for PEER_CACHE_IDLE seconds. The port it listens on
+    (chosen by the OS if port is 0) and its pid are written to root/.server, where start_peer_server finds them.
+    """
+    server = PeerCacheServer(root, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    with open(os.path.join(root, '.server.tmp'), 'w') as f:
+        f.write('{} {}'.format(server.server_address[1], os.getpid()))
+    os.rename(os.path.join(root, '.server.tmp'), os.path.join(root, '.server'))
+    while time.time() - server.last_request < PEER_CACHE_IDLE:
+        time.sleep(min(30, PEER_CACHE_IDLE))
+    os.remove(os.path.join(root, '.server'))
+    server.shutdown()
+
+
+def start_peer_server(root, port):
+    """
+    Returns the port of this node's peer cache server for root, starting the server if it isn't running.
+    The server is a detached process (this module, run with python -m), so it outlives the job.
+
+    root: str               Peer cache directory of this node
+    port: int               Port to listen on (0: any free port, e.g. for several stand-in workers on one machine)
+    """
+    server_file = os.path.join(root, '.server')
+    with open(os.path.join(root, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(server_file):
+            with open(server_file) as f:
+                server_port, pid = [int(field) for field in f.read().split()]
+            try:
+                os.kill(pid, 0)
+                return server_port
+            except OSError:
+                # The server died without cleaning up
+                os.remove(server_file)
+        # Run from the directory holding pipeline_lib, which the job's script imports it from
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.devnull, 'w') as devnull:
+            subprocess.Popen([sys.executable, '-m', 'pipeline_lib.peer_cache', root, str(port)], cwd=package_dir,
+                             stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+        for _ in range(100):
+            if os.path.exists(server_file):
+                with open(server_file) as f:
+                    return int(f.read().split()[0])
+            time.sleep(0.1)
+    raise RuntimeError('The peer cache server for {} did not start'.format(root))
+
+
+def peer_address():
+    """
+    Returns this node's address on the cluster network (the one its default route uses)
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Connecting a UDP socket sends nothing; it only picks the outgoing interface
+        probe.connect(('10.255.255.255', 1))
+        return probe.getsockname()[0]
+    except socket.error:
+        return socket.gethostbyname(socket.gethostname())
+    finally:
+        probe.close()
+
+
+def update_peers(job, peers_id, key, url, state):
+    """
+    Records a node's state for a cache file in the peers registry, a JSON file in the job store listing the nodes
+    that have each file ('ready') and that are fetching it from the job store ('fetching')
+
+    peers_id: str           FileStoreID of the registry
+    key: str                Name of the cache file
+    url: str                Base URL of the node's peer cache server
+    state: str              'ready', 'fetching', or None to remove the node
+    """
+    registry = json.loads(read_state(job, peers_id) or '{}')
+    entry = registry.setdefault(key, {'ready': [], 'fetching': []})
+    for urls in entry.values():
+        if url in urls:
+            urls.remove(url)
+    if state:
+        entry[state].append(url)
+    # Concurrent updates can overwrite each other: a lost 'ready' only means one node fewer to fetch from, and a
+    # lost 'fetching' is noticed by the node that wrote it (see fetch_shared_file)
+    write_state(job, peers_id, json.dumps(registry))
+
+
+def fetch_shared_file(job, work_dir, file_id, peers_id, key, path, me):
+    """
+    Fetches a shared file into path from a node that has it, or else from the job store: one node reads it there
+    while the others wait up to PEER_CACHE_WAIT seconds for it to appear on that node
+
+    work_dir: str           Job's working directory, for files read from the job store
+    file_id: str            FileStoreID of the file
+    peers_id: str           FileStoreID of the peers registry (see update_peers)
+    key: str                Name of the file in the peer caches
+    path: str               Path the file is written to
+    me: str                 Base URL of this node's peer cache server
+
+    Returns: 'peer' or 'jobstore', where the file came from
+    """
+    deadline = time.time() + PEER_CACHE_WAIT
+    while True:
+        entry = json.loads(read_state(job, peers_id) or '{}').get(key, {})
+        peers = [url for url in entry.get('ready', []) if url != me]
+        random.shuffle(peers)
+        for url in peers[:PEER_CACHE_TRIES]:
+            try:
+                hedged_download(url + key, path)
+                return 'peer'
+            except (RuntimeError, subprocess.CalledProcessError):
+                job.fileStore.logToMaster('Peer {} failed to serve {}'.format(url, key))
+                shutil.rmtree(path + '.parts', ignore_errors=True)
+                if os.path.exists(path):
+                    os.remove(path)
+        fetching = entry.get('fetching', [])
+        if peers or time.time() > deadline or fetching[:1] == [me]:
+            break
+        if not fetching:
+            update_peers(job, peers_id, key, me, 'fetching')
+            # Let concurrent claims land before checking which one stands
+            time.sleep(random.uniform(0, PEER_CACHE_POLL))
+        else:
+            time.sleep(PEER_CACHE_POLL)
+    local_path = job.fileStore.readGlobalFile(file_id, os.path.join(work_dir, key))
+    shutil.copyfile(local_path, path)
+    return 'jobstore'
+
+
+def stage_cached_files(job, work_dir, ids, peer_cache, *names):
+    """
+    Places shared files (e.g. the reference) in work_dir from this node's peer cache, where each node keeps one
+    copy of each, hard-linked into the work_dirs and fetched from other nodes before the job store
+
+    work_dir: str           Working directory
+    ids: dict               jobstore id dictionary, with the peers registry as 'peers'
+    peer_cache: dict        Peer cache directory of the node ('dir') and port of its server ('port')
+    names: str              Names of the shared files in ids
+    """
+    root = peer_cache['dir']
+    if not os.path.isdir(root):
+        try:
+            os.makedirs(root)
+        except OSError:
+            pass
+    me = 'http://{}:{}/'.format(peer_address(), start_peer_server(root, peer_cache['port']))
+    for name in names:
+        # Keys are unique to the workflow's copy of the file, so nodes never serve another run's reference
+        key = '{}-{}'.format(hashlib.md5(str(ids[name]).encode()).hexdigest()[:16], name)
+        cache_path = os.path.join(root, key)
+        with open(os.path.join(root, key + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(cache_path):
+                if os.path.exists(cache_path + '.part'):
+                    # Left by a job that failed while fetching
+                    os.remove(cache_path + '.part')
+                source = fetch_shared_file(job, work_dir, ids[name], ids['peers'], key, cache_path + '.part', me)
+                os.chmod(cache_path + '.part', 0o444)
+                os.rename(cache_path + '.part', cache_path)
+                update_peers(job, ids['peers'], key, me, 'ready')
+                job.fileStore.logToMaster('Cached {} on {} from the {}'.format(name, me, source))
+        file_path = os.path.join(work_dir, name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(cache_path, file_path)
+        except OSError:
+            # The cache is on another file system
+            shutil.copyfile(cache_path, file_path)
+
+
+if __name__ == '__main__':
+    # A node's peer cache server, started by start_peer_server
+    serve_peer_cache(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,258 @@
+"""
+Resource model learned from the metrics of previous runs: per-stage fits of runtime, CPU, memory and disk against
+a sample's input size, used to size sample jobs and to plan a cohort
+"""
+import heapq
+import json
+import math
+import os
+import shutil
+import subprocess
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+try:
+    from boto.exception import S3ResponseError
+    from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+except ImportError:
+    # Only needed for a model kept in S3; boto comes with s3am, which saves it
+    S3Connection = None
+from pipeline_lib.config import read_config
+from pipeline_lib.transfer import sample_sizes, url_size
+
+# Headroom over predicted memory and disk, observations kept per stage, observations a stage needs before its
+# predictions are used, and the metrics that are fitted
+MODEL_MARGIN = 1.25
+MODEL_HISTORY = 200
+MODEL_MIN_SAMPLES = 3
+MODEL_METRICS = ['wall_sec', 'cpu_sec', 'peak_rss', 'disk']
+# Estimates used by --plan: bytes/sec of one download, and the copies of a job's inputs on a node's disk (FileStore
+# cache and the job's work dir)
+PLAN_DOWNLOAD_RATE = 100 * 1024 ** 2
+PLAN_DISK_COPIES = 2
+
+
+def load_resource_model(location):
+    """
+    Reads the resource model, a JSON file kept locally or in S3. Returns an empty model if there is none yet;
+    any other failure to read it is raised, so that saving can't overwrite the history.
+
+    location: str           Local path, or path-style S3 URL (https://s3.amazonaws.com/bucket/key), of the model
+    """
+    if location.startswith('http'):
+        if S3Connection is None:
+            raise RuntimeError('Reading the resource model from S3 needs boto. Install via "pip install boto"')
+        # Read with the ~/.boto credentials s3am writes the model with
+        url = urlparse(location)
+        bucket_name, key_name = url.path.lstrip('/').split('/', 1)
+        connection = S3Connection(host=url.hostname, port=url.port, is_secure=url.scheme == 'https',
+                                  calling_format=OrdinaryCallingFormat())
+        key = connection.get_bucket(bucket_name, validate=False).get_key(key_name, validate=False)
+        try:
+            return json.loads(key.get_contents_as_string())
+        except S3ResponseError as e:
+            if e.status == 404 and e.error_code == 'NoSuchKey':
+                return {}
+            raise
+    if not os.path.exists(location):
+        return {}
+    with open(location) as f_in:
+        return json.load(f_in)
+
+
+def save_resource_model(model, location, work_dir):
+    """
+    Writes the resource model back to where it was read from and returns the path of the local copy
+
+    model: dict             Resource model
+    location: str           Local path, or path-style S3 URL, of the model
+    work_dir: str           Directory for the local copy
+    """
+    path = os.path.join(work_dir, 'resource_model.json')
+    with open(path, 'w') as f_out:
+        json.dump(model, f_out, indent=1, sort_keys=True)
+    if location.startswith('http'):
+        bucket_name, key = location.split('/', 3)[3].split('/', 1)
+        subprocess.check_call(['s3am', 'upload', 'file://{}'.format(path), bucket_name, key])
+    else:
+        shutil.copy(path, location)
+    return path
+
+
+def model_fits(model):
+    """
+    Returns the part of the resource model the jobs need: each stage's fits and number of observations
+    """
+    return {key: dict(entry['fit'], count=len(entry['observations'])) for key, entry in model.items()}
+
+
+def fit_line(points):
+    """
+    Least-squares fit of y = a + b * x to a list of (x, y) points
+
+    Returns: [a, b, largest amount by which a point lies above the line]
+    """
+    n = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x if var_x else 0.0
+    intercept = mean_y - slope * mean_x
+    return [intercept, slope, max(0.0, max(y - intercept - slope * x for x, y in points))]
+
+
+def resource_observations(records):
+    """
+    Turns a run's metrics into one observation per sample job, keyed by stage and tool image ('stage@image'):
+    the sample's downloaded bytes with the job's wall time, CPU seconds, peak memory and disk use
+
+    records: list           Metrics records of the run
+    """
+    input_bytes = {}
+    jobs = {}
+    for record in records:
+        if record.get('kind') == 'phase' and record['phase'] == 'download' and record.get('uuid'):
+            input_bytes[record['uuid']] = input_bytes.get(record['uuid'], 0) + record['bytes']
+        jobs.setdefault(record.get('job_id'), []).append(record)
+    observations = {}
+    for group in jobs.values():
+        job_record = [record for record in group if record.get('kind') == 'job']
+        if not job_record or not input_bytes.get(job_record[0]['uuid']):
+            continue
+        job_record = job_record[0]
+        tools = [record for record in group if record.get('kind', 'tool') == 'tool']
+        key = job_record['stage'] + ('@' + tools[0]['image'] if tools else '')
+        # Files that are stored or uploaded were already counted by the phase that produced them
+        disk = sum(record['bytes'] for record in group
+                   if record.get('kind') == 'phase' and record['phase'] not in ('store', 'upload'))
+        observations.setdefault(key, []).append({
+            'input_bytes': input_bytes[job_record['uuid']], 'wall_sec': job_record['wall_sec'],
+            'cpu_sec': sum(record.get('user_sec', 0) + record.get('sys_sec', 0) for record in tools),
+            'peak_rss': max([record.get('peak_rss', 0) for record in tools] or [0]), 'disk': disk})
+    return observations
+
+
+def update_resource_model(model, records):
+    """
+    Adds a run's observations to the resource model and refits the stages that got new ones, keeping each stage's
+    last MODEL_HISTORY observations
+
+    model: dict             Resource model, updated in place
+    records: list           Metrics records of the run
+    """
+    for key, observations in resource_observations(records).items():
+        entry = model.setdefault(key, {'observations': []})
+        entry['observations'] = (entry['observations'] + observations)[-MODEL_HISTORY:]
+        entry['fit'] = {name: fit_line([(obs['input_bytes'], obs[name]) for obs in entry['observations']])
+                        for name in MODEL_METRICS}
+    return model
+
+
+def model_requirements(input_args, stage, input_bytes, image=None, **defaults):
+    """
+    Returns the Toil requirements (cores, memory, disk) of a sample's job as predicted from its input size, or
+    defaults for those the model can't predict yet
+
+    input_args: dict        Input arguments, with the model's fits as 'resource_model'
+    stage: str              Stage of the job
+    input_bytes: int        Total size of the sample's inputs (None if unknown)
+    image: str              Image of the tool the job runs, if any
+    defaults: dict          Requirements to use without a prediction
+    """
+    fits = input_args['resource_model'].get(stage + ('@' + image if image else ''))
+    if not fits or not input_bytes or fits['count'] < MODEL_MIN_SAMPLES:
+        return defaults
+
+    def predict(name, margin=True):
+        intercept, slope, residual = fits[name]
+        if not margin:
+            return intercept + slope * input_bytes
+        return (intercept + slope * input_bytes + residual) * MODEL_MARGIN
+
+    requirements = dict(defaults)
+    if predict('peak_rss') > 0:
+        requirements['memory'] = int(predict('peak_rss'))
+    if predict('disk') > 0:
+        requirements['disk'] = int(predict('disk'))
+    if predict('wall_sec', margin=False) > 0 and predict('cpu_sec', margin=False) > 0:
+        cores = int(math.ceil(predict('cpu_sec', margin=False) / predict('wall_sec', margin=False)))
+        requirements['cores'] = max(1, min(input_args['cpu_count'], cores))
+    return requirements
+
+
+def plan_runtime(input_args, stage, tool, input_bytes, rate=None):
+    """
+    Estimates the runtime of a sample's job (for --plan and --speculate), from the resource model (any digest of
+    the tool's image) or else from the tool's throughput
+
+    input_args: dict        Input arguments
+    stage: str              Stage of the job
+    tool: str               Name of the image the job runs
+    input_bytes: int        Total size of the sample's inputs
+    rate: int               Throughput in bytes/sec to use without the model (None: return None)
+    """
+    prefix = '{}@{}'.format(stage, tool)
+    fits = [fits for key, fits in input_args['resource_model'].items()
+            if (key == prefix or key.startswith(prefix + '@')) and fits['count'] >= MODEL_MIN_SAMPLES]
+    if fits:
+        intercept, slope, _ = max(fits, key=lambda fit: fit['count'])['wall_sec']
+        return max(0.0, intercept + slope * input_bytes)
+    return input_bytes / float(rate) if rate else None
+
+
+def makespan(durations, nodes):
+    """
+    Returns the time to run jobs of the given durations on a number of nodes, one job per node at a time,
+    longest jobs first
+    """
+    loads = [0.0] * nodes
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(loads, loads[0] + duration)
+    return max(loads)
+
+
+def plan_cohort(input_args, config_files, shared_files, estimate, disk_stage, nodes, node_disk):
+    """
+    --plan: estimates a run without starting it from the inputs' sizes and the tools' throughput (or the resource
+    model), and prints the transfer, peak disk, makespan per node count and the samples that won't fit a node
+
+    input_args: dict        Input arguments
+    config_files: list      (name, encrypted) of the files each row of the config gives the URL of, in order
+    shared_files: list      Names of the shared files in input_args
+    estimate: function      Returns the compute time of a sample and the inputs held by its largest job in bytes,
+                            from input_args, the sizes of the sample's files and the size of the shared files
+    disk_stage: str         Stage of a sample's largest job
+    nodes: list             Cluster sizes to estimate the makespan for
+    node_disk: int          Disk of a node in bytes, if known
+    """
+    rows, problems = read_config(input_args['config'], config_files)
+    samples = [(uuid, urls) for _, uuid, urls in rows]
+    shared_bytes = sum(sample_sizes([input_args[name] for name in shared_files], url_size))
+    sizes = sample_sizes(samples, lambda sample: [url_size(url, input_args['ssec'] if encrypted else None)
+                                                  for (_, encrypted), url in zip(config_files, sample[1])])
+    durations = []
+    disks = []
+    for file_sizes in sizes:
+        compute, job_bytes = estimate(input_args, file_sizes, shared_bytes)
+        durations.append(max(file_sizes) / float(PLAN_DOWNLOAD_RATE) + compute)
+        disks.append(PLAN_DISK_COPIES * job_bytes)
+    unknown = [uuid for (uuid, _), file_sizes in zip(samples, sizes) if not all(file_sizes)]
+    total = shared_bytes + sum(sum(file_sizes) for file_sizes in sizes)
+    print('Plan for {} samples in {}'.format(len(samples), input_args['config']))
+    print('  Transfer: {:.1f} GiB ({:.1f} GiB shared files)'.format(total / 1024.0 ** 3, shared_bytes / 1024.0 ** 3))
+    if disks:
+        peak = disks.index(max(disks))
+        print('  Peak job disk: {:.1f} GiB ({} of {})'.format(disks[peak] / 1024.0 ** 3, disk_stage, samples[peak][0]))
+    start = shared_bytes / float(PLAN_DOWNLOAD_RATE)
+    for count in nodes:
+        print('  Makespan on {} node(s): {:.1f} h'.format(count, (start + makespan(durations, count)) / 3600))
+    if node_disk:
+        over = [uuid for (uuid, _), disk in zip(samples, disks) if disk > node_disk]
+        print('  Samples over {:.0f} GiB of node disk: {}'.format(node_disk / 1024.0 ** 3, ', '.join(over) or 'none'))
+    if unknown:
+        print('  Samples with inputs that could not be sized (counted as 0 bytes): {}'.format(', '.join(unknown)))
+    if problems:
+        print('  Rows left out of the plan:')
+        for number, uuid, message in problems:
+            print('    line {} ({}): {}'.format(number, uuid or '-', message))
@@ -0,0 +1,56 @@
+"""
+Whitelist targets: matching their chromosome names to the reference, and sorting and merging them as bedtools merge
+does
+"""
+from pipeline_lib.bam import read_targets
+
+
+def read_fai(fai_path):
+    """
+    Returns the contig names of a fasta index (fai), in reference order
+    """
+    with open(fai_path) as f_in:
+        return [line.split('\t')[0] for line in f_in if line.strip()]
+
+
+def reference_name(chromosome, contigs):
+    """
+    Returns a chromosome's name as the reference calls it, adding or removing the 'chr' prefix (and M / MT) as needed.
+    Names the reference doesn't have in any form are returned unchanged.
+
+    chromosome: str         Chromosome name from a bed file
+    contigs: set            Contig names of the reference
+    """
+    if chromosome in contigs:
+        return chromosome
+    bare = chromosome[3:] if chromosome.startswith('chr') else chromosome
+    for name in [bare, 'chr' + bare] + (['MT', 'chrM'] if bare in ('M', 'MT') else []):
+        if name in contigs:
+            return name
+    return chromosome
+
+
+def prepare_targets(bed_path, contigs=None):
+    """
+    Reads the targets of a bed file, renames their chromosomes to match the reference, sorts them (in the reference's
+    contig order, then other chromosomes by name) and merges overlapping or adjacent targets
+
+    bed_path: str           Bed file with the targets
+    contigs: list           Contig names of the reference in order, if known
+
+    Returns: sorted list of merged (chromosome, start, end) targets
+    """
+    contigs = contigs or []
+    rank = dict((name, i) for i, name in enumerate(contigs))
+    targets = []
+    for chromosome, regions in read_targets(bed_path).items():
+        name = reference_name(chromosome, rank)
+        targets.extend((name, start, end) for start, end in regions)
+    targets.sort(key=lambda target: (rank.get(target[0], len(rank)), target[0], target[1], target[2]))
+    merged = []
+    for chromosome, start, end in targets:
+        if merged and merged[-1][0] == chromosome and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chromosome, start, end])
+    return [tuple(target) for target in merged]
@@ -0,0 +1,377 @@
+"""
+Downloads from S3: SSE-C headers, HEAD requests, ranged and hedged downloads, and the node-wide transfer governor
+"""
+import base64
+from contextlib import contextmanager
+import fcntl
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import subprocess
+import time
+
+# Ranged downloads: number of concurrent connections and size of each byte range
+DOWNLOAD_CONNECTIONS = 8
+DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+# Seconds before a connection's throughput is judged, and the fraction of the median below which it is hedged
+HEDGE_GRACE = 15
+HEDGE_RATIO = 0.25
+# Seconds between attempts to acquire a node-wide transfer slot, and the slots --max_bandwidth is split over
+# when --max_transfers isn't given
+GOVERNOR_POLL = 5
+GOVERNOR_SLOTS = 4
+# Concurrent HEAD requests used to size or check the samples' inputs
+HEAD_CONNECTIONS = 16
+# Maximum number of a sample's input files downloaded at the same time
+MAX_SAMPLE_DOWNLOADS = 4
+
+
+def generate_unique_key(master_key_path, url):
+    """
+    Input1: Path to the BD2K Master Key (for S3 Encryption)
+    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
+
+    Returns: 32-byte unique key generated for that URL
+    """
+    with open(master_key_path, 'r') as f:
+        master_key = f.read()
+    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
+                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
+    new_key = hashlib.sha256(master_key + url).digest()
+    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
+    return new_key
+
+
+def encryption_headers(key_path, url):
+    """
+    Returns the SSE-C headers needed to retrieve an encrypted file from S3
+
+    key_path: str   Path to the master key needed to derive unique encryption keys per file
+    url: str        S3 URL of the file
+    """
+    with open(key_path, 'r') as f:
+        key = f.read()
+    if len(key) != 32:
+        raise RuntimeError('Invalid Key! Must be 32 bytes: {}'.format(key))
+
+    key = generate_unique_key(key_path, url)
+
+    encoded_key = base64.b64encode(key)
+    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
+    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
+    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
+    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
+    return [h1, h2, h3]
+
+
+def curl_command(url, file_path, headers=(), byte_range=None, rate=None):
+    """
+    Returns the curl command that downloads a URL (or a byte range of it) to file_path
+
+    headers: list       Headers to send with the request (e.g. SSE-C)
+    byte_range: tuple   Optional (first, last) byte offsets, inclusive
+    rate: int           Optional bandwidth limit in bytes/sec
+    """
+    command = ['curl', '-fs', '--retry', '5', '--create-dir']
+    for header in headers:
+        command += ['-H', header]
+    if byte_range:
+        command += ['-r', '{}-{}'.format(*byte_range)]
+    if rate:
+        command += ['--limit-rate', str(rate)]
+    return command + [url, '-o', file_path]
+
+
+def check_url(url, headers=()):
+    """
+    Issues a HEAD request and returns the status of the final response (None if there was none, e.g. an unknown
+    host) and its headers as a dict with lower-case names
+
+    url: str            URL to be checked
+    headers: list       Headers to send with the request (e.g. SSE-C)
+    """
+    command = ['curl', '-sI', '--retry', '5']
+    for header in headers:
+        command += ['-H', header]
+    try:
+        output = subprocess.check_output(command + [url], universal_newlines=True)
+    except OSError:
+        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    except subprocess.CalledProcessError:
+        return None, {}
+    status, response = None, {}
+    for line in output.splitlines():
+        if line.startswith('HTTP/'):
+            # Only keep the final response if there were redirects
+            status, response = int(line.split()[1]), {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            response[name.strip().lower()] = value.strip()
+    return status, response
+
+
+def head_url(url, headers=()):
+    """
+    Issues a HEAD request and returns the response headers as a dict with lower-case names (empty if it failed)
+
+    url: str            URL to be checked
+    headers: list       Headers to send with the request (e.g. SSE-C)
+    """
+    status, response = check_url(url, headers)
+    return response if status and status < 400 else {}
+
+
+def url_size(url, key_path=None):
+    """
+    Returns the size in bytes of the file behind a URL, or 0 if it can't be determined
+
+    url: str            URL to be checked
+    key_path: str       Path to the master key, if the file is SSE-C encrypted
+    """
+    headers = encryption_headers(key_path, url) if key_path else ()
+    return int(head_url(url, headers).get('content-length', 0))
+
+
+def sample_sizes(samples, size):
+    """
+    Returns size(sample) for every sample, sizing HEAD_CONNECTIONS samples concurrently
+
+    samples: list           Samples from the config (or URLs)
+    size: function          Returns the size of one sample's inputs, from HEAD requests
+    """
+    pool = ThreadPool(HEAD_CONNECTIONS)
+    try:
+        return pool.map(size, samples)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fetch_range(url, headers=(), byte_range=None, rate=None):
+    """
+    Returns the content of a URL, or of a byte range of it
+
+    headers: list       Headers to send with the request (e.g. SSE-C)
+    byte_range: tuple   Optional (first, last) byte offsets, inclusive
+    rate: int           Optional bandwidth limit in bytes/sec
+    """
+    try:
+        return subprocess.check_output(curl_command(url, '-', headers, byte_range, rate))
+    except OSError:
+        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+
+
+def hedged_download(url, file_path, headers=(), rate=None):
+    """
+    Downloads a URL as DOWNLOAD_CONNECTIONS concurrent byte ranges, requesting a range again on a fresh connection
+    when its connection is much slower than the others (see HEDGE_RATIO). Small files are fetched in one stream.
+
+    url: str            URL to be downloaded
+    file_path: str      Path the file is written to
+    headers: list       Headers to send with every request (e.g. SSE-C)
+    rate: int           Optional bandwidth limit in bytes/sec, split evenly over the connections (hedges included)
+    """
+    response = head_url(url, headers)
+    size = int(response.get('content-length', 0))
+    if response.get('accept-ranges') != 'bytes' or size <= DOWNLOAD_PART_SIZE:
+        try:
+            subprocess.check_call(curl_command(url, file_path, headers, rate=rate))
+        except OSError:
+            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        return
+
+    ranges = [(start, min(start + DOWNLOAD_PART_SIZE, size) - 1) for start in range(0, size, DOWNLOAD_PART_SIZE)]
+    part_dir = file_path + '.parts'
+    if not os.path.exists(part_dir):
+        os.makedirs(part_dir)
+    pending = list(range(len(ranges)))
+    running = {}    # range index -> list of attempts: [process, part path, start time]
+    finished = {}   # range index -> part path
+    rates = []      # bytes/sec of completed attempts
+    launched = [0]
+    # curl treats a zero --limit-rate as unlimited
+    connection_rate = max(1, rate // DOWNLOAD_CONNECTIONS) if rate else None
+
+    def busy():
+        # Under a bandwidth limit a hedge uses up one of the connections, so it can't exceed the limit
+        return sum(len(attempts) for attempts in running.values()) if rate else len(running)
+
+    def launch(index):
+        launched[0] += 1
+        path = os.path.join(part_dir, '{}.{}'.format(index, launched[0]))
+        try:
+            process = subprocess.Popen(curl_command(url, path, headers, ranges[index], connection_rate))
+        except OSError:
+            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        running.setdefault(index, []).append([process, path, time.time()])
+
+    try:
+        while len(finished) < len(ranges):
+            while pending and busy() < DOWNLOAD_CONNECTIONS:
+                launch(pending.pop(0))
+            time.sleep(1)
+            now = time.time()
+            live = []
+            for index, attempts in list(running.items()):
+                first, last = ranges[index]
+                for attempt in list(attempts):
+                    process, path, started = attempt
+                    returncode = process.poll()
+                    if returncode is None:
+                        done = os.path.getsize(path) if os.path.exists(path) else 0
+                        live.append((index, done / max(now - started, 1e-3), now - started))
+                        continue
+                    attempts.remove(attempt)
+                    if returncode == 0 and os.path.getsize(path) == last - first + 1:
+                        rates.append((last - first + 1) / max(now - started, 1e-3))
+                        finished[index] = path
+                        break
+                    if os.path.exists(path):
+                        os.remove(path)
+                if index in finished:
+                    # First copy of this range to finish wins; cancel the others
+                    for process, path, _ in attempts:
+                        process.kill()
+                        process.wait()
+                        if os.path.exists(path):
+                            os.remove(path)
+                    del running[index]
+                elif not attempts:
+                    raise RuntimeError('Failed to download bytes {}-{} of {}'.format(first, last, url))
+            # Hedge stragglers once there is enough data to judge what a healthy connection looks like
+            samples = sorted(rates + [speed for _, speed, elapsed in live if elapsed > HEDGE_GRACE])
+            if len(samples) < 2:
+                continue
+            median = samples[len(samples) // 2]
+            for index, speed, elapsed in live:
+                if index in running and len(running[index]) == 1 and elapsed > HEDGE_GRACE \
+                        and speed < HEDGE_RATIO * median and (not rate or busy() < DOWNLOAD_CONNECTIONS):
+                    launch(index)
+
+        with open(file_path, 'wb') as f_out:
+            for index in range(len(ranges)):
+                with open(finished[index], 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+    finally:
+        for attempts in running.values():
+            for process, _, _ in attempts:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def parse_rate(rate):
+    """
+    Converts a bandwidth such as '200M' to bytes/sec. Returns None if no rate is given.
+    """
+    if not rate:
+        return None
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    rate = str(rate).strip().upper()
+    if rate[-1] in units:
+        return int(float(rate[:-1]) * units[rate[-1]])
+    return int(rate)
+
+
+def governor_slots(governor):
+    """
+    Returns the number of transfer slots per node (None for unlimited); a bandwidth limit needs a fixed number
+    """
+    if not governor:
+        return None
+    return governor.get('max_transfers') or (GOVERNOR_SLOTS if governor.get('max_bandwidth') else None)
+
+
+def transfer_rate(governor):
+    """
+    Returns the bandwidth (bytes/sec) a single transfer may use: the node's aggregate limit split over its slots
+
+    governor: dict      Node-wide transfer limits (see transfer_slot)
+    """
+    if not governor or not governor.get('max_bandwidth'):
+        return None
+    return max(1, parse_rate(governor['max_bandwidth']) // governor_slots(governor))
+
+
+@contextmanager
+def transfer_slot(governor):
+    """
+    Holds one of the node's transfer slots, lock files in governor['lock_dir'] shared by every Toil worker on the
+    host, for the duration of a transfer
+
+    governor: dict      Contains max_transfers (None for unlimited), max_bandwidth and lock_dir
+    """
+    slots = governor_slots(governor)
+    if not slots:
+        yield
+        return
+    lock_dir = governor['lock_dir']
+    try:
+        os.makedirs(lock_dir)
+    except OSError:
+        if not os.path.isdir(lock_dir):
+            raise
+    while True:
+        for slot in range(slots):
+            lock_file = open(os.path.join(lock_dir, 'slot.{}'.format(slot)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(GOVERNOR_POLL)
+
+
+def download_batch(job, urls, governor=None):
+    """
+    Downloads several URLs concurrently within a single job and stores them in the FileStore.
+
+    urls: dict      Maps file name to the URL it is downloaded from
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+
+    Returns: dict mapping file name to FileStoreID
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+
+    def fetch(name):
+        file_path = os.path.join(work_dir, name)
+        with transfer_slot(governor):
+            hedged_download(urls[name], file_path, rate=transfer_rate(governor))
+        assert os.path.exists(file_path)
+        return file_path
+
+    names = list(urls)
+    pool = ThreadPool(len(names))
+    try:
+        # map() re-raises the first download failure once all downloads have finished
+        paths = pool.map(fetch, names)
+    finally:
+        pool.close()
+        pool.join()
+    # The fileStore is only used from the job's own thread
+    return {name: job.fileStore.writeGlobalFile(path) for name, path in zip(names, paths)}
+
+
+def download_concurrently(downloads):
+    """
+    Runs several downloads at once, at most MAX_SAMPLE_DOWNLOADS at a time, and waits for all of them. Raises the
+    first failed download's error; the other downloads are allowed to finish first.
+
+    downloads: list     (download function, argument tuple) pairs
+    """
+    pool = ThreadPool(min(len(downloads), MAX_SAMPLE_DOWNLOADS))
+    try:
+        results = [pool.apply_async(download, args) for download, args in downloads]
+        for result in results:
+            result.get()
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,96 @@
+import contextlib
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+# The pipelines import pipeline_lib from the directory they run in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LocalFileStore(object):
+    """
+    Stand-in for a Toil 3.0 FileStore that keeps the job store's files in a local directory
+    """
+    def __init__(self, root):
+        self.root = root
+        self.ids = itertools.count()
+        self.messages = []
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.root)
+
+    def getEmptyFileStoreID(self):
+        file_id = 'file{}'.format(next(self.ids))
+        open(os.path.join(self.root, file_id), 'w').close()
+        return file_id
+
+    def writeGlobalFile(self, localFileName):
+        file_id = self.getEmptyFileStoreID()
+        shutil.copyfile(localFileName, os.path.join(self.root, file_id))
+        return file_id
+
+    def updateGlobalFile(self, fileStoreID, localFileName):
+        shutil.copyfile(localFileName, os.path.join(self.root, fileStoreID))
+
+    def readGlobalFile(self, fileStoreID, localFilePath=None):
+        localFilePath = localFilePath or os.path.join(self.getLocalTempDir(), fileStoreID)
+        shutil.copyfile(os.path.join(self.root, fileStoreID), localFilePath)
+        return localFilePath
+
+    @contextlib.contextmanager
+    def readGlobalFileStream(self, fileStoreID):
+        with open(os.path.join(self.root, fileStoreID)) as f:
+            yield f
+
+    @contextlib.contextmanager
+    def updateGlobalFileStream(self, fileStoreID):
+        with open(os.path.join(self.root, fileStoreID), 'w') as f:
+            yield f
+
+    def deleteGlobalFile(self, fileStoreID):
+        os.remove(os.path.join(self.root, fileStoreID))
+
+    def logToMaster(self, message):
+        self.messages.append(message)
+
+
+class Promise(object):
+    def __init__(self, call):
+        self.call = call
+
+    def rv(self):
+        return self
+
+
+class LocalJob(object):
+    """
+    Stand-in for a Toil 3.0 job: records the jobs it adds instead of running them. As in Toil, requirements that
+    aren't given are None.
+    """
+    def __init__(self, file_store, cores=None, memory=None, disk=None):
+        self.fileStore = file_store
+        self.cores, self.memory, self.disk = cores, memory, disk
+        self.children, self.follow_ons = [], []
+
+    def addChildJobFn(self, fn, *args, **kwargs):
+        self.children.append((fn, args, kwargs))
+        return Promise(self.children[-1])
+
+    def addFollowOnJobFn(self, fn, *args, **kwargs):
+        self.follow_ons.append((fn, args, kwargs))
+        return Promise(self.follow_ons[-1])
+
+    def job_for(self, requirements):
+        """
+        Returns a job as Toil would run one added with these requirements
+        """
+        return LocalJob(self.fileStore, requirements.get('cores'), requirements.get('memory'),
+                        requirements.get('disk'))
+
+
+@pytest.fixture
+def local_job(tmpdir):
+    return LocalJob(LocalFileStore(str(tmpdir.mkdir('jobstore'))))
@@ -0,0 +1,38 @@
+"""
+Runs jobs of the zygosity pipeline with local stand-ins for Toil's job and FileStore (see conftest.py)
+"""
+import os
+import pytest
+pytest.importorskip('toil')
+import toil_adtex_zygosity as zygosity
+
+
+def sample_args(**args):
+    return dict({'uuid': 'sample', 'input_bytes': None, 'coverage_engine': 'bedtools', 'coverage_format': 'text',
+                 'resource_model': {}, 'cpu_count': 4, 'speculate': False}, **args)
+
+
+def test_bedtools_coverage_without_a_model(local_job, monkeypatch, tmpdir):
+    # With the default bedtools engine and no resource model, bedtools_coverage runs with the default requirements
+    input_args = sample_args()
+    bam, white = tmpdir.join('control.bam'), tmpdir.join('white.bed')
+    bam.write('bam')
+    white.write('chr1\t0\t10\n')
+    ids = {'control.bam': (local_job.fileStore.writeGlobalFile(str(bam)), []), 'tumor.bam': ('tumor', []),
+           'sample.baf': ('baf', []), 'white.bed': local_job.fileStore.writeGlobalFile(str(white))}
+    zygosity.bam_to_coverage(local_job, (input_args, ids))
+    function, (bamfile, job_vars), requirements = local_job.children[0]
+    assert function is zygosity.bedtools_coverage and bamfile == 'control.bam'
+
+    def coverage_call(job, input_args, ids, work_dir, bamfile, file_path, cores, binary=False):
+        with open(file_path, 'w') as f_out:
+            f_out.write('chr1\t0\t10\t1\t0\n')
+        return {'kind': 'tool', 'cores': cores}
+
+    monkeypatch.setattr(zygosity, 'coverage_call', coverage_call)
+    job = local_job.job_for(requirements)
+    cov_id, _ = zygosity.bedtools_coverage(job, bamfile, job_vars)
+    assert [record['cores'] for record in job.profile.records if record.get('kind') == 'tool'] == [1]
+    assert os.path.exists(os.path.join(local_job.fileStore.root, cov_id))
+    # The bam's only consumer releases it
+    assert not os.path.exists(os.path.join(local_job.fileStore.root, ids['control.bam']))
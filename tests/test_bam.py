@@ -0,0 +1,20 @@
+import subprocess
+import pytest
+from pipeline_lib import bam
+from pipeline_lib.bam import fetch_targeted_bam
+
+
+@pytest.mark.parametrize('url, index_urls', [
+    ('https://host/tumor.bam', ['https://host/tumor.bam.bai', 'https://host/tumor.bai']),
+    # The bam itself must not be fetched as a candidate index
+    ('https://host/samples/tumor', ['https://host/samples/tumor.bai'])])
+def test_missing_index(tmpdir, monkeypatch, url, index_urls):
+    fetched = []
+
+    def fetch_range(url, headers=(), byte_range=None, rate=None):
+        fetched.append(url)
+        raise subprocess.CalledProcessError(22, ['curl', url])
+
+    monkeypatch.setattr(bam, 'fetch_range', fetch_range)
+    assert fetch_targeted_bam(url, lambda url: [], 'targets.bed', str(tmpdir.join('targeted.bam'))) is None
+    assert fetched == index_urls
@@ -0,0 +1,47 @@
+import os
+from pipeline_lib import filestore
+from pipeline_lib.filestore import finish_race, start_race, watch_race, write_state
+
+
+def attempt(job, sample, race=None):
+    pass
+
+
+def watcher(job, race, requirements, deadline, sample):
+    pass
+
+
+def test_start_race(local_job):
+    ids = {'tumor.bam': local_job.fileStore.getEmptyFileStoreID()}
+    results = start_race(local_job, attempt, watcher, ('sample',), {'cores': 4}, 300.0, ids, ('tumor.bam',))
+    assert len(results) == 2
+    (first, args, kwargs), (second, watcher_args, watcher_kwargs) = local_job.children
+    assert (first, args, kwargs['race']['attempt'], kwargs['cores']) == (attempt, ('sample',), 0, 4)
+    assert second is watcher and watcher_kwargs == filestore.SPECULATE_WATCHER
+    assert watcher_args[0]['attempt'] == 1 and watcher_args[1:] == ({'cores': 4}, 300.0, 'sample')
+    # Both attempts share the race's files
+    race = dict(kwargs['race'])
+    del race['attempt']
+    assert dict(watcher_args[0], attempt=0) == kwargs['race']
+    fn, args, _ = local_job.follow_ons[0]
+    assert fn is finish_race
+    fn(local_job, *args)
+    root = local_job.fileStore.root
+    assert not os.path.exists(os.path.join(root, ids['tumor.bam']))
+    assert not any(os.path.exists(os.path.join(root, file_id)) for file_id in [race['done']] + race['claims'])
+
+
+def test_watch_race(local_job, monkeypatch):
+    monkeypatch.setattr(filestore, 'SPECULATE_POLL', 0)
+    monkeypatch.setattr(filestore, 'SPECULATE_GRACE', 0)
+    race = filestore.new_race(local_job)
+    # Attempt 0 never started
+    assert not watch_race(local_job, race, 0, 'run_muse for sample')
+    # Attempt 0 runs past the deadline
+    write_state(local_job, race['started'], '1')
+    assert watch_race(local_job, race, 0, 'run_muse for sample')
+    # Attempt 0 finished
+    write_state(local_job, race['done'], '0')
+    assert not watch_race(local_job, race, 3600, 'run_muse for sample')
+    assert local_job.fileStore.messages == ['run_muse for sample has not started after 0 s, no longer watching it',
+                                            'run_muse for sample has run for over 0 s, launching a duplicate']
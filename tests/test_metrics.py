@@ -0,0 +1,19 @@
+import json
+import os
+from pipeline_lib.metrics import collect_metrics, write_metrics
+
+
+def test_collect_metrics(local_job, tmpdir):
+    records = [{'kind': 'job', 'stage': 'varscan', 'uuid': 'sample{}'.format(i), 'host': 'node1', 'start': 100.0 + i,
+                'wall_sec': 10.0 * (i + 1)} for i in range(3)]
+    # Samples return nested lists of metrics, some of them empty (e.g. a cancelled attempt)
+    metrics = [[write_metrics(local_job, records[:1])], [[write_metrics(local_job, records[1:])], []]]
+    output_dir = str(tmpdir.join('out'))
+    # Pipelines without a resource model have no resource_model_path
+    metrics_id = collect_metrics(local_job, {'output_dir': output_dir}, metrics)
+    with open(os.path.join(local_job.fileStore.root, metrics_id)) as f_in:
+        assert [json.loads(line) for line in f_in] == records
+    assert sorted(os.listdir(output_dir)) == ['metrics.jsonl', 'metrics_summary.tsv', 'trace.json']
+    with open(os.path.join(output_dir, 'metrics_summary.tsv')) as f_in:
+        header, row = [line.rstrip('\n').split('\t') for line in f_in]
+    assert dict(zip(header, row))['wall_total'] == '60.00'
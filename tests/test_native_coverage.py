@@ -0,0 +1,75 @@
+"""
+Checks the native coverage engine (--coverage_engine numpy) against bedtools coverage -d, on a bam with deletions,
+skips and unmapped reads (data/reads.bam) and overlapping targets (data/targets.bed)
+"""
+import gzip
+import os
+import re
+import subprocess
+import pytest
+np = pytest.importorskip('numpy')
+from pipeline_lib import coverage
+from pipeline_lib.coverage import IntervalIndex, native_coverage
+from pipeline_lib.targets import prepare_targets
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+CONTIGS = ['chr1', 'chr2', 'chrM', 'chr3']
+
+
+def run_native(tmpdir, binary=False):
+    index = IntervalIndex(prepare_targets(os.path.join(DATA, 'targets.bed'), CONTIGS))
+    cov_path = str(tmpdir.join('native.npz' if binary else 'native.cov'))
+    native_coverage(os.path.join(DATA, 'reads.bam'), index, cov_path, 3, binary=binary)
+    if binary:
+        coverage.expand_depth_npz(cov_path)
+    with open(cov_path, 'rb') as f_in:
+        return f_in.read()
+
+
+def expected():
+    # bedtools coverage -d over the prepared targets, computed per base with pysam
+    with gzip.open(os.path.join(DATA, 'targets.cov.gz'), 'rb') as f_in:
+        return f_in.read()
+
+
+def bedtools_version():
+    try:
+        output = subprocess.check_output(['bedtools', '--version'])
+    except OSError:
+        return None
+    return tuple(int(part) for part in re.search(r'v(\d+)\.(\d+)', output.decode('ascii')).groups())
+
+
+# Segments smaller than a BGZF block, records spanning segments, and one segment for the whole bam
+@pytest.mark.parametrize('segment', [1000, 8192, 32 * 1024 ** 2])
+def test_matches_expected(tmpdir, monkeypatch, segment):
+    monkeypatch.setattr(coverage, 'COVERAGE_SEGMENT', segment)
+    assert run_native(tmpdir) == expected()
+
+
+def test_npz_matches_expected(tmpdir, monkeypatch):
+    monkeypatch.setattr(coverage, 'COVERAGE_SEGMENT', 8192)
+    assert run_native(tmpdir, binary=True) == expected()
+
+
+def test_rescues_misidentified_segments(tmpdir, monkeypatch):
+    # Segments whose first record isn't found are decoded again from where the previous one ended
+    monkeypatch.setattr(coverage, 'COVERAGE_SEGMENT', 4096)
+    monkeypatch.setattr(coverage, 'first_record', lambda data, start, end, n_ref: None)
+    assert run_native(tmpdir) == expected()
+
+
+@pytest.mark.skipif(bedtools_version() is None, reason='bedtools is not installed')
+def test_matches_bedtools(tmpdir, monkeypatch):
+    monkeypatch.setattr(coverage, 'COVERAGE_SEGMENT', 8192)
+    bed_path = str(tmpdir.join('prepared.bed'))
+    with open(bed_path, 'w') as f_out:
+        for target in prepare_targets(os.path.join(DATA, 'targets.bed'), CONTIGS):
+            f_out.write('{}\t{}\t{}\n'.format(*target))
+    bam_path = os.path.join(DATA, 'reads.bam')
+    # bedtools 2.24 swapped the roles of -a and -b in coverage
+    if bedtools_version() < (2, 24):
+        command = ['bedtools', 'coverage', '-abam', bam_path, '-d', '-b', bed_path]
+    else:
+        command = ['bedtools', 'coverage', '-a', bed_path, '-b', bam_path, '-d']
+    assert run_native(tmpdir) == subprocess.check_output(command)
@@ -0,0 +1,87 @@
+"""
+Runs two peer cache servers on this machine, standing in for two nodes, and fetches a shared file between them
+"""
+import json
+import os
+import threading
+import pytest
+from pipeline_lib import peer_cache, transfer
+from pipeline_lib.peer_cache import PeerCacheServer, fetch_shared_file, update_peers
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+KEY = '0123456789abcdef-ref.fa'
+DATA = b''.join(b'>chr%d\nACGT\n' % i for i in range(5000))
+
+
+@pytest.fixture
+def nodes(tmpdir):
+    servers = []
+    for name in ['node1', 'node2']:
+        server = PeerCacheServer(str(tmpdir.mkdir(name)), 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    with open(os.path.join(servers[0].root, KEY), 'wb') as f_out:
+        f_out.write(DATA)
+    yield [(server.root, 'http://127.0.0.1:{}/'.format(server.server_address[1])) for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def request(url, byte_range=None):
+    headers = {'Range': 'bytes={}'.format(byte_range)} if byte_range else {}
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as error:
+        return error.code, error.headers, b''
+    return response.getcode(), response.headers, response.read()
+
+
+def test_hit(nodes, local_job, tmpdir, monkeypatch):
+    # Small parts, so that the file is fetched as concurrent byte ranges
+    monkeypatch.setattr(transfer, 'DOWNLOAD_PART_SIZE', 4096)
+    (_, node1), (root2, node2) = nodes
+    peers_id = local_job.fileStore.getEmptyFileStoreID()
+    update_peers(local_job, peers_id, KEY, node1, 'ready')
+    path = os.path.join(root2, KEY + '.part')
+    assert fetch_shared_file(local_job, str(tmpdir), None, peers_id, KEY, path, node2) == 'peer'
+    with open(path, 'rb') as f_in:
+        assert f_in.read() == DATA
+
+
+def test_miss(nodes, local_job, tmpdir, monkeypatch):
+    monkeypatch.setattr(peer_cache, 'PEER_CACHE_POLL', 0)
+    (root1, node1), (root2, node2) = nodes
+    assert request(node1 + '0123456789abcdef-dbsnp.vcf')[0] == 404
+    # node1 is listed as ready but no longer has the file, so node2 reads it from the job store
+    os.remove(os.path.join(root1, KEY))
+    source = str(tmpdir.join('ref.fa'))
+    with open(source, 'wb') as f_out:
+        f_out.write(DATA)
+    file_id = local_job.fileStore.writeGlobalFile(source)
+    peers_id = local_job.fileStore.getEmptyFileStoreID()
+    update_peers(local_job, peers_id, KEY, node1, 'ready')
+    path = os.path.join(root2, KEY + '.part')
+    assert fetch_shared_file(local_job, str(tmpdir.mkdir('work')), file_id, peers_id, KEY, path, node2) == 'jobstore'
+    with open(path, 'rb') as f_in:
+        assert f_in.read() == DATA
+    assert local_job.fileStore.messages == ['Peer {} failed to serve {}'.format(node1, KEY)]
+    assert json.loads(open(os.path.join(local_job.fileStore.root, peers_id)).read())[KEY]['ready'] == [node1]
+
+
+def test_range(nodes):
+    (_, node1), _ = nodes
+    size = len(DATA)
+    status, headers, body = request(node1 + KEY, '10-19')
+    assert (status, headers['Content-Range'], body) == (206, 'bytes 10-19/{}'.format(size), DATA[10:20])
+    status, headers, body = request(node1 + KEY, '{}-'.format(size - 5))
+    assert (status, body) == (206, DATA[-5:])
+    for byte_range in ['{}-'.format(size), '{}-'.format(size + 100), '20-10']:
+        status, headers, _ = request(node1 + KEY, byte_range)
+        assert (status, headers['Content-Range']) == (416, 'bytes */{}'.format(size))
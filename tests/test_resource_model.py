@@ -0,0 +1,42 @@
+from pipeline_lib import resource_model
+from pipeline_lib.resource_model import plan_cohort
+
+GIB = 1024 ** 3
+CONFIG_FILES = [('sample.baf', False), ('control.bam', True), ('tumor.bam', True)]
+SIZES = {'https://host/white.bed': GIB, 'https://host/s1.baf': GIB, 'https://host/s1.control.bam': 10 * GIB,
+         'https://host/s1.tumor.bam': 20 * GIB, 'https://host/s2.baf': GIB, 'https://host/s2.control.bam': 0,
+         'https://host/s2.tumor.bam': 5 * GIB}
+
+
+def estimate(input_args, file_sizes, shared_bytes):
+    return sum(file_sizes) / float(GIB) * 3600, max(file_sizes[1:]) + shared_bytes
+
+
+def test_plan_cohort(tmpdir, monkeypatch, capsys):
+    encrypted = []
+
+    def url_size(url, key_path=None):
+        if key_path:
+            encrypted.append(url)
+        return SIZES[url]
+
+    monkeypatch.setattr(resource_model, 'url_size', url_size)
+    monkeypatch.setattr(resource_model, 'PLAN_DOWNLOAD_RATE', GIB)
+    config = tmpdir.join('config.csv')
+    config.write('s1,https://host/s1.baf,https://host/s1.control.bam,https://host/s1.tumor.bam\n\n'
+                 's2,https://host/s2.baf,https://host/s2.control.bam,https://host/s2.tumor.bam\n'
+                 's3,https://host/s3.baf\n')
+    input_args = {'config': str(config), 'white.bed': 'https://host/white.bed', 'ssec': 'master.key'}
+    plan_cohort(input_args, CONFIG_FILES, ['white.bed'], estimate, 'bedtools_coverage', [1, 2], 30 * GIB)
+    assert sorted(encrypted) == sorted(url for url in SIZES if url.endswith('.bam'))
+    assert capsys.readouterr()[0].splitlines() == [
+        'Plan for 2 samples in {}'.format(config),
+        '  Transfer: 38.0 GiB (1.0 GiB shared files)',
+        '  Peak job disk: 42.0 GiB (bedtools_coverage of s1)',
+        # The shared files (1 s), then s1 (20 s + 31 h) and s2 (5 s + 6 h)
+        '  Makespan on 1 node(s): 37.0 h',
+        '  Makespan on 2 node(s): 31.0 h',
+        '  Samples over 30 GiB of node disk: s1',
+        '  Samples with inputs that could not be sized (counted as 0 bytes): s2',
+        '  Rows left out of the plan:',
+        '    line 4 (s3): expected a UUID and 3 URLs (sample.baf, control.bam, tumor.bam), found 2 fields']
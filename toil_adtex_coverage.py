@@ -17,16 +17,18 @@ S3AM*   -   pip install --pre S3AM  (optional)
 Curl    -   apt-get install curl
 """
 import argparse
-import base64
 from collections import OrderedDict
-import hashlib
 import os
 import tarfile
 import subprocess
 import multiprocessing
 import shutil
+import socket
 import sys
 from toil.job import Job
+from pipeline_lib.metrics import collect_metrics, profiled, run_instrumented
+from pipeline_lib.transfer import (download_batch, download_concurrently, encryption_headers, generate_unique_key,
+                                   hedged_download)
 
 
 def build_parser():
@@ -41,22 +43,6 @@ def build_parser():
 
 
 # Convenience Functions
-def generate_unique_key(master_key_path, url):
-    """
-    Input1: Path to the BD2K Master Key (for S3 Encryption)
-    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
-
-    Returns: 32-byte unique key generated for that URL
-    """
-    with open(master_key_path, 'r') as f:
-        master_key = f.read()
-    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
-                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
-    new_key = hashlib.sha256(master_key + url).digest()
-    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
-    return new_key
-
-
 def download_encrypted_file(work_dir, url, key_path, name):
     """
     Downloads encrypted file from S3
@@ -67,55 +53,8 @@ def download_encrypted_file(work_dir, url, key_path, name):
     Input4: name of file to be downloaded
     """
     file_path = os.path.join(work_dir, name)
-    key = generate_unique_key(key_path, url)
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
-    assert os.path.exists(file_path)
-
-def download_S3_file(work_dir, url, name):
-    """
-    Downloads file from S3
-
-    Input1: Working directory
-    Input2: S3 URL to be downloaded
-    Input3: name of file to be downloaded
-    """
-    file_path = os.path.join(work_dir, name)
-    # curl fs means fail quietly but show error when failing (not clear how that works)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
-    assert os.path.exists(file_path)
-
-
-def download_from_url(job, input_args, ids, name):
-    """
-    Downloads a file from a URL and places it in the jobStore
-
-    Input1: Toil job instance
-    Input2: Input arguments
-    Input3: jobstore id dictionary
-    Input4: Name of key used to access url in input_args
-    """
-    work_dir = job.fileStore.getLocalTempDir()
-    file_path = os.path.join(work_dir, name)
-    url = input_args[name]
-    if not os.path.exists(file_path):
-        try:
-            subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-        except OSError:
-            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    hedged_download(url, file_path, encryption_headers(key_path, url))
     assert os.path.exists(file_path)
-    job.fileStore.updateGlobalFile(ids[name], file_path)
-
 
 def return_input_paths(job, work_dir, ids, *args):
     """
@@ -164,9 +103,7 @@ def batch_start(job, input_args):
     """
     input_args['cpu_count'] = multiprocessing.cpu_count()
     shared_files = ['white.bed']
-    shared_ids = {x: job.fileStore.getEmptyFileStoreID() for x in shared_files}
-    for fname in shared_files:
-        job.addChildJobFn(download_from_url, input_args, shared_ids, fname)
+    shared_ids = job.addChildJobFn(download_batch, {x: input_args[x] for x in shared_files}).rv()
     job.addFollowOnJobFn(spawn_batch_jobs, shared_ids, input_args)
 
 
@@ -181,10 +118,11 @@ def spawn_batch_jobs(job, shared_ids, input_args):
         for line in f_in:
             uuid, c_url, t_url = line.strip().split(',')
             samples.append((uuid, c_url, t_url))
-    for sample in samples:
-        job.addChildJobFn(adtex, shared_ids, input_args, sample, cores=cores)
+    metrics = [job.addChildJobFn(adtex, shared_ids, input_args, sample, cores=cores).rv() for sample in samples]
+    job.addFollowOnJobFn(collect_metrics, input_args, metrics)
 
 
+@profiled('adtex')
 def adtex(job, ids, input_args, sample):
     """
     Runs adtex on the input bams for this sample
@@ -195,6 +133,7 @@ def adtex(job, ids, input_args, sample):
     Input4: Sample UUID and urls
     """
     uuid, c_url, t_url = sample
+    job.profile.uuid = uuid
 #    ids['log'] = job.fileStore.getEmptyFileStoreID()
     ids['tgz'] = job.fileStore.getEmptyFileStoreID()
     work_dir = job.fileStore.getLocalTempDir()
@@ -203,15 +142,18 @@ def adtex(job, ids, input_args, sample):
     cores = input_args['cpu_count']
 
     # I/O
-    return_input_paths(job, work_dir, ids, 'white.bed') 
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, 'white.bed')]):
+        return_input_paths(job, work_dir, ids, 'white.bed')
 
     # adtex output dir
     outdir = "adtex_out"
     #os.mkdir(os.path.join(work_dir, outdir))
 
     # Get bams associated with this sample
-    download_encrypted_file(work_dir, c_url, key_path, uuid + ".control.coverage")
-    download_encrypted_file(work_dir, t_url, key_path, uuid + ".tumor.coverage")
+    coverages = [uuid + ".control.coverage", uuid + ".tumor.coverage"]
+    with job.profile.phase('download', [os.path.join(work_dir, name) for name in coverages]):
+        download_concurrently([(download_encrypted_file, (work_dir, c_url, key_path, coverages[0])),
+                               (download_encrypted_file, (work_dir, t_url, key_path, coverages[1]))])
 
     # Setup docker base and adtex command
     docker_cmd = ['docker', 'run', '--rm', '-v', '{}:/data'.format(work_dir)]
@@ -231,7 +173,10 @@ def adtex(job, ids, input_args, sample):
                 "-p", "--DOC"]
 
     # log docker command output to stdout (this isn't helping)
-    subprocess.check_output(docker_cmd + adtex_command)
+    with job.profile.phase('compute', [os.path.join(work_dir, outdir)]):
+        record = run_instrumented(docker_cmd + adtex_command)
+    job.profile.records.append(dict(record, kind='tool', uuid=uuid, stage='adtex', image=adtex_command[0],
+                                    host=socket.gethostname()))
 #    subprocess.check_output([docker_cmd + adtex_command], stderr=subprocess.STDOUT, shell=True)
 #    # Piping the log output to a file handle
 #    # check_call blocks progress until finished
@@ -242,9 +187,11 @@ def adtex(job, ids, input_args, sample):
     # Save in JobStore
 #    job.fileStore.updateGlobalFile(ids['log'], os.path.join(work_dir, outfile))
     outtar = os.path.join(work_dir, uuid + '.tgz')
-    make_tarfile(outtar, (os.path.join(work_dir, outdir)))
+    with job.profile.phase('package', [outtar]):
+        make_tarfile(outtar, (os.path.join(work_dir, outdir)))
     # Save in JobStore
-    job.fileStore.updateGlobalFile(ids['tgz'], outtar)
+    with job.profile.phase('store', [outtar]):
+        job.fileStore.updateGlobalFile(ids['tgz'], outtar)
 
     # Move file in output_dir 
 #    if input_args['output_dir']:
@@ -252,12 +199,14 @@ def adtex(job, ids, input_args, sample):
 
     # Copy tarfile to S3
     if input_args['s3_dir']:
-        job.addChildJobFn(upload_file_to_s3, ids, input_args, sample[0], cores=cores)
+        return [job.addChildJobFn(upload_file_to_s3, ids, input_args, sample[0], cores=cores).rv()]
+    return []
 
 def make_tarfile(output_filename, source_dir):
     with tarfile.open(output_filename, "w:gz") as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
+@profiled('upload_file_to_s3')
 def upload_file_to_s3(job, ids, input_args, uuid):
     """
     Uploads output tarfile from sample to S3
@@ -267,6 +216,7 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     Input3: Input arguments dictionary
     Input4: Sample uuid
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     key_path = input_args['ssec']
     # Parse s3_dir to get bucket and s3 path
@@ -277,7 +227,8 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     outfile = uuid + '.tgz'
     url = os.path.join(base_url, bucket_name, bucket_dir, outfile)
     #I/O
-    job.fileStore.readGlobalFile(ids['tgz'], os.path.join(work_dir, outfile))
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, outfile)]):
+        job.fileStore.readGlobalFile(ids['tgz'], os.path.join(work_dir, outfile))
     # Generate keyfile for upload
     with open(os.path.join(work_dir, uuid + '.key'), 'wb') as f_out:
         f_out.write(generate_unique_key(key_path, url))
@@ -289,7 +240,8 @@ def upload_file_to_s3(job, ids, input_args, uuid):
                     bucket_name,
                     os.path.join(bucket_dir, outfile)]
 
-    subprocess.check_call(s3am_command)
+    with job.profile.phase('upload', [os.path.join(work_dir, outfile)]):
+        subprocess.check_call(s3am_command)
 
 
 if __name__ == "__main__":
@@ -7,7 +7,7 @@ Runs adtex on input coverage and baf files.
      0 --> 1 --> 2 --> 3 --> 4
 
 0 = Start Node
-1 = Download whitelist bed file
+1 = Download and prepare whitelist bed file
 2 = Download bam and baf files
 3 = Create coverage files
 4 = Run Adtex
@@ -19,17 +19,54 @@ Docker  -   apt-get install docker.io
 Toil    -   pip install toil
 S3AM*   -   pip install --pre S3AM  (optional)
 Curl    -   apt-get install curl
+NumPy*  -   pip install numpy  (optional, for --coverage_engine numpy)
 """
 import argparse
-import base64
 from collections import OrderedDict
-import hashlib
+import math
 import os
 import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import shutil
+import socket
 import sys
+import tarfile
+import tempfile
+import zlib
 from toil.job import Job
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by the native coverage engine (--coverage_engine numpy)
+    np = None
+from pipeline_lib.bam import fetch_targeted_bam
+from pipeline_lib.config import preflight_config, read_config
+from pipeline_lib.containers import container_limits, docker_call, pinned, prepull_images
+from pipeline_lib.coverage import IntervalIndex, expand_depth_npz, native_coverage, read_bed_rows
+from pipeline_lib.filestore import claim_race, release_files, start_race, watch_race, write_state
+from pipeline_lib.metrics import Superseded, collect_metrics, profiled, split_outputs
+from pipeline_lib.resource_model import (load_resource_model, model_fits, model_requirements, plan_cohort,
+                                         plan_runtime)
+from pipeline_lib.targets import prepare_targets, read_fai
+from pipeline_lib.transfer import (download_batch, encryption_headers, hedged_download, parse_rate, sample_sizes,
+                                   transfer_rate, transfer_slot, url_size)
+
+# Docker images used by the pipeline
+TOOL_IMAGES = ['jvivian/bedtools', 'jeltje/adtex']
+# Hung-tool watchdog: defaults of --stall_timeout, --max_runtime and --max_runtime_per_gb
+STALL_TIMEOUT = 1800
+MAX_RUNTIME = 4 * 3600
+MAX_RUNTIME_PER_GIB = 1800
+# Files of a config row, after its UUID, and whether each is SSE-C encrypted
+CONFIG_FILES = [('sample.baf', False), ('control.bam', True), ('tumor.bam', True)]
+# Intermediates stored compressed in the FileStore: zlib level, and uncompressed bytes per gzip member (each
+# member is compressed by its own thread)
+COMPRESS_LEVEL = 1
+COMPRESS_CHUNK = 8 * 1024 ** 2
+# Throughput of each tool in bytes/sec (per byte of the sample's inputs), used by --plan and --speculate without a
+# resource model
+PLAN_TOOL_RATES = {'jvivian/bedtools': 50 * 1024 ** 2, 'numpy': 200 * 1024 ** 2, 'jeltje/adtex': 200 * 1024 ** 2}
 
 
 def build_parser():
@@ -37,77 +74,220 @@ def build_parser():
     parser.add_argument('-c', '--config', default=None, help='configuration file with ID and URLs to bam inputs (control, tumor): uuid,url,url,...')
     parser.add_argument('-s', '--ssec', default=None, help='Path to Key File for SSE-C Encryption')
     parser.add_argument('-w', '--white', required=True, help='exome whitelist (bed format)')
+    parser.add_argument('-f', '--fai', default=None, help='Reference fasta index (fai): whitelist chromosome names are '
+                                                          'matched to it (chr / no chr) and targets sorted in its order')
     parser.add_argument('-o', '--out', default=None, help='full path where final results will be output')
     parser.add_argument('-3', '--s3_dir', default=None, help='S3 Directory, starting with bucket name. e.g.: '
                                                              'cgl-driver-projects/ckcc/rna-seq-samples/')
     parser.add_argument('-u', '--sudo', dest='sudo', action='store_true', default=False, help='Docker usually needs sudo to execute '
                                                                                'locally, but not''when running Mesos '
                                                                                'or when a member of a Docker group.')
+    parser.add_argument('--limit_containers', action='store_true', default=False,
+                        help="Enforce each job's Toil cores/memory on its containers (--cpus/--memory); "
+                             "set --defaultMemory to suit the tools")
+    parser.add_argument('--pin_cpus', action='store_true', default=False,
+                        help='With --limit_containers, also pin each container to its own set of CPUs')
+    parser.add_argument('--persistent_containers', action='store_true', default=False,
+                        help='Run tools in one long-lived container per image per node (docker exec) instead of a '
+                             'new container per call')
+    parser.add_argument('--stall_timeout', type=int, default=STALL_TIMEOUT,
+                        help='Kill a tool container that has written no output and used no CPU for this many '
+                             'seconds (0: never)')
+    parser.add_argument('--max_runtime', type=int, default=MAX_RUNTIME,
+                        help='Kill a tool container that has run for this many seconds plus --max_runtime_per_gb '
+                             'per GiB of its inputs (0: never)')
+    parser.add_argument('--max_runtime_per_gb', type=int, default=MAX_RUNTIME_PER_GIB,
+                        help='Seconds added to --max_runtime per GiB of input')
+    parser.add_argument('--prepull_nodes', type=int, default=1, help='Number of Docker image warm-up jobs; each '
+                                                                     'reserves a whole node so they land on '
+                                                                     'different workers')
+    parser.add_argument('--max_transfers', type=int, default=None, help='Maximum number of concurrent transfers per node, '
+                                                                        'shared by all Toil workers on that node')
+    parser.add_argument('--max_bandwidth', default=None, help='Aggregate download bandwidth per node, in bytes/sec with '
+                                                              'optional K/M/G suffix (e.g. 200M), split evenly over '
+                                                              '--max_transfers slots (4 if not given)')
+    parser.add_argument('--transfer_lock_dir', default='/tmp/toil_transfers', help='Node-local directory holding the '
+                                                                                   'transfer slot lock files')
+    parser.add_argument('--resource_model', default=None, help='Resource model learned from previous runs (local JSON '
+                                                               'file or path-style S3 URL): sets the requirements of '
+                                                               'bedtools_coverage and run_adtex from input size, and '
+                                                               'is updated by this run')
+    parser.add_argument('--targeted', action='store_true', default=False,
+                        help='Fetch only the parts of each bam overlapping the whitelist targets, via its .bai index '
+                             'and range requests (the whole bam is fetched if it has no index)')
+    parser.add_argument('--coverage_engine', choices=['bedtools', 'numpy'], default='bedtools',
+                        help='Compute coverage with bedtools in its container, or natively with NumPy over all of '
+                             "the job's cores (same output; NumPy must be installed on the workers)")
+    parser.add_argument('--coverage_format', choices=['text', 'npz'], default='text',
+                        help='With --coverage_engine numpy, store coverage as text or as NumPy arrays, which are '
+                             'smaller and turned back into text for ADTEx (not used with --fused)')
+    parser.add_argument('--fused', action='store_true', default=False,
+                        help="Run each sample's downloads, both coverages and ADTEx in one job on one node, keeping "
+                             'bams and coverage on local disk instead of passing them through the job store')
+    parser.add_argument('--speculate', type=float, default=None, metavar='FACTOR',
+                        help="Launch a duplicate of a sample's run_adtex job once it has run FACTOR times longer "
+                             'than predicted for its input size (by the resource model, or the tool throughput); '
+                             'the first to finish is kept and the other cancelled')
+    parser.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='Only check the shape of the config rows before launch, not that every URL (and its '
+                             'SSE-C key) can be downloaded')
+    parser.add_argument('--plan', action='store_true', default=False, help='Only estimate the run: bytes to transfer, '
+                                                                           'peak job disk and makespan, then exit')
+    parser.add_argument('--plan_nodes', type=int, nargs='+', default=[1, 8, 32], help='Cluster sizes (nodes) to '
+                                                                                      'estimate the makespan for')
+    parser.add_argument('--node_disk', default=None, help='With --plan, disk per node in bytes with optional K/M/G '
+                                                          'suffix (e.g. 500G), to list samples that will not fit')
     return parser
 
 
 # Convenience Functions
-def generate_unique_key(master_key_path, url):
-    """
-    Input1: Path to the BD2K Master Key (for S3 Encryption)
-    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
-
-    Returns: 32-byte unique key generated for that URL
-    """
-    with open(master_key_path, 'r') as f:
-        master_key = f.read()
-    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
-                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
-    new_key = hashlib.sha256(master_key + url).digest()
-    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
-    return new_key
-
-def download_encrypted_file(job, url, key_path):
+@profiled('download', output=True)
+def download_encrypted_file(job, url, key_path, governor=None, uuid=None):
     """
     Downloads encrypted files from S3 via header injection
 
     url: str        URL to be downloaded
     key_path: str   Path to the master key needed to derive unique encryption keys per file
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+    uuid: str       Sample the file belongs to, for the metrics
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     file_path = os.path.join(work_dir, os.path.basename(url))
+    with transfer_slot(governor):
+        with job.profile.phase('download', [file_path]):
+            hedged_download(url, file_path, encryption_headers(key_path, url), transfer_rate(governor))
+    assert os.path.exists(file_path)
+    with job.profile.phase('store'):
+        file_id = job.fileStore.writeGlobalFile(file_path)
+    return file_id
 
-    with open(key_path, 'r') as f:
-        key = f.read()
-    if len(key) != 32:
-        raise RuntimeError('Invalid Key! Must be 32 bytes: {}'.format(key))
 
-    key = generate_unique_key(key_path, url)
+@profiled('download', output=True)
+def download_targeted_bam(job, url, key_path, white_id, governor=None, uuid=None):
+    """
+    Downloads only the parts of an encrypted bam that hold reads overlapping the whitelist targets (see
+    fetch_targeted_bam) and stores them in the FileStore as a smaller bam. Bams without an index are downloaded whole.
 
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    url: str        URL of the bam
+    key_path: str   Path to the master key needed to derive unique encryption keys per file
+    white_id: str   FileStoreID of the whitelist (bed)
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+    uuid: str       Sample the file belongs to, for the metrics
+    """
+    job.profile.uuid = uuid
+    work_dir = job.fileStore.getLocalTempDir()
+    file_path = os.path.join(work_dir, os.path.basename(url))
+    bed_path = job.fileStore.readGlobalFile(white_id, os.path.join(work_dir, 'white.bed'))
+    with transfer_slot(governor):
+        with job.profile.phase('download', [file_path]):
+            fetched = fetch_targeted_bam(url, lambda target: encryption_headers(key_path, target), bed_path, file_path,
+                                         transfer_rate(governor))
+            if fetched is None:
+                job.fileStore.logToMaster('No index found for {}, downloading all of it'.format(url))
+                hedged_download(url, file_path, encryption_headers(key_path, url), transfer_rate(governor))
+            else:
+                job.fileStore.logToMaster('Fetched {:.1f} MiB of {} for its targets'.format(fetched / 1024.0 ** 2, url))
     assert os.path.exists(file_path)
-    return job.fileStore.writeGlobalFile(file_path)
+    with job.profile.phase('store'):
+        file_id = job.fileStore.writeGlobalFile(file_path)
+    return file_id
 
 
-def download_from_url(job, url):
+@profiled('download', output=True)
+def download_from_url(job, url, governor=None, uuid=None):
     """
     Downloads a URL that was supplied as an argument to running this script in LocalTempDir.
     After downloading the file, it is stored in the FileStore.
 
     url: str        URL to be downloaded. filename is derived from URL
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+    uuid: str       Sample the file belongs to, for the metrics
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     file_path = os.path.join(work_dir, os.path.basename(url))
     if not os.path.exists(file_path):
-        try:
-            subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-        except OSError:
-            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        with transfer_slot(governor):
+            with job.profile.phase('download', [file_path]):
+                hedged_download(url, file_path, rate=transfer_rate(governor))
     assert os.path.exists(file_path)
-    return job.fileStore.writeGlobalFile(file_path)
+    with job.profile.phase('store'):
+        file_id = job.fileStore.writeGlobalFile(file_path)
+    return file_id
+
+
+def compress_file(in_path, out_path, threads=1):
+    """
+    Compresses a file to gzip, COMPRESS_CHUNK bytes per gzip member. Members are compressed by a pool of threads
+    (zlib releases the GIL) and written in order, which makes a standard multi-member gzip file.
+
+    in_path: str            File to compress
+    out_path: str           Path of the gzip file
+    threads: int            Number of compressing threads
+    """
+    def compress(data):
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    pool = ThreadPool(max(1, threads))
+    try:
+        with open(in_path, 'rb') as f_in, open(out_path, 'wb') as f_out:
+            while True:
+                # A few chunks per thread at a time keeps memory bounded
+                chunks = [f_in.read(COMPRESS_CHUNK) for _ in range(2 * max(1, threads))]
+                chunks = [chunk for chunk in chunks if chunk]
+                if not chunks:
+                    break
+                for member in pool.map(compress, chunks):
+                    f_out.write(member)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def decompress_file(in_path, out_path):
+    """
+    Decompresses a (multi-member) gzip file, streaming
+    """
+    with open(in_path, 'rb') as f_in, open(out_path, 'wb') as f_out:
+        decompressor = zlib.decompressobj(31)
+        while True:
+            data = f_in.read(COMPRESS_CHUNK)
+            if not data:
+                break
+            while data:
+                f_out.write(decompressor.decompress(data))
+                # Data after the end of a member starts the next one
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(31)
+        f_out.write(decompressor.flush())
+
+
+def write_compressed_file(job, file_path, threads=1):
+    """
+    Writes a file to the FileStore gzip-compressed (see compress_file); read it back with read_compressed_file
+
+    file_path: str          File to store
+    threads: int            Number of compressing threads
+
+    Returns: FileStoreID of the compressed file
+    """
+    compressed_path = file_path + '.gz'
+    compress_file(file_path, compressed_path, threads)
+    return job.fileStore.writeGlobalFile(compressed_path)
+
+
+def read_compressed_file(job, file_id, file_path):
+    """
+    Reads a file stored with write_compressed_file from the FileStore and decompresses it to file_path
+
+    Returns: file_path
+    """
+    compressed_path = job.fileStore.readGlobalFile(file_id, file_path + '.gz')
+    decompress_file(compressed_path, file_path)
+    return file_path
 
 
 def return_input_paths(job, work_dir, ids, *args):
@@ -142,200 +322,519 @@ def download_shared_files(job, input_args):
 
     input_args: dict        Input arguments (passed from main())
     """
-    shared_files = ['white.bed']
-    shared_ids = {}
-    for fname in shared_files:
-        url = input_args[fname]
-        shared_ids[fname] = job.addChildJobFn(download_from_url, url).rv()
-    job.addFollowOnJobFn(parse_config, shared_ids, input_args)
+    shared_files = ['white.bed'] + (['ref.fa.fai'] if input_args['ref.fa.fai'] else [])
+    urls = {fname: input_args[fname] for fname in shared_files}
+    shared_ids = job.addChildJobFn(download_batch, urls, input_args['governor']).rv()
+    # Warm-up jobs ask for a whole node's cores so the scheduler spreads them over different workers
+    images = [job.addChildJobFn(prepull_images, TOOL_IMAGES, input_args['sudo'], cores=multiprocessing.cpu_count()).rv()
+              for _ in range(input_args['prepull_nodes'])]
+    prepared = job.addFollowOnJobFn(prepare_whitelist, shared_ids)
+    prepared.addFollowOnJobFn(parse_config, prepared.rv(), input_args, images)
+
+def prepare_whitelist(job, shared_ids):
+    """
+    Prepares the whitelist once for all samples: names matched to the reference, targets sorted and merged (see
+    prepare_targets), and an interval index of them stored as well when NumPy is installed
 
-def parse_config(job, shared_ids, input_args):
+    shared_ids: dict        Dictionary of fileStore IDs for the shared files
+
+    Returns: shared_ids with the prepared whitelist (and 'white.npz', the index)
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    bed_path = return_input_paths(job, work_dir, shared_ids, 'white.bed')
+    contigs = read_fai(return_input_paths(job, work_dir, shared_ids, 'ref.fa.fai')) if 'ref.fa.fai' in shared_ids else []
+    targets = prepare_targets(bed_path, contigs)
+    prepared_path = os.path.join(work_dir, 'white.prepared.bed')
+    with open(prepared_path, 'w') as f_out:
+        for chromosome, start, end in targets:
+            f_out.write('{}\t{}\t{}\n'.format(chromosome, start, end))
+    job.fileStore.logToMaster('Prepared whitelist: {} targets over {} bases'.format(
+        len(targets), sum(end - start for _, start, end in targets)))
+    shared_ids = dict(shared_ids, **{'white.bed': job.fileStore.writeGlobalFile(prepared_path)})
+    if np is not None:
+        index_path = os.path.join(work_dir, 'white.npz')
+        IntervalIndex(targets).save(index_path)
+        shared_ids['white.npz'] = job.fileStore.writeGlobalFile(index_path)
+    return shared_ids
+
+def parse_config(job, shared_ids, input_args, images):
     """
     Stores the UUID and urls associated with the input files to be retrieved.
     Configuration file has one sample per line, with the following format:  UUID,1st_url,2nd_url
 
+    Before any sample is launched the config is checked (see read_config and preflight_config) and the run fails
+    with a report of every bad row. The size and ETag of each input are written to preflight.tsv, which is copied
+    to output_dir, and the sizes are used to size the samples' jobs.
+
     shared_ids: dict        Dictionary of fileStore IDs for the shared files downloaded in the previous step
     input_args: dict        Input argumentts
+    images: list            Digest-pinned image references returned by the warm-up jobs
     """
-    samples = []
     config = input_args['config']
-    with open(config, 'r') as f_in:
-        for line in f_in:
-            line = line.strip().split(',')
-            uuid = line[0]
-            # there are three urls: one baf file and two bam files
-            urls = line[1:]
-            samples.append((uuid, urls))
+    rows, problems = read_config(config, CONFIG_FILES)
+    checks = []
+    if not input_args['skip_preflight']:
+        checks, bad_urls = preflight_config(rows, CONFIG_FILES, input_args['ssec'])
+        problems += bad_urls
+        work_dir = job.fileStore.getLocalTempDir()
+        report_path = os.path.join(work_dir, 'preflight.tsv')
+        with open(report_path, 'w') as f_out:
+            f_out.write('\t'.join(['line', 'uuid', 'file', 'url', 'status', 'bytes', 'etag']) + '\n')
+            for check in checks:
+                f_out.write('\t'.join('' if value is None else str(value) for value in check) + '\n')
+        save_output(input_args, report_path)
+        job.fileStore.logToMaster('Preflight: checked {} URLs of {} samples in {:.1f} GiB'.format(
+            len(checks), len(rows), sum(check[5] or 0 for check in checks) / 1024.0 ** 3))
+    if problems:
+        bad_rows = len(set(number for number, _, _ in problems))
+        raise RuntimeError('Preflight found problems in {} row(s) of {}:\n{}'.format(bad_rows, config, '\n'.join(
+            '  line {} ({}): {}'.format(number, uuid or '-', message) for number, uuid, message in sorted(problems))))
+    samples = [(uuid, urls) for _, uuid, urls in rows]
     input_args['cpu_count'] = multiprocessing.cpu_count()
+    input_args['images'] = images[0] if images else {}
     job_vars = (input_args, shared_ids)
-    for sample in samples:
-        job.addChildJobFn(download_inputs, job_vars, sample, cores=input_args['cpu_count'])
+    # Each sample returns the FileStoreIDs of its jobs' metrics
+    metrics = []
+    if checks:
+        sizes = {}
+        for _, uuid, _, _, _, size, _ in checks:
+            sizes[uuid] = sizes.get(uuid, 0) + (size or 0)
+        sizes = [sizes[uuid] for uuid, _ in samples]
+    elif input_args['resource_model'] or input_args['speculate']:
+        # The baf is public; the bams are encrypted
+        sizes = sample_sizes(samples, lambda sample: url_size(sample[1][0]) + sum(url_size(url, input_args['ssec'])
+                                                                                 for url in sample[1][1:]))
+    else:
+        sizes = [None] * len(samples)
+    for sample, input_bytes in zip(samples, sizes):
+        if input_args['fused']:
+            image = 'numpy' if input_args['coverage_engine'] == 'numpy' else pinned(input_args, 'jvivian/bedtools')
+            requirements = model_requirements(input_args, 'fused_sample', input_bytes, image,
+                                              cores=input_args['cpu_count'])
+            metrics.append(job.addChildJobFn(fused_sample, job_vars, sample, **requirements).rv())
+            continue
+        metrics.append(job.addChildJobFn(download_inputs, job_vars, sample, input_bytes,
+                                         cores=input_args['cpu_count']).rv())
         #job.addChildJobFn(download_inputs, job_vars, sample, cores=input_args['cpu_count'], memory='20 G', disk='100 G')
+    job.addFollowOnJobFn(collect_metrics, input_args, metrics)
+
+@profiled('fused_sample')
+def fused_sample(job, job_vars, sample):
+    """
+    Runs a sample's whole chain in one job (--fused): downloads, both coverages and ADTEx, with only the tarball
+    leaving the node
+
+    job_vars: tuple         Contains the dictionaries: input_args and ids
+    sample: tuple           Contains the uuid (str) and urls (baf, control bam, tumor bam)
 
-def download_inputs(job, job_vars, sample):
+    Returns: list of the sample's metrics
+    """
+    input_args, ids = job_vars
+    uuid, urls = sample
+    input_args['uuid'] = uuid
+    job.profile.uuid = uuid
+    work_dir = job.fileStore.getLocalTempDir()
+    governor = input_args['governor']
+    key_path = input_args['ssec']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, 'white.bed')]):
+        bed_path = return_input_paths(job, work_dir, ids, 'white.bed')
+    inputs = OrderedDict([('sample.baf', urls[0]), ('control.bam', urls[1]), ('tumor.bam', urls[2])])
+
+    def fetch(name):
+        file_path = os.path.join(work_dir, name)
+        with transfer_slot(governor):
+            if name == 'sample.baf':
+                hedged_download(inputs[name], file_path, rate=transfer_rate(governor))
+            elif not (input_args['targeted'] and fetch_targeted_bam(
+                    inputs[name], lambda target: encryption_headers(key_path, target), bed_path, file_path,
+                    transfer_rate(governor))):
+                hedged_download(inputs[name], file_path, encryption_headers(key_path, inputs[name]),
+                                transfer_rate(governor))
+        assert os.path.exists(file_path)
+
+    def coverage(name):
+        return coverage_call(job, input_args, ids, work_dir, name + '.bam', os.path.join(work_dir, name + '.cov'),
+                             int(math.ceil(job.cores)))
+
+    pool = ThreadPool(len(inputs))
+    try:
+        with job.profile.phase('download', [os.path.join(work_dir, name) for name in inputs]):
+            # map() re-raises the first download failure once all downloads have finished
+            pool.map(fetch, list(inputs))
+        with job.profile.phase('compute', [os.path.join(work_dir, name) for name in ['control.cov', 'tumor.cov']]):
+            if input_args['coverage_engine'] == 'numpy':
+                # The native engine already uses all the cores, and its process pools are not forked from threads
+                job.profile.records.extend(coverage(name) for name in ['control', 'tumor'])
+            else:
+                job.profile.records.extend(pool.map(coverage, ['control', 'tumor']))
+    finally:
+        pool.close()
+        pool.join()
+    adtexOut = uuid + '.adtex_out'
+    with job.profile.phase('compute', [os.path.join(work_dir, adtexOut)]):
+        job.profile.records.append(adtex_call(job, input_args, work_dir))
+    outtar = os.path.join(work_dir, uuid + '.adtex.tgz')
+    with job.profile.phase('package', [outtar]):
+        make_tarfile(outtar, (os.path.join(work_dir, adtexOut)))
+    save_output(input_args, outtar)
+    if input_args['s3_dir']:
+        with transfer_slot(governor):
+            with job.profile.phase('upload', [outtar]):
+                s3am_upload(input_args, outtar)
+
+
+@profiled('download_inputs')
+def download_inputs(job, job_vars, sample, input_bytes=None):
     """
     Downloads the sample inputs (bam and baf files)
 
     job_vars: tuple         Contains the dictionaries: input_args and ids
     sample: tuple           Contains the uuid (str) and urls (list of strings)
+    input_bytes: int        Total size of the inputs, used to size the sample's jobs with the resource model
     """
     input_args, ids = job_vars
     uuid, urls = sample
     input_args['uuid'] = uuid
-    ids['sample.baf']  = job.addChildJobFn(download_from_url, urls[0]).rv()
+    input_args['input_bytes'] = input_bytes
+    job.profile.uuid = uuid
+    governor = input_args['governor']
+    ids['sample.baf']  = job.addChildJobFn(download_from_url, urls[0], governor, uuid).rv()
     key_path = input_args['ssec']
-    ids['control.bam'] = job.addChildJobFn(download_encrypted_file, urls[1], key_path).rv()
-    ids['tumor.bam']   = job.addChildJobFn(download_encrypted_file, urls[2], key_path).rv()
-    job.addFollowOnJobFn(bam_to_coverage, job_vars, cores=input_args['cpu_count'])
-
+    if input_args['targeted']:
+        white_id = ids['white.bed']
+        ids['control.bam'] = job.addChildJobFn(download_targeted_bam, urls[1], key_path, white_id, governor, uuid).rv()
+        ids['tumor.bam']   = job.addChildJobFn(download_targeted_bam, urls[2], key_path, white_id, governor, uuid).rv()
+    else:
+        ids['control.bam'] = job.addChildJobFn(download_encrypted_file, urls[1], key_path, governor, uuid).rv()
+        ids['tumor.bam']   = job.addChildJobFn(download_encrypted_file, urls[2], key_path, governor, uuid).rv()
+    return job.addFollowOnJobFn(bam_to_coverage, job_vars, cores=input_args['cpu_count']).rv()
+
+@profiled('bam_to_coverage')
 def bam_to_coverage(job, job_vars):
     """
     job_vars: tuple         Contains the dictionaries: input_args and ids
     """
     input_args, ids = job_vars
-    ids['control.cov'] = job.addChildJobFn(bedtools_coverage, 'control.bam', job_vars).rv()
-    ids['tumor.cov'] = job.addChildJobFn(bedtools_coverage, 'tumor.bam', job_vars).rv()
-    job.addFollowOnJobFn(run_adtex, job_vars, cores=input_args['cpu_count'])
-
-def bedtools_coverage(work_dir, bamfile, job_vars):
+    job.profile.uuid = input_args['uuid']
+    metrics = split_outputs(ids, 'sample.baf', 'control.bam', 'tumor.bam')
+    input_bytes = input_args['input_bytes']
+    if input_args['coverage_engine'] == 'numpy':
+        # The native engine uses every core it is given
+        requirements = model_requirements(input_args, 'bedtools_coverage', input_bytes, 'numpy',
+                                          cores=input_args['cpu_count'])
+    else:
+        requirements = model_requirements(input_args, 'bedtools_coverage', input_bytes,
+                                          pinned(input_args, 'jvivian/bedtools'), cores=1)
+    ids['control.cov'] = job.addChildJobFn(bedtools_coverage, 'control.bam', job_vars, **requirements).rv()
+    ids['tumor.cov'] = job.addChildJobFn(bedtools_coverage, 'tumor.bam', job_vars, **requirements).rv()
+    requirements = model_requirements(input_args, 'run_adtex', input_bytes, pinned(input_args, 'jeltje/adtex'),
+                                      cores=input_args['cpu_count'])
+    if input_args['speculate'] and input_bytes:
+        return metrics + [job.addFollowOnJobFn(speculate, job_vars, requirements).rv()]
+    if input_args['speculate']:
+        job.fileStore.logToMaster('run_adtex for {} is not speculated: its input size is unknown'.format(
+            input_args['uuid']))
+    return metrics + [job.addFollowOnJobFn(run_adtex, job_vars, **requirements).rv()]
+
+def coverage_call(job, input_args, ids, work_dir, bamfile, file_path, cores, binary=False):
     """
-    Runs bedtools coverage on input bam and returns coverage file
-    
+    Computes the per-base coverage of a bam in work_dir over the whitelist, with bedtools in its container or with
+    the native engine (--coverage_engine numpy)
+
+    input_args: dict        Input arguments
+    ids: dict               jobstore id dictionary (the whitelist must already be in work_dir)
+    bamfile: str            Name of the bam in work_dir
+    file_path: str          Path the coverage is written to
+    cores: int              Cores the native engine may use
+    binary: bool            Have the native engine write NumPy arrays instead of text
+
+    Returns: metrics record of the tool call
     """
+    tags = {'uuid': input_args['uuid'], 'stage': 'bedtools', 'input': bamfile}
+    if input_args['coverage_engine'] == 'numpy':
+        if 'white.npz' in ids:
+            index = IntervalIndex.load(return_input_paths(job, work_dir, ids, 'white.npz'))
+        else:
+            # The prepared whitelist is already sorted and merged
+            index = IntervalIndex([(fields[0], int(fields[1]), int(fields[2]))
+                                   for fields in read_bed_rows(os.path.join(work_dir, 'white.bed'))])
+        usage = native_coverage(os.path.join(work_dir, bamfile), index, file_path, cores, binary=binary)
+        return dict(tags, kind='tool', image='numpy', host=socket.gethostname(), **usage)
 #docker run --log-driver=none --rm -v /data/data/general:/data jvivian/bedtools coverage -abam $tumor -d -b $targets >  wcdt_T.cov
+    parameters = ['coverage',
+                  '-abam', '{}'.format(bamfile),
+                  '-d',
+                  '-b', 'white.bed']
+    with open(file_path, 'w') as f_out:
+        return docker_call(work_dir=work_dir, tool_parameters=parameters, tool=pinned(input_args, 'jvivian/bedtools'),
+                           outfile=f_out, sudo=input_args['sudo'], persistent_root=input_args['persistent_root'],
+                           tags=tags, outputs=[file_path], **container_limits(job, input_args))
+
+
+def adtex_call(job, input_args, work_dir):
+    """
+    Runs ADTEx (with zygosity output) on control.cov, tumor.cov, white.bed and sample.baf in work_dir, into the
+    directory <uuid>.adtex_out
+
+    Returns: metrics record of the tool call
+    """
+    adtexOut = input_args['uuid'] + '.adtex_out'
+    parameters = ['-n', 'control.cov',
+                '-t', 'tumor.cov',
+                '-b', 'white.bed',
+                '-o', '{}'.format(adtexOut),
+                '-p', '--estimatePloidy', 
+                '--baf', 'sample.baf' ]
+    return docker_call(work_dir=work_dir, tool_parameters=parameters, tool=pinned(input_args, 'jeltje/adtex'),
+                       sudo=input_args['sudo'], persistent_root=input_args['persistent_root'],
+                       tags={'uuid': input_args['uuid'], 'stage': 'adtex'},
+                       outputs=[os.path.join(work_dir, adtexOut)], **container_limits(job, input_args))
+
+
+@profiled('bedtools_coverage', output=True)
+def bedtools_coverage(job, bamfile, job_vars):
+    """
+    Runs bedtools coverage on input bam and returns coverage file. With --coverage_engine numpy the coverage is
+    computed natively instead (see native_coverage).
+
+    bamfile: str            Name of the bam in ids ('control.bam' or 'tumor.bam')
+    job_vars: tuple         Contains the dictionaries: input_args and ids
+
+    Returns: FileStoreID of the coverage file (paired with the job's metrics by @profiled)
+    """
     # Unpack variables
     input_args, ids = job_vars
+    job.profile.uuid = input_args['uuid']
     work_dir = job.fileStore.getLocalTempDir()
-    sudo = input_args['sudo']
     covfile = 'out.cov'
     file_path = os.path.join(work_dir, covfile)
     # Retrieve sample
-    return_input_paths(job, work_dir, ids, bamfile)
-    parameters = ['-abam', '{}'.format(bamfile),
-                  '-d',
-                  '-b', 'white.bed']
-    docker_call(work_dir=work_dir, tool_parameters=parameters,
-                tool='jvivian/bedtools', outfile=covfile, sudo=sudo)
-    return job.fileStore.writeGlobalFile(file_path)
-
-def run_adtex(job, job_vars):
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, bamfile), os.path.join(work_dir, 'white.bed')]):
+        return_input_paths(job, work_dir, ids, bamfile, 'white.bed')
+    with job.profile.phase('compute', [file_path]):
+        job.profile.records.append(coverage_call(job, input_args, ids, work_dir, bamfile, file_path,
+                                                 int(math.ceil(job.cores)),
+                                                 binary=input_args['coverage_format'] == 'npz'))
+    # Coverage is highly redundant text, so it goes to run_adtex compressed
+    with job.profile.phase('store', [file_path + '.gz']):
+        cov_id = write_compressed_file(job, file_path, int(math.ceil(job.cores)))
+    # bedtools_coverage is the bam's only consumer
+    release_files(job, ids, bamfile)
+    return cov_id
+
+@profiled('run_adtex')
+def run_adtex(job, job_vars, race=None):
     """
     This module runs the ADTEx variant caller including zygosity output. The output is a directory of files
     which should be tarred
 
     job_vars: tuple         Contains the dictionaries: input_args and ids
+    race: dict              With --speculate, the race of this attempt (see start_race)
+
+    Returns: list of the sample's metrics
     """
     # Unpack variables
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
-    sudo = input_args['sudo']
-    cores = input_args['cpu_count']
-    # Retrieve samples
-    return_input_paths(job, work_dir, ids, 'sample.baf', 'tumor.cov', 'control.cov')
-    # Retrieve input files
-    return_input_paths(job, work_dir, ids, 'white.bed')
+    uuid = input_args['uuid']
+    job.profile.uuid = uuid
+    # With --speculate, this is one of two attempts (see speculate), which took out the coverage metrics already;
+    # the tool is cancelled once the other attempt finishes (see container_limits)
+    if race:
+        input_args = dict(input_args, race=race)
+    if race and race['attempt'] == 0:
+        write_state(job, race['started'], '1')
+    metrics = split_outputs(ids, 'control.cov', 'tumor.cov') if not race else []
+    inputs = ['sample.baf', 'tumor.cov.gz', 'tumor.cov', 'control.cov.gz', 'control.cov', 'white.bed']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, name) for name in inputs]):
+        # Retrieve samples
+        return_input_paths(job, work_dir, ids, 'sample.baf')
+        for name in ['tumor.cov', 'control.cov']:
+            read_compressed_file(job, ids[name], os.path.join(work_dir, name))
+        # Retrieve input files
+        return_input_paths(job, work_dir, ids, 'white.bed')
+    if input_args['coverage_format'] == 'npz':
+        with job.profile.phase('decode', [os.path.join(work_dir, name) for name in ['tumor.cov', 'control.cov']]):
+            for name in ['tumor.cov', 'control.cov']:
+                expand_depth_npz(os.path.join(work_dir, name))
 
     # Call: Adtex
-    uuid = input_args['uuid']
     adtexOut = uuid + '.adtex_out'
-    parameters = ['-n', 'control.cov',
-                '-t', 'tumor.cov',
-                '-b', 'white.bed',
-                '-o', '{}'.format(adtexOut),
-                '-p', '--estimatePloidy', 
-                '--baf', 'sample.baf' ]
-    docker_call(work_dir=work_dir, tool_parameters=parameters,
-                tool='jeltje/adtex', sudo=sudo)
+    try:
+        with job.profile.phase('compute', [os.path.join(work_dir, adtexOut)]):
+            job.profile.records.append(adtex_call(job, input_args, work_dir))
+    except Superseded:
+        job.fileStore.logToMaster('run_adtex for {} was cancelled: the other attempt finished first'.format(uuid))
+        return metrics
+    if race and not claim_race(job, race):
+        job.fileStore.logToMaster('run_adtex for {} discards its output: the other attempt finished first'.format(uuid))
+        return metrics
     outtar = os.path.join(work_dir, uuid + '.adtex.tgz')
-    make_tarfile(outtar, (os.path.join(work_dir, adtexOut)))
+    with job.profile.phase('package', [outtar]):
+        make_tarfile(outtar, (os.path.join(work_dir, adtexOut)))
     # Write to FileStore
-    ids['tgz'] = job.fileStore.writeGlobalFile(outtar)
+    with job.profile.phase('store', [outtar]):
+        ids['tgz'] = job.fileStore.writeGlobalFile(outtar)
+    save_output(input_args, outtar)
+    # The baf and coverage are released here, or by finish_race once both attempts of a race are done
+    if not race:
+        release_files(job, ids, 'sample.baf', 'control.cov', 'tumor.cov')
 
     if input_args['s3_dir']:
-        job.addChildJobFn(upload_to_s3, job_vars, outtar)
+        metrics.append(job.addChildJobFn(upload_to_s3, job_vars, os.path.basename(outtar)).rv())
+    return metrics
 
 
-def docker_path(file_path):
-    """
-    Returns the path internal to the docker container (for standard reasons, this is always /data)
+def speculate(job, job_vars, requirements):
     """
-    return os.path.join('/data', os.path.basename(file_path))
+    Runs a sample's run_adtex with --speculate (see start_race), releasing its inputs once both attempts are done
 
+    job_vars: tuple         Contains the dictionaries: input_args and ids
+    requirements: dict      Toil requirements of run_adtex
 
-def docker_call(work_dir, tool_parameters, tool, java_opts=None, outfile=None, sudo=False):
+    Returns: list of the sample's metrics
     """
-    Makes subprocess call of a command to a docker container.
+    input_args, ids = job_vars
+    # Both attempts read the coverage, so its metrics are taken out here rather than by each of them
+    metrics = split_outputs(ids, 'control.cov', 'tumor.cov')
+    predicted = plan_runtime(input_args, 'run_adtex', 'jeltje/adtex', input_args['input_bytes'],
+                             PLAN_TOOL_RATES['jeltje/adtex'])
+    return metrics + start_race(job, run_adtex, watch_attempt, (job_vars,), requirements,
+                                input_args['speculate'] * predicted, ids, ('sample.baf', 'control.cov', 'tumor.cov'))
 
 
-    tool_parameters: list   An array of the parameters to be passed to the tool
-    tool: str               Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
-    java_opts: str          Optional commands to pass to a java jar execution. (e.g. '-Xmx15G')
-    outfile: file           Filehandle that stderr will be passed to
-    sudo: bool              If the user wants the docker command executed as sudo
+def watch_attempt(job, race, requirements, deadline, job_vars):
     """
-    base_docker_call = 'docker run --log-driver=none --rm -v {}:/data'.format(work_dir).split()
-    if sudo:
-        base_docker_call = ['sudo'] + base_docker_call
-    if java_opts:
-        base_docker_call = base_docker_call + ['-e', 'JAVA_OPTS={}'.format(java_opts)]
-    try:
-        if outfile:
-            subprocess.check_call(base_docker_call + [tool] + tool_parameters, stdout=outfile)
-        else:
-            subprocess.check_call(base_docker_call + [tool] + tool_parameters)
-    except subprocess.CalledProcessError:
-        raise RuntimeError('docker command returned a non-zero exit status. Check error logs.')
-    except OSError:
-        raise RuntimeError('docker not found on system. Install on all nodes.')
+    Watcher of a speculated run_adtex (see watch_race): returns the duplicate's metrics if it launches one
+    """
+    if watch_race(job, race, deadline, 'run_adtex for {}'.format(job_vars[0]['uuid'])):
+        return [job.addChildJobFn(run_adtex, job_vars, race=race, **requirements).rv()]
+    return []
+
 
 def make_tarfile(output_filename, source_dir):
     with tarfile.open(output_filename, "w:gz") as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
 
+@profiled('upload_to_s3')
 def upload_to_s3(job, job_vars, outfile):
     """
     Uploads a file to S3 via S3AM 
 
     job_vars: tuple         Contains the dictionaries: input_args and ids
+    outfile: str            Name the file (ids['tgz']) is uploaded under
     """
     # Unpack variables
     input_args, ids = job_vars
+    job.profile.uuid = input_args['uuid']
     #uuid = input_args['uuid']
-    key_path = input_args['ssec']
     work_dir = job.fileStore.getLocalTempDir()
+    # Retrieve file to be uploaded
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, outfile)]):
+        job.fileStore.readGlobalFile(ids['tgz'], os.path.join(work_dir, outfile))
+    with transfer_slot(input_args['governor']):
+        with job.profile.phase('upload', [os.path.join(work_dir, outfile)]):
+            s3am_upload(input_args, os.path.join(work_dir, outfile))
+    # The archive is the sample's result, so it is only released once uploaded
+    release_files(job, ids, 'tgz')
+
+
+def s3am_upload(input_args, file_path):
+    """
+    Uploads a local file into input_args['s3_dir'] via S3AM, under its own name
+
+    input_args: dict        Input arguments
+    file_path: str          Path of the file
+    """
     # Parse s3_dir to get bucket and s3 path
     s3_dir = input_args['s3_dir']
     bucket_name = s3_dir.lstrip('/').split('/')[0]
     bucket_dir = '/'.join(s3_dir.lstrip('/').split('/')[1:])
-    base_url = 'https://s3-us-west-2.amazonaws.com/'
-    url = os.path.join(base_url, bucket_name, bucket_dir, outfile)
-    # Retrieve file to be uploaded
-    job.fileStore.readGlobalFile(ids['tgz'], os.path.join(work_dir, outfile))
     # Upload to S3 via S3AM
     s3am_command = ['s3am',
                     'upload',
-                    'file://{}'.format(os.path.join(work_dir, outfile)),
+                    'file://{}'.format(file_path),
                     bucket_name,
-                    os.path.join(bucket_dir, outfile)]
+                    os.path.join(bucket_dir, os.path.basename(file_path))]
     subprocess.check_call(s3am_command)
 
 
+def save_output(input_args, file_path):
+    """
+    Copies a result file into input_args['output_dir'], if one was given
+    """
+    if input_args['output_dir']:
+        if not os.path.exists(input_args['output_dir']):
+            try:
+                os.makedirs(input_args['output_dir'])
+            except OSError:
+                # Another sample's job created it first
+                if not os.path.isdir(input_args['output_dir']):
+                    raise
+        shutil.copy(file_path, os.path.join(input_args['output_dir'], os.path.basename(file_path)))
+
+
+def plan_sample(input_args, file_sizes, shared_bytes):
+    """
+    Estimates a sample for --plan (see plan_cohort): the runtime of its coverage (both bams are covered at once, by
+    separate jobs) and of run_adtex, and the inputs of its largest job, bedtools_coverage of the larger bam, which
+    also holds the whitelist
+
+    input_args: dict        Input arguments
+    file_sizes: list        Sizes of the sample's files, in the order of CONFIG_FILES
+    shared_bytes: int       Size of the shared files
+    """
+    input_bytes = sum(file_sizes)
+    engine = 'numpy' if input_args['coverage_engine'] == 'numpy' else 'jvivian/bedtools'
+    coverage = plan_runtime(input_args, 'bedtools_coverage', engine, input_bytes, PLAN_TOOL_RATES[engine])
+    adtex = plan_runtime(input_args, 'run_adtex', 'jeltje/adtex', input_bytes, PLAN_TOOL_RATES['jeltje/adtex'])
+    return coverage + adtex, max(file_sizes[1:]) + shared_bytes
+
 
 if __name__ == "__main__":
     # Define Parser object and add to toil
     parser = build_parser()
     Job.Runner.addToilOptions(parser)
     args = parser.parse_args()
+    if args.coverage_engine == 'numpy' and np is None:
+        parser.error('--coverage_engine numpy requires NumPy (pip install numpy)')
+    if args.coverage_format == 'npz' and args.coverage_engine != 'numpy':
+        parser.error('--coverage_format npz requires --coverage_engine numpy')
 
     # Store inputs
     inputs = {'config': args.config,
               'white.bed': args.white,
+              'ref.fa.fai': args.fai,
               'ssec':args.ssec,
               'output_dir': args.out,
               's3_dir': args.s3_dir,
               'sudo': args.sudo,
+              'limit_containers': args.limit_containers,
+              'pin_cpus': args.pin_cpus,
+              'persistent_root': os.path.realpath(args.workDir or tempfile.gettempdir())
+                                 if args.persistent_containers else None,
+              'watchdog': {'stall_timeout': args.stall_timeout,
+                           'max_runtime': args.max_runtime,
+                           'max_runtime_per_gb': args.max_runtime_per_gb},
+              'prepull_nodes': args.prepull_nodes,
+              'targeted': args.targeted,
+              'coverage_engine': args.coverage_engine,
+              'coverage_format': args.coverage_format,
+              'fused': args.fused,
+              'speculate': args.speculate,
+              'skip_preflight': args.skip_preflight,
+              'governor': {'max_transfers': args.max_transfers,
+                           'max_bandwidth': args.max_bandwidth,
+                           'lock_dir': args.transfer_lock_dir},
+              'resource_model_path': args.resource_model,
+              'resource_model': model_fits(load_resource_model(args.resource_model)) if args.resource_model else {},
               'cpu_count': None}
 
+    if args.plan:
+        plan_cohort(inputs, CONFIG_FILES, ['white.bed'], plan_sample, 'bedtools_coverage', args.plan_nodes,
+                    parse_rate(args.node_disk))
+        sys.exit(0)
+
     # Launch jobs
     Job.Runner.startToil(Job.wrapJobFn(download_shared_files, inputs), args)
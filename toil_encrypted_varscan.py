@@ -16,15 +16,25 @@ S3AM*   -   pip install --pre S3AM  (optional)
 Curl    -   apt-get install curl
 """
 import argparse
-import base64
 from collections import OrderedDict
-import hashlib
+import functools
 import os
 import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import shutil
+import socket
 import sys
 from toil.job import Job
+from pipeline_lib.filestore import claim_race, race_lost, start_race, watch_race, write_state
+from pipeline_lib.metrics import Superseded, collect_metrics, profiled, run_instrumented
+from pipeline_lib.resource_model import load_resource_model, model_fits, model_requirements, plan_runtime
+from pipeline_lib.targets import prepare_targets, read_fai
+from pipeline_lib.transfer import (download_batch, download_concurrently, encryption_headers, generate_unique_key,
+                                   hedged_download, sample_sizes, url_size)
+
+# Local disk (bytes) that must stay free, beyond the next sample's inputs, before that sample is prefetched
+PREFETCH_HEADROOM = 10 * 1024 ** 3
 
 
 def build_parser():
@@ -38,26 +48,20 @@ def build_parser():
     parser.add_argument('-o', '--out', default=None, help='full path where final results will be output')
     parser.add_argument('-3', '--s3_dir', default=None, help='S3 Directory, starting with bucket name. e.g.: '
                                                              'cgl-driver-projects/ckcc/rna-seq-samples/')
+    parser.add_argument('--lanes', type=int, default=None, help='Run samples back-to-back in this many lanes (one job '
+                                                                'each), downloading the next sample while the current '
+                                                                'one computes')
+    parser.add_argument('--resource_model', default=None, help='Resource model learned from previous runs (local JSON '
+                                                               'file or path-style S3 URL): sets the requirements of '
+                                                               'varscan from input size, and is updated by this run')
+    parser.add_argument('--speculate', type=float, default=None, metavar='FACTOR',
+                        help="With --resource_model, launch a duplicate of a sample's varscan job once it has run "
+                             'FACTOR times longer than the model predicts for its input size; the first to finish '
+                             'is kept and the other cancelled (not used with --lanes)')
     return parser
 
 
 # Convenience Functions
-def generate_unique_key(master_key_path, url):
-    """
-    Input1: Path to the BD2K Master Key (for S3 Encryption)
-    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
-
-    Returns: 32-byte unique key generated for that URL
-    """
-    with open(master_key_path, 'r') as f:
-        master_key = f.read()
-    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
-                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
-    new_key = hashlib.sha256(master_key + url).digest()
-    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
-    return new_key
-
-
 def download_encrypted_file(work_dir, url, key_path, name):
     """
     Downloads encrypted file from S3
@@ -68,55 +72,8 @@ def download_encrypted_file(work_dir, url, key_path, name):
     Input4: name of file to be downloaded
     """
     file_path = os.path.join(work_dir, name)
-    key = generate_unique_key(key_path, url)
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
-    assert os.path.exists(file_path)
-
-def download_S3_file(work_dir, url, name):
-    """
-    Downloads file from S3
-
-    Input1: Working directory
-    Input2: S3 URL to be downloaded
-    Input3: name of file to be downloaded
-    """
-    file_path = os.path.join(work_dir, name)
-    # curl fs means fail quietly but show error when failing (not clear how that works)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
-    assert os.path.exists(file_path)
-
-
-def download_from_url(job, input_args, ids, name):
-    """
-    Downloads a file from a URL and places it in the jobStore
-
-    Input1: Toil job instance
-    Input2: Input arguments
-    Input3: jobstore id dictionary
-    Input4: Name of key used to access url in input_args
-    """
-    work_dir = job.fileStore.getLocalTempDir()
-    file_path = os.path.join(work_dir, name)
-    url = input_args[name]
-    if not os.path.exists(file_path):
-        try:
-            subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-        except OSError:
-            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    hedged_download(url, file_path, encryption_headers(key_path, url))
     assert os.path.exists(file_path)
-    job.fileStore.updateGlobalFile(ids[name], file_path)
-
 
 def return_input_paths(job, work_dir, ids, *args):
     """
@@ -142,6 +99,14 @@ def return_input_paths(job, work_dir, ids, *args):
     return paths.values()
 
 
+def free_disk(path):
+    """
+    Returns the number of bytes available on the filesystem holding path
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
 def move_to_output_dir(work_dir, output_dir, uuid=None, files=list()):
     """
     Moves files from work_dir to output_dir
@@ -165,10 +130,32 @@ def batch_start(job, input_args):
     """
     input_args['cpu_count'] = multiprocessing.cpu_count()
     shared_files = ['ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed']
-    shared_ids = {x: job.fileStore.getEmptyFileStoreID() for x in shared_files}
-    for fname in shared_files:
-        job.addChildJobFn(download_from_url, input_args, shared_ids, fname)
-    job.addFollowOnJobFn(spawn_batch_jobs, shared_ids, input_args)
+    shared_ids = job.addChildJobFn(download_batch, {x: input_args[x] for x in shared_files}).rv()
+    prepared = job.addFollowOnJobFn(prepare_whitelist, shared_ids)
+    prepared.addFollowOnJobFn(spawn_batch_jobs, prepared.rv(), input_args)
+
+
+def prepare_whitelist(job, shared_ids):
+    """
+    Prepares the whitelist once for all samples: chromosome names are matched to the reference's fai, and the
+    targets are sorted and merged so that VarScan covers no base twice. The prepared whitelist replaces white.bed.
+
+    Input1: Toil Job instance
+    Input2: jobstore id dictionary of the shared files
+
+    Returns: shared_ids, for the jobs that follow
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    bed_path, fai_path = return_input_paths(job, work_dir, shared_ids, 'white.bed', 'ref.fa.fai')
+    targets = prepare_targets(bed_path, read_fai(fai_path))
+    prepared_path = os.path.join(work_dir, 'white.prepared.bed')
+    with open(prepared_path, 'w') as f_out:
+        for chromosome, start, end in targets:
+            f_out.write('{}\t{}\t{}\n'.format(chromosome, start, end))
+    job.fileStore.logToMaster('Prepared whitelist: {} targets over {} bases'.format(
+        len(targets), sum(end - start for _, start, end in targets)))
+    job.fileStore.updateGlobalFile(shared_ids['white.bed'], prepared_path)
+    return shared_ids
 
 
 def spawn_batch_jobs(job, shared_ids, input_args):
@@ -182,11 +169,44 @@ def spawn_batch_jobs(job, shared_ids, input_args):
         for line in f_in:
             uuid, c_url, t_url = line.strip().split(',')
             samples.append((uuid, c_url, t_url))
-    for sample in samples:
-        job.addChildJobFn(varscan, shared_ids, input_args, sample, cores=cores)
+    # Each sample (or lane) returns the FileStoreIDs of its metrics
+    metrics = []
+    if input_args['lanes']:
+        lanes = input_args['lanes']
+        for lane in range(lanes):
+            if samples[lane::lanes]:
+                metrics.append(job.addChildJobFn(varscan_lane, shared_ids, input_args, samples[lane::lanes],
+                                                 cores=cores).rv())
+    else:
+        if input_args['resource_model']:
+            sizes = sample_sizes(samples, lambda sample: sum(url_size(url, input_args['ssec']) for url in sample[1:]))
+        else:
+            sizes = [None] * len(samples)
+        for sample, input_bytes in zip(samples, sizes):
+            requirements = model_requirements(input_args, 'varscan', input_bytes, 'jeltje/varscan', cores=cores)
+            predicted = plan_runtime(input_args, 'varscan', 'jeltje/varscan', input_bytes) if input_bytes else None
+            if input_args['speculate'] and predicted is not None:
+                metrics.extend(start_race(job, varscan, watch_attempt, (shared_ids, input_args, sample),
+                                          requirements, input_args['speculate'] * predicted))
+                continue
+            if input_args['speculate']:
+                job.fileStore.logToMaster('varscan for {} is not speculated: the resource model has no prediction '
+                                          'for it yet'.format(sample[0]))
+            metrics.append(job.addChildJobFn(varscan, shared_ids, input_args, sample, **requirements).rv())
+    job.addFollowOnJobFn(collect_metrics, input_args, metrics)
+
+
+def watch_attempt(job, race, requirements, deadline, ids, input_args, sample):
+    """
+    Watcher of a speculated varscan job (see watch_race): returns the duplicate's metrics if it launches one
+    """
+    if watch_race(job, race, deadline, 'varscan for {}'.format(sample[0])):
+        return [job.addChildJobFn(varscan, ids, input_args, sample, race=race, **requirements).rv()]
+    return []
 
 
-def varscan(job, ids, input_args, sample):
+@profiled('varscan')
+def varscan(job, ids, input_args, sample, race=None):
     """
     Runs varscan on the input bams for this sample
 
@@ -194,27 +214,109 @@ def varscan(job, ids, input_args, sample):
     Input2: jobstore id dictionary
     Input3: Input arguments dictionary
     Input4: Sample UUID and urls
+    Input5: With --speculate, the race of this attempt (see start_race)
     """
     uuid, c_url, t_url = sample
+    job.profile.uuid = uuid
+    # With --speculate, this is one of two attempts
+    if race and race['attempt'] == 0:
+        write_state(job, race['started'], '1')
     # TODO How do I do this?
 #    output_files = ['copyCalled.recenter', 'output.copynumber']
 #    output_ids = {x: job.fileStore.getEmptyFileStoreID() for x in output_files}
-    ids['cnv'] = job.fileStore.getEmptyFileStoreID()
     work_dir = job.fileStore.getLocalTempDir()
-    output_dir = input_args['output_dir']
     key_path = input_args['ssec']
-    cores = input_args['cpu_count']
 
     # I/O
-    return_input_paths(job, work_dir, ids, 'ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed') 
+    shared_files = ['ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, f) for f in shared_files]):
+        return_input_paths(job, work_dir, ids, *shared_files)
 
     # Get bams associated with this sample
-    download_encrypted_file(work_dir, c_url, key_path, uuid + ".control.bam")
-    download_encrypted_file(work_dir, t_url, key_path, uuid + ".tumor.bam")
+    bams = [uuid + ".control.bam", uuid + ".tumor.bam"]
+    with job.profile.phase('download', [os.path.join(work_dir, bam) for bam in bams]):
+        download_concurrently([(download_encrypted_file, (work_dir, c_url, key_path, bams[0])),
+                               (download_encrypted_file, (work_dir, t_url, key_path, bams[1]))])
 #    for url in urls:
 #        download_S3_file(work_dir, url, os.path.basename(url))
     #sam_path=input_args['insam']
     #shutil.copy(sam_path, os.path.join(work_dir, 'input.sam'))
+    return run_varscan(job, work_dir, ids, input_args, uuid, race)
+
+
+@profiled('varscan_lane')
+def varscan_lane(job, ids, input_args, samples):
+    """
+    Runs varscan on a series of samples in one job, each in its own subdirectory of the work directory, and
+    downloads the next sample's bams in the background if the disk can hold them plus PREFETCH_HEADROOM
+
+    Input1: Toil Job instance
+    Input2: jobstore id dictionary
+    Input3: Input arguments dictionary
+    Input4: List of sample UUIDs and urls, run in order
+    """
+    work_dir = job.fileStore.getLocalTempDir()
+    key_path = input_args['ssec']
+    metrics = []
+    shared_files = ['ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, f) for f in shared_files]):
+        return_input_paths(job, work_dir, ids, *shared_files)
+
+    def fetch(sample):
+        uuid, c_url, t_url = sample
+        # Each sample runs in its own directory, so VarScan's files for one sample never mix with the next one's
+        sample_dir = os.path.join(work_dir, uuid)
+        os.mkdir(sample_dir)
+        for name in shared_files:
+            os.link(os.path.join(work_dir, name), os.path.join(sample_dir, name))
+        bams = [uuid + ".control.bam", uuid + ".tumor.bam"]
+        with job.profile.phase('download', [os.path.join(sample_dir, bam) for bam in bams], uuid=uuid):
+            download_concurrently([(download_encrypted_file, (sample_dir, c_url, key_path, bams[0])),
+                                   (download_encrypted_file, (sample_dir, t_url, key_path, bams[1]))])
+
+    pool = ThreadPool(1)
+    prefetch = None
+    try:
+        for i, sample in enumerate(samples):
+            uuid = sample[0]
+            if prefetch is None:
+                fetch(sample)
+            else:
+                with job.profile.phase('prefetch_wait', uuid=uuid):
+                    prefetch.get()
+                prefetch = None
+            if i + 1 < len(samples):
+                next_sample = samples[i + 1]
+                needed = sum(url_size(url, key_path) for url in next_sample[1:]) + PREFETCH_HEADROOM
+                if free_disk(work_dir) > needed:
+                    prefetch = pool.apply_async(fetch, (next_sample,))
+                else:
+                    job.fileStore.logToMaster('Not enough disk to prefetch {} while {} runs'.format(next_sample[0], uuid))
+            # Each sample gets its own copy of ids, since children are only pickled once this job finishes
+            metrics.extend(run_varscan(job, os.path.join(work_dir, uuid), dict(ids), input_args, uuid))
+            # The output is in the job store by now; the upload job reads it from there
+            shutil.rmtree(os.path.join(work_dir, uuid))
+    finally:
+        pool.close()
+        pool.join()
+    return metrics
+
+
+def run_varscan(job, work_dir, ids, input_args, uuid, race=None):
+    """
+    Runs varscan on a sample's bams in work_dir, saves the output and schedules its upload.
+    The varscan container's record and the phases are added to the job's profile; returns the upload's metrics.
+
+    Input1: Toil Job instance
+    Input2: Working directory holding the bams and shared files
+    Input3: jobstore id dictionary
+    Input4: Input arguments dictionary
+    Input5: Sample UUID
+    Input6: With --speculate, the race of this attempt (see start_race)
+    """
+    ids['cnv'] = job.fileStore.getEmptyFileStoreID()
+    output_dir = input_args['output_dir']
+    cores = input_args['cpu_count']
 
     # Setup docker base and varscan command
     docker_cmd = ['docker', 'run', '--rm', '-v', '{}:/data'.format(work_dir)]
@@ -233,18 +335,35 @@ def varscan(job, ids, input_args, sample):
     # Piping the output to a file handle
     # check_call blocks progress until finished
     outfile = uuid + '.cnv'
-    with open(os.path.join(work_dir, outfile), 'w') as f_out:
-        subprocess.check_call(docker_cmd + varscan_command, stdout=f_out)
+    try:
+        with job.profile.phase('compute', [os.path.join(work_dir, outfile)], uuid=uuid):
+            with open(os.path.join(work_dir, outfile), 'w') as f_out:
+                watchdog = {'name': 'varscan', 'stall_timeout': 0, 'max_runtime': 0, 'paths': (),
+                            'cancelled': functools.partial(race_lost, job, race)} if race else None
+                record = run_instrumented(docker_cmd + varscan_command, stdout=f_out, watchdog=watchdog)
+    except Superseded:
+        job.fileStore.logToMaster('varscan for {} was cancelled: the other attempt finished first'.format(uuid))
+        job.fileStore.deleteGlobalFile(ids['cnv'])
+        return []
+    job.profile.records.append(dict(record, kind='tool', uuid=uuid, stage='varscan', image=varscan_command[0],
+                                    host=socket.gethostname()))
+    if race and not claim_race(job, race):
+        job.fileStore.logToMaster('varscan for {} discards its output: the other attempt finished first'.format(uuid))
+        job.fileStore.deleteGlobalFile(ids['cnv'])
+        return []
 
     # Save in JobStore
-    job.fileStore.updateGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
+    with job.profile.phase('store', [os.path.join(work_dir, outfile)], uuid=uuid):
+        job.fileStore.updateGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
     # Move file in output_dir
     if input_args['output_dir']:
         move_to_output_dir(work_dir, output_dir, uuid=None, files=[outfile])
     # Copy file to S3
     if input_args['s3_dir']:
-        job.addChildJobFn(upload_file_to_s3, ids, input_args, sample[0], cores=cores)
+        return [job.addChildJobFn(upload_file_to_s3, ids, input_args, uuid, cores=cores).rv()]
+    return []
 
+@profiled('upload_file_to_s3')
 def upload_file_to_s3(job, ids, input_args, uuid):
     """
     Uploads output file from sample to S3
@@ -254,6 +373,7 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     Input3: Input arguments dictionary
     Input4: Sample uuid
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     key_path = input_args['ssec']
     # Parse s3_dir to get bucket and s3 path
@@ -264,7 +384,8 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     outfile = uuid + '.cnv'
     url = os.path.join(base_url, bucket_name, bucket_dir, outfile)
     #I/O
-    job.fileStore.readGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, outfile)]):
+        job.fileStore.readGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
     # Generate keyfile for upload
     with open(os.path.join(work_dir, uuid + '.key'), 'wb') as f_out:
         f_out.write(generate_unique_key(key_path, url))
@@ -276,7 +397,10 @@ def upload_file_to_s3(job, ids, input_args, uuid):
                     bucket_name,
                     os.path.join(bucket_dir, outfile)]
 
-    subprocess.check_call(s3am_command)
+    with job.profile.phase('upload', [os.path.join(work_dir, outfile)]):
+        subprocess.check_call(s3am_command)
+    # The upload is the output's only reader, so it leaves the job store with this job rather than with the workflow
+    job.fileStore.deleteGlobalFile(ids['cnv'])
 
 
 if __name__ == "__main__":
@@ -284,6 +408,9 @@ if __name__ == "__main__":
     parser = build_parser()
     Job.Runner.addToilOptions(parser)
     args = parser.parse_args()
+    # Without a throughput to fall back on, varscan's runtime is only predicted by the resource model
+    if args.speculate and not args.resource_model:
+        parser.error('--speculate requires --resource_model')
 
     # Store input_URLs for downloading
     inputs = {'config': args.config,
@@ -294,6 +421,10 @@ if __name__ == "__main__":
               'ssec':args.ssec,
               'output_dir': args.out,
               's3_dir': args.s3_dir,
+              'lanes': args.lanes,
+              'speculate': args.speculate,
+              'resource_model_path': args.resource_model,
+              'resource_model': model_fits(load_resource_model(args.resource_model)) if args.resource_model else {},
               'cpu_count': None}
 
     # Launch jobs
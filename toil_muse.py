@@ -12,15 +12,38 @@ S3AM*   -   pip install --pre S3AM  (optional)
 Curl    -   apt-get install curl
 """
 import argparse
-import base64
 from collections import OrderedDict
-import hashlib
 import os
 import subprocess
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import shutil
 import sys
+import tempfile
 from toil.job import Job
+from pipeline_lib.config import preflight_config, read_config
+from pipeline_lib.containers import container_limits, docker_call, docker_path, pinned, prepull_images
+from pipeline_lib.filestore import claim_race, release_files, start_race, watch_race, write_state
+from pipeline_lib.metrics import Superseded, collect_metrics, profiled, split_outputs
+from pipeline_lib.peer_cache import PEER_CACHE_PORT, stage_cached_files
+from pipeline_lib.resource_model import (load_resource_model, model_fits, model_requirements, plan_cohort,
+                                         plan_runtime)
+from pipeline_lib.transfer import (download_batch, encryption_headers, hedged_download, parse_rate, sample_sizes,
+                                   transfer_rate, transfer_slot, url_size)
+
+# Docker images used by the pipeline
+TOOL_IMAGES = ['jeltje/musev1.0']
+# Hung-tool watchdog: defaults of --stall_timeout, --max_runtime and --max_runtime_per_gb
+STALL_TIMEOUT = 1800
+MAX_RUNTIME = 4 * 3600
+MAX_RUNTIME_PER_GIB = 1800
+# Local disk (bytes) that must stay free, beyond the next sample's inputs, before that sample is prefetched
+PREFETCH_HEADROOM = 10 * 1024 ** 3
+# Files of a config row, after its UUID, and whether each is SSE-C encrypted (with --ssec)
+CONFIG_FILES = [('control.bam', True), ('tumor.bam', True)]
+# Throughput of each tool in bytes/sec (per byte of the sample's inputs), used by --plan and --speculate without a
+# resource model
+PLAN_TOOL_RATES = {'jeltje/musev1.0': 10 * 1024 ** 2}
 
 
 def build_parser():
@@ -36,71 +59,130 @@ def build_parser():
     parser.add_argument('-u', '--sudo', dest='sudo', action='store_true', help='Docker usually needs sudo to execute '
                                                                                'locally, but not''when running Mesos '
                                                                                'or when a member of a Docker group.')
+    parser.add_argument('--lanes', type=int, default=None, help='Run samples back-to-back in this many lanes (one job '
+                                                                'each), downloading the next sample while the current '
+                                                                'one computes')
+    parser.add_argument('--limit_containers', action='store_true', default=False,
+                        help="Enforce each job's Toil cores/memory on its containers (--cpus/--memory); "
+                             "set --defaultMemory to suit the tools")
+    parser.add_argument('--pin_cpus', action='store_true', default=False,
+                        help='With --limit_containers, also pin each container to its own set of CPUs')
+    parser.add_argument('--persistent_containers', action='store_true', default=False,
+                        help='Run tools in one long-lived container per image per node (docker exec) instead of a '
+                             'new container per call')
+    parser.add_argument('--stall_timeout', type=int, default=STALL_TIMEOUT,
+                        help='Kill a tool container that has written no output and used no CPU for this many '
+                             'seconds (0: never)')
+    parser.add_argument('--max_runtime', type=int, default=MAX_RUNTIME,
+                        help='Kill a tool container that has run for this many seconds plus --max_runtime_per_gb '
+                             'per GiB of its inputs (0: never)')
+    parser.add_argument('--max_runtime_per_gb', type=int, default=MAX_RUNTIME_PER_GIB,
+                        help='Seconds added to --max_runtime per GiB of input')
+    parser.add_argument('--prepull_nodes', type=int, default=1, help='Number of Docker image warm-up jobs; each '
+                                                                     'reserves a whole node so they land on '
+                                                                     'different workers')
+    parser.add_argument('--max_transfers', type=int, default=None, help='Maximum number of concurrent transfers per node, '
+                                                                        'shared by all Toil workers on that node')
+    parser.add_argument('--max_bandwidth', default=None, help='Aggregate download bandwidth per node, in bytes/sec with '
+                                                              'optional K/M/G suffix (e.g. 200M), split evenly over '
+                                                              '--max_transfers slots (4 if not given)')
+    parser.add_argument('--transfer_lock_dir', default='/tmp/toil_transfers', help='Node-local directory holding the '
+                                                                                   'transfer slot lock files')
+    parser.add_argument('--resource_model', default=None, help='Resource model learned from previous runs (local JSON '
+                                                               'file or path-style S3 URL): sets the requirements of '
+                                                               'run_muse from input size, and is updated by this run')
+    parser.add_argument('--speculate', type=float, default=None, metavar='FACTOR',
+                        help="Launch a duplicate of a sample's run_muse job once it has run FACTOR times longer "
+                             'than predicted for its input size (by the resource model, or the tool throughput); '
+                             'the first to finish is kept and the other cancelled (not used with --lanes)')
+    parser.add_argument('--peer_cache', default=None, metavar='DIR',
+                        help='Keep one copy of the shared files (reference, dbsnp) per node in DIR and serve it to '
+                             'the other nodes over HTTP, so that nodes fetch them from each other rather than all '
+                             'from the job store')
+    parser.add_argument('--peer_port', type=int, default=PEER_CACHE_PORT,
+                        help='Port of the peer cache server on each node (0: any free port, to run several '
+                             'stand-in workers with their own --peer_cache on one machine)')
+    parser.add_argument('--skip_preflight', action='store_true', default=False,
+                        help='Only check the shape of the config rows before launch, not that every URL (and its '
+                             'SSE-C key) can be downloaded')
+    parser.add_argument('--plan', action='store_true', default=False, help='Only estimate the run: bytes to transfer, '
+                                                                           'peak job disk and makespan, then exit')
+    parser.add_argument('--plan_nodes', type=int, nargs='+', default=[1, 8, 32], help='Cluster sizes (nodes) to '
+                                                                                      'estimate the makespan for')
+    parser.add_argument('--node_disk', default=None, help='With --plan, disk per node in bytes with optional K/M/G '
+                                                          'suffix (e.g. 500G), to list samples that will not fit')
     return parser
 
 
 # Convenience Functions
-def generate_unique_key(master_key_path, url):
-    """
-    Input1: Path to the BD2K Master Key (for S3 Encryption)
-    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
-
-    Returns: 32-byte unique key generated for that URL
-    """
-    with open(master_key_path, 'r') as f:
-        master_key = f.read()
-    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
-                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
-    new_key = hashlib.sha256(master_key + url).digest()
-    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
-    return new_key
-
-def download_encrypted_file(job, url, key_path):
+@profiled('download', output=True)
+def download_encrypted_file(job, url, key_path, governor=None, uuid=None):
     """
     Downloads encrypted files from S3 via header injection
 
     url: str        URL to be downloaded
     key_path: str   Path to the master key needed to derive unique encryption keys per file
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+    uuid: str       Sample the file belongs to, for the metrics
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     file_path = os.path.join(work_dir, os.path.basename(url))
-
-    with open(key_path, 'r') as f:
-        key = f.read()
-    if len(key) != 32:
-        raise RuntimeError('Invalid Key! Must be 32 bytes: {}'.format(key))
-
-    key = generate_unique_key(key_path, url)
-
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    with transfer_slot(governor):
+        with job.profile.phase('download', [file_path]):
+            hedged_download(url, file_path, encryption_headers(key_path, url), transfer_rate(governor))
     assert os.path.exists(file_path)
-    return job.fileStore.writeGlobalFile(file_path)
+    with job.profile.phase('store'):
+        file_id = job.fileStore.writeGlobalFile(file_path)
+    return file_id
 
 
-def download_from_url(job, url):
+@profiled('download', output=True)
+def download_from_url(job, url, governor=None, uuid=None):
     """
     Downloads a URL that was supplied as an argument to running this script in LocalTempDir.
     After downloading the file, it is stored in the FileStore.
 
     url: str        URL to be downloaded. filename is derived from URL
+    governor: dict  Node-wide transfer limits (see transfer_slot)
+    uuid: str       Sample the file belongs to, for the metrics
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     file_path = os.path.join(work_dir, os.path.basename(url))
     if not os.path.exists(file_path):
-        try:
-            subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-        except OSError:
-            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+        with transfer_slot(governor):
+            with job.profile.phase('download', [file_path]):
+                hedged_download(url, file_path, rate=transfer_rate(governor))
     assert os.path.exists(file_path)
-    return job.fileStore.writeGlobalFile(file_path)
+    with job.profile.phase('store'):
+        file_id = job.fileStore.writeGlobalFile(file_path)
+    return file_id
+
+
+def fetch_sample_bams(sample_dir, urls, input_args):
+    """
+    Downloads a sample's control and tumor bams into a local directory, bypassing the FileStore
+
+    sample_dir: str         Directory the bams are written to; created if needed
+    urls: list              URLs of the control and tumor bams
+    input_args: dict        Input arguments
+    """
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+    governor = input_args['governor']
+    for name, url in zip(['control.bam', 'tumor.bam'], urls):
+        headers = encryption_headers(input_args['ssec'], url) if input_args['ssec'] else ()
+        with transfer_slot(governor):
+            hedged_download(url, os.path.join(sample_dir, name), headers, transfer_rate(governor))
+
+
+def free_disk(path):
+    """
+    Returns the number of bytes available on the filesystem holding path
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
 
 
 def return_input_paths(job, work_dir, ids, *args):
@@ -127,6 +209,16 @@ def return_input_paths(job, work_dir, ids, *args):
     return paths.values()
 
 
+def stage_shared_files(job, work_dir, ids, input_args, *names):
+    """
+    Places shared files (e.g. the reference) in work_dir, through this node's peer cache with --peer_cache
+    """
+    if input_args['peer_cache']:
+        stage_cached_files(job, work_dir, ids, input_args['peer_cache'], *names)
+    else:
+        return_input_paths(job, work_dir, ids, *names)
+
+
 # Start of Job Functions
 ######
 def download_shared_files(job, input_args):
@@ -136,120 +228,273 @@ def download_shared_files(job, input_args):
     input_args: dict        Input arguments (passed from main())
     """
     shared_files = ['ref.fa', 'ref.fa.fai', 'dbsnp.vcf']
-    shared_ids = {}
-    for fname in shared_files:
-        url = input_args[fname]
-        shared_ids[fname] = job.addChildJobFn(download_from_url, url).rv()
-    job.addFollowOnJobFn(parse_config, shared_ids, input_args)
-
-def parse_config(job, shared_ids, input_args):
+    urls = {fname: input_args[fname] for fname in shared_files}
+    shared_ids = job.addChildJobFn(download_batch, urls, input_args['governor']).rv()
+    # Warm-up jobs ask for a whole node's cores so the scheduler spreads them over different workers
+    images = [job.addChildJobFn(prepull_images, TOOL_IMAGES, input_args['sudo'], cores=multiprocessing.cpu_count()).rv()
+              for _ in range(input_args['prepull_nodes'])]
+    job.addFollowOnJobFn(parse_config, shared_ids, input_args, images)
+
+def parse_config(job, shared_ids, input_args, images):
     """
     Stores the UUID and urls associated with the input files to be retrieved.
     Configuration file has one sample per line, with the following format:  UUID,1st_url,2nd_url
 
+    Before any sample is launched the config is checked (see read_config and preflight_config) and the run fails
+    with a report of every bad row. The size and ETag of each input are written to preflight.tsv, which is copied
+    to output_dir, and the sizes are used to size the samples' jobs.
+
     shared_ids: dict        Dictionary of fileStore IDs for the shared files downloaded in the previous step
     input_args: dict        Input argumentts
+    images: list            Digest-pinned image references returned by the warm-up jobs
     """
-    samples = []
     config = input_args['config']
-    with open(config, 'r') as f_in:
-        for line in f_in:
-            line = line.strip().split(',')
-            uuid = line[0]
-            urls = line[1:]
-            samples.append((uuid, urls))
+    rows, problems = read_config(config, CONFIG_FILES)
+    checks = []
+    if not input_args['skip_preflight']:
+        checks, bad_urls = preflight_config(rows, CONFIG_FILES, input_args['ssec'])
+        problems += bad_urls
+        work_dir = job.fileStore.getLocalTempDir()
+        report_path = os.path.join(work_dir, 'preflight.tsv')
+        with open(report_path, 'w') as f_out:
+            f_out.write('\t'.join(['line', 'uuid', 'file', 'url', 'status', 'bytes', 'etag']) + '\n')
+            for check in checks:
+                f_out.write('\t'.join('' if value is None else str(value) for value in check) + '\n')
+        if input_args['output_dir']:
+            if not os.path.exists(input_args['output_dir']):
+                os.makedirs(input_args['output_dir'])
+            shutil.copy(report_path, os.path.join(input_args['output_dir'], 'preflight.tsv'))
+        job.fileStore.logToMaster('Preflight: checked {} URLs of {} samples in {:.1f} GiB'.format(
+            len(checks), len(rows), sum(check[5] or 0 for check in checks) / 1024.0 ** 3))
+    if problems:
+        bad_rows = len(set(number for number, _, _ in problems))
+        raise RuntimeError('Preflight found problems in {} row(s) of {}:\n{}'.format(bad_rows, config, '\n'.join(
+            '  line {} ({}): {}'.format(number, uuid or '-', message) for number, uuid, message in sorted(problems))))
+    samples = [(uuid, urls) for _, uuid, urls in rows]
     input_args['cpu_count'] = multiprocessing.cpu_count()
+    input_args['images'] = images[0] if images else {}
+    if input_args['peer_cache']:
+        # Registry of the nodes that have (or are fetching) each shared file, see stage_shared_files
+        shared_ids['peers'] = job.fileStore.getEmptyFileStoreID()
     job_vars = (input_args, shared_ids)
-    for sample in samples:
-        job.addChildJobFn(download_inputs, job_vars, sample, cores=input_args['cpu_count'])
-        #job.addChildJobFn(download_inputs, job_vars, sample, cores=input_args['cpu_count'], memory='20 G', disk='100 G')
-
-def download_inputs(job, job_vars, sample):
+    # Each sample (or lane) returns the FileStoreIDs of its jobs' metrics
+    metrics = []
+    if input_args['lanes']:
+        lanes = input_args['lanes']
+        for lane in range(lanes):
+            if samples[lane::lanes]:
+                metrics.append(job.addChildJobFn(muse_lane, job_vars, samples[lane::lanes],
+                                                 cores=input_args['cpu_count']).rv())
+    else:
+        if checks:
+            sizes = {}
+            for _, uuid, _, _, _, size, _ in checks:
+                sizes[uuid] = sizes.get(uuid, 0) + (size or 0)
+            sizes = [sizes[uuid] for uuid, _ in samples]
+        elif input_args['resource_model'] or input_args['speculate']:
+            sizes = sample_sizes(samples, lambda sample: sum(url_size(url, input_args['ssec']) for url in sample[1]))
+        else:
+            sizes = [None] * len(samples)
+        for sample, input_bytes in zip(samples, sizes):
+            metrics.append(job.addChildJobFn(download_inputs, job_vars, sample, input_bytes,
+                                             cores=input_args['cpu_count']).rv())
+            #job.addChildJobFn(download_inputs, job_vars, sample, cores=input_args['cpu_count'], memory='20 G', disk='100 G')
+    job.addFollowOnJobFn(collect_metrics, input_args, metrics)
+
+@profiled('download_inputs')
+def download_inputs(job, job_vars, sample, input_bytes=None):
     """
     Downloads the sample inputs (bam files)
 
     job_vars: tuple         Contains the dictionaries: input_args and ids
     sample: tuple           Contains the uuid (str) and urls (list of strings)
+    input_bytes: int        Total size of the bams, used to size run_muse with the resource model
     """
     input_args, ids = job_vars
     uuid, urls = sample
     input_args['uuid'] = uuid
+    job.profile.uuid = uuid
     for i, file in enumerate(['control.bam', 'tumor.bam']):
         if input_args['ssec']:
             key_path = input_args['ssec']
-            ids[file] = job.addChildJobFn(download_encrypted_file, urls[i], key_path).rv()
+            ids[file] = job.addChildJobFn(download_encrypted_file, urls[i], key_path, input_args['governor'],
+                                          uuid).rv()
         else:
-            ids[file] = job.addChildJobFn(download_from_url, urls[i]).rv()
-    job.addFollowOnJobFn(run_muse, job_vars, cores=job_vars['cpu_count'])
-
-def run_muse(job, job_vars):
+            ids[file] = job.addChildJobFn(download_from_url, urls[i], input_args['governor'], uuid).rv()
+    requirements = model_requirements(input_args, 'run_muse', input_bytes, pinned(input_args, 'jeltje/musev1.0'),
+                                      cores=input_args['cpu_count'])
+    if input_args['speculate'] and input_bytes:
+        return job.addFollowOnJobFn(speculate, job_vars, requirements, input_bytes).rv()
+    if input_args['speculate']:
+        job.fileStore.logToMaster('run_muse for {} is not speculated: its input size is unknown'.format(uuid))
+    return job.addFollowOnJobFn(run_muse, job_vars, **requirements).rv()
+
+@profiled('run_muse')
+def run_muse(job, job_vars, race=None):
     """
     This module runs the MuSE somatic mutation caller, which outputs vcf 
 
     job_vars: tuple         Contains the dictionaries: input_args and ids
+    race: dict              With --speculate, the race of this attempt (see start_race)
+
+    Returns: list of the sample's metrics
     """
     # Unpack variables
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
-    sudo = input_args['sudo']
-    cores = input_args['cpu_count']
-    # Retrieve samples
-    return_input_paths(job, work_dir, ids, 'tumor.bam', 'control.bam')
-    # Retrieve input files
-    return_input_paths(job, work_dir, ids, 'ref.fa', 'ref.fa.fai', 'dbsnp.vcf') 
-
-    # Call: MuSE
     uuid = input_args['uuid']
-    muse_vcf = os.path.join(work_dir, uuid + '.muse.vcf')
-    parameters = ['--mode', 'wxs',
-                  '--dbsnp', 'dbsnp.vcf',
-                  '--fafile', 'ref.fa',
-                  '--tumor-bam', 'tumor.bam',
-                  '--normal-bam', 'control.bam',
-                  '--outfile', docker_path(muse_vcf),
-                  '--cpus', str(cores)]
-    docker_call(work_dir=work_dir, tool_parameters=parameters,
-                tool='jeltje/musev1.0', sudo=sudo)
+    job.profile.uuid = uuid
+    # With --speculate, this is one of two attempts (see speculate), which took out the download metrics already;
+    # the tool is cancelled once the other attempt finishes (see container_limits)
+    if race:
+        input_args = dict(input_args, race=race)
+    if race and race['attempt'] == 0:
+        write_state(job, race['started'], '1')
+    metrics = split_outputs(ids, 'tumor.bam', 'control.bam') if not race else []
+    inputs = ['tumor.bam', 'control.bam', 'ref.fa', 'ref.fa.fai', 'dbsnp.vcf']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, name) for name in inputs]):
+        # Retrieve samples
+        return_input_paths(job, work_dir, ids, 'tumor.bam', 'control.bam')
+        # Retrieve input files
+        stage_shared_files(job, work_dir, ids, input_args, 'ref.fa', 'ref.fa.fai', 'dbsnp.vcf')
 
-    ids['muse_vcf'] = job.fileStore.writeGlobalFile(muse_vcf)
+    # Call: MuSE
+    try:
+        with job.profile.phase('compute'):
+            muse_vcf = call_muse(job, work_dir, uuid, input_args)
+    except Superseded:
+        job.fileStore.logToMaster('run_muse for {} was cancelled: the other attempt finished first'.format(uuid))
+        return metrics
+    if race and not claim_race(job, race):
+        job.fileStore.logToMaster('run_muse for {} discards its output: the other attempt finished first'.format(uuid))
+        return metrics
+
+    with job.profile.phase('store', [muse_vcf]):
+        ids['muse_vcf'] = job.fileStore.writeGlobalFile(muse_vcf)
     if input_args['s3_dir']:
-        job.addChildJobFn(upload_to_s3, job_vars, disk='80G')
+        metrics.append(job.addChildJobFn(upload_to_s3, job_vars, disk='80G').rv())
+    # run_muse is the bams' only consumer; in a race finish_race releases them once both attempts are done
+    if not race:
+        release_files(job, ids, 'tumor.bam', 'control.bam')
+    return metrics
 
 
-def docker_path(file_path):
+def speculate(job, job_vars, requirements, input_bytes):
     """
-    Returns the path internal to the docker container (for standard reasons, this is always /data)
+    Runs a sample's run_muse with --speculate (see start_race), releasing the bams once both attempts are done
+
+    job_vars: tuple         Contains the dictionaries: input_args and ids
+    requirements: dict      Toil requirements of run_muse
+    input_bytes: int        Total size of the bams
+
+    Returns: list of the sample's metrics
     """
-    return os.path.join('/data', os.path.basename(file_path))
+    input_args, ids = job_vars
+    # Both attempts read the bams, so their download metrics are taken out here rather than by each of them
+    metrics = split_outputs(ids, 'tumor.bam', 'control.bam')
+    predicted = plan_runtime(input_args, 'run_muse', 'jeltje/musev1.0', input_bytes,
+                             PLAN_TOOL_RATES['jeltje/musev1.0'])
+    return metrics + start_race(job, run_muse, watch_attempt, (job_vars,), requirements,
+                                input_args['speculate'] * predicted, ids, ('tumor.bam', 'control.bam'))
 
 
-def docker_call(work_dir, tool_parameters, tool, java_opts=None, outfile=None, sudo=False):
+def watch_attempt(job, race, requirements, deadline, job_vars):
+    """
+    Watcher of a speculated run_muse (see watch_race): returns the duplicate's metrics if it launches one
     """
-    Makes subprocess call of a command to a docker container.
+    if watch_race(job, race, deadline, 'run_muse for {}'.format(job_vars[0]['uuid'])):
+        return [job.addChildJobFn(run_muse, job_vars, race=race, **requirements).rv()]
+    return []
 
 
-    tool_parameters: list   An array of the parameters to be passed to the tool
-    tool: str               Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
-    java_opts: str          Optional commands to pass to a java jar execution. (e.g. '-Xmx15G')
-    outfile: file           Filehandle that stderr will be passed to
-    sudo: bool              If the user wants the docker command executed as sudo
+@profiled('muse_lane')
+def muse_lane(job, job_vars, samples):
     """
-    base_docker_call = 'docker run --rm -v {}:/data'.format(work_dir).split()
-    if sudo:
-        base_docker_call = ['sudo'] + base_docker_call
-    if java_opts:
-        base_docker_call = base_docker_call + ['-e', 'JAVA_OPTS={}'.format(java_opts)]
+    Runs MuSE on a series of samples within one job. While MuSE runs on one sample, the next sample's bams
+    are downloaded in the background, as long as the local disk can hold them plus PREFETCH_HEADROOM.
+
+    job_vars: tuple         Contains the dictionaries: input_args and ids
+    samples: list           (uuid, urls) tuples, run in order
+
+    Returns: list of the lane's metrics
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    metrics = []
+    shared_files = ['ref.fa', 'ref.fa.fai', 'dbsnp.vcf']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, name) for name in shared_files]):
+        stage_shared_files(job, work_dir, ids, input_args, *shared_files)
+
+    def fetch(uuid, urls):
+        sample_dir = os.path.join(work_dir, uuid)
+        with job.profile.phase('download', [sample_dir], uuid=uuid):
+            fetch_sample_bams(sample_dir, urls, input_args)
+
+    pool = ThreadPool(1)
+    prefetch = None
     try:
-        if outfile:
-            subprocess.check_call(base_docker_call + [tool] + tool_parameters, stdout=outfile)
-        else:
-            subprocess.check_call(base_docker_call + [tool] + tool_parameters)
-    except subprocess.CalledProcessError:
-        raise RuntimeError('docker command returned a non-zero exit status. Check error logs.')
-    except OSError:
-        raise RuntimeError('docker not found on system. Install on all nodes.')
+        for i, (uuid, urls) in enumerate(samples):
+            sample_dir = os.path.join(work_dir, uuid)
+            if prefetch is None:
+                fetch(uuid, urls)
+            else:
+                with job.profile.phase('prefetch_wait', uuid=uuid):
+                    prefetch.get()
+                prefetch = None
+            if i + 1 < len(samples):
+                next_uuid, next_urls = samples[i + 1]
+                needed = sum(url_size(url, input_args['ssec']) for url in next_urls) + PREFETCH_HEADROOM
+                if free_disk(work_dir) > needed:
+                    prefetch = pool.apply_async(fetch, (next_uuid, next_urls))
+                else:
+                    job.fileStore.logToMaster('Not enough disk to prefetch {} while {} runs'.format(next_uuid, uuid))
+            # Hard links give each sample the shared files without copying them
+            for name in shared_files:
+                os.link(os.path.join(work_dir, name), os.path.join(sample_dir, name))
+            with job.profile.phase('compute', uuid=uuid):
+                sample_vcf = call_muse(job, sample_dir, uuid, input_args)
+            # Keep the vcf when the sample's inputs are cleared away
+            muse_vcf = os.path.join(work_dir, os.path.basename(sample_vcf))
+            os.rename(sample_vcf, muse_vcf)
+            shutil.rmtree(sample_dir)
+            with job.profile.phase('store', [muse_vcf], uuid=uuid):
+                sample_vars = (dict(input_args, uuid=uuid),
+                               dict(ids, muse_vcf=job.fileStore.writeGlobalFile(muse_vcf)))
+            if input_args['s3_dir']:
+                metrics.append(job.addChildJobFn(upload_to_s3, sample_vars, disk='80G').rv())
+    finally:
+        pool.close()
+        pool.join()
+    return metrics
+
+
+def call_muse(job, work_dir, uuid, input_args):
+    """
+    Runs MuSE on the control.bam and tumor.bam in work_dir and returns the path of the output vcf
 
+    job: Job                Toil job running MuSE; its cores set MuSE's thread count (and container limits),
+                            and the call's metrics record is added to its profile
+    work_dir: str           Directory holding the bams and the shared files (ref.fa, ref.fa.fai, dbsnp.vcf)
+    uuid: str               Sample UUID, used to name the output
+    input_args: dict        Input arguments (sudo, pinned images and container settings)
+    """
+    muse_vcf = os.path.join(work_dir, uuid + '.muse.vcf')
+    parameters = ['--mode', 'wxs',
+                  '--dbsnp', 'dbsnp.vcf',
+                  '--fafile', 'ref.fa',
+                  '--tumor-bam', 'tumor.bam',
+                  '--normal-bam', 'control.bam',
+                  '--outfile', docker_path(muse_vcf),
+                  '--cpus', str(max(1, int(job.cores)))]
+    job.profile.records.append(docker_call(work_dir=work_dir, tool_parameters=parameters,
+                                           tool=pinned(input_args, 'jeltje/musev1.0'), sudo=input_args['sudo'],
+                                           persistent_root=input_args['persistent_root'],
+                                           tags={'uuid': uuid, 'stage': 'muse'}, outputs=[muse_vcf],
+                                           **container_limits(job, input_args)))
+    return muse_vcf
 
+
+@profiled('upload_to_s3')
 def upload_to_s3(job, job_vars):
     """
     Uploads a file to S3 via S3AM 
@@ -259,6 +504,7 @@ def upload_to_s3(job, job_vars):
     # Unpack variables
     input_args, ids = job_vars
     uuid = input_args['uuid']
+    job.profile.uuid = uuid
     key_path = input_args['ssec']
     work_dir = job.fileStore.getLocalTempDir()
     # Parse s3_dir to get bucket and s3 path
@@ -268,15 +514,33 @@ def upload_to_s3(job, job_vars):
     base_url = 'https://s3-us-west-2.amazonaws.com/'
     url = os.path.join(base_url, bucket_name, bucket_dir, uuid + '.muse.vcf')
     # Retrieve file to be uploaded
-    job.fileStore.readGlobalFile(ids['muse_vcf'], os.path.join(work_dir, uuid + '.muse.vcf'))
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, uuid + '.muse.vcf')]):
+        job.fileStore.readGlobalFile(ids['muse_vcf'], os.path.join(work_dir, uuid + '.muse.vcf'))
     # Upload to S3 via S3AM
     s3am_command = ['s3am',
                     'upload',
                     'file://{}'.format(os.path.join(work_dir, uuid + '.muse.vcf')),
                     bucket_name,
                     os.path.join(bucket_dir, uuid + '.muse.vcf')]
-    subprocess.check_call(s3am_command)
+    with transfer_slot(input_args['governor']):
+        with job.profile.phase('upload', [os.path.join(work_dir, uuid + '.muse.vcf')]):
+            subprocess.check_call(s3am_command)
+    # The vcf is the sample's result, so it is only released once uploaded
+    release_files(job, ids, 'muse_vcf')
+
 
+def plan_sample(input_args, file_sizes, shared_bytes):
+    """
+    Estimates a sample for --plan (see plan_cohort): the runtime of run_muse, and its inputs, which are the sample's
+    bams and the shared files
+
+    input_args: dict        Input arguments
+    file_sizes: list        Sizes of the sample's files, in the order of CONFIG_FILES
+    shared_bytes: int       Size of the shared files
+    """
+    input_bytes = sum(file_sizes)
+    compute = plan_runtime(input_args, 'run_muse', 'jeltje/musev1.0', input_bytes, PLAN_TOOL_RATES['jeltje/musev1.0'])
+    return compute, input_bytes + shared_bytes
 
 
 if __name__ == "__main__":
@@ -291,9 +555,33 @@ if __name__ == "__main__":
               'ref.fa.fai': args.fai,
               'dbsnp.vcf': args.dbsnp,
               'sudo': args.sudo,
+              'limit_containers': args.limit_containers,
+              'pin_cpus': args.pin_cpus,
+              'persistent_root': os.path.realpath(args.workDir or tempfile.gettempdir())
+                                 if args.persistent_containers else None,
+              'watchdog': {'stall_timeout': args.stall_timeout,
+                           'max_runtime': args.max_runtime,
+                           'max_runtime_per_gb': args.max_runtime_per_gb},
+              'prepull_nodes': args.prepull_nodes,
+              'lanes': args.lanes,
+              'speculate': args.speculate,
+              'skip_preflight': args.skip_preflight,
+              'peer_cache': {'dir': os.path.abspath(args.peer_cache), 'port': args.peer_port}
+                            if args.peer_cache else None,
+              'governor': {'max_transfers': args.max_transfers,
+                           'max_bandwidth': args.max_bandwidth,
+                           'lock_dir': args.transfer_lock_dir},
               'ssec':args.ssec,
               's3_dir': args.s3_dir,
+              'output_dir': args.out,
+              'resource_model_path': args.resource_model,
+              'resource_model': model_fits(load_resource_model(args.resource_model)) if args.resource_model else {},
               'cpu_count': None}
 
+    if args.plan:
+        plan_cohort(inputs, CONFIG_FILES, ['ref.fa', 'ref.fa.fai', 'dbsnp.vcf'], plan_sample, 'run_muse',
+                    args.plan_nodes, parse_rate(args.node_disk))
+        sys.exit(0)
+
     # Launch jobs
     Job.Runner.startToil(Job.wrapJobFn(download_shared_files, inputs), args)
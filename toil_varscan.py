@@ -16,15 +16,16 @@ S3AM*   -   pip install --pre S3AM  (optional)
 Curl    -   apt-get install curl
 """
 import argparse
-import base64
 from collections import OrderedDict
-import hashlib
 import os
 import subprocess
 import multiprocessing
 import shutil
+import socket
 import sys
 from toil.job import Job
+from pipeline_lib.metrics import collect_metrics, profiled, run_instrumented
+from pipeline_lib.transfer import download_batch, download_concurrently, encryption_headers, hedged_download
 
 
 def build_parser():
@@ -42,22 +43,6 @@ def build_parser():
 
 
 # Convenience Functions
-def generate_unique_key(master_key_path, url):
-    """
-    Input1: Path to the BD2K Master Key (for S3 Encryption)
-    Input2: S3 URL (e.g. https://s3-us-west-2.amazonaws.com/cgl-driver-projects-encrypted/wcdt/exome_bams/DTB-111-N.bam)
-
-    Returns: 32-byte unique key generated for that URL
-    """
-    with open(master_key_path, 'r') as f:
-        master_key = f.read()
-    assert len(master_key) == 32, 'Invalid Key! Must be 32 characters. ' \
-                                  'Key: {}, Length: {}'.format(master_key, len(master_key))
-    new_key = hashlib.sha256(master_key + url).digest()
-    assert len(new_key) == 32, 'New key is invalid and is not 32 characters: {}'.format(new_key)
-    return new_key
-
-
 def download_encrypted_file(work_dir, url, key_path, name):
     """
     Downloads encrypted file from S3
@@ -68,16 +53,7 @@ def download_encrypted_file(work_dir, url, key_path, name):
     Input4: name of file to be downloaded
     """
     file_path = os.path.join(work_dir, name)
-    key = generate_unique_key(key_path, url)
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    hedged_download(url, file_path, encryption_headers(key_path, url))
     assert os.path.exists(file_path)
 
 def download_S3_file(work_dir, url, name):
@@ -89,35 +65,10 @@ def download_S3_file(work_dir, url, name):
     Input3: name of file to be downloaded
     """
     file_path = os.path.join(work_dir, name)
-    # curl fs means fail quietly but show error when failing (not clear how that works)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    hedged_download(url, file_path)
     assert os.path.exists(file_path)
 
 
-def download_from_url(job, input_args, ids, name):
-    """
-    Downloads a file from a URL and places it in the jobStore
-
-    Input1: Toil job instance
-    Input2: Input arguments
-    Input3: jobstore id dictionary
-    Input4: Name of key used to access url in input_args
-    """
-    work_dir = job.fileStore.getLocalTempDir()
-    file_path = os.path.join(work_dir, name)
-    url = input_args[name]
-    if not os.path.exists(file_path):
-        try:
-            subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
-        except OSError:
-            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
-    assert os.path.exists(file_path)
-    job.fileStore.updateGlobalFile(ids[name], file_path)
-
-
 def return_input_paths(job, work_dir, ids, *args):
     """
     Returns the paths of files from the FileStore
@@ -165,9 +116,7 @@ def batch_start(job, input_args):
     """
     input_args['cpu_count'] = multiprocessing.cpu_count()
     shared_files = ['ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed']
-    shared_ids = {x: job.fileStore.getEmptyFileStoreID() for x in shared_files}
-    for fname in shared_files:
-        job.addChildJobFn(download_from_url, input_args, shared_ids, fname)
+    shared_ids = job.addChildJobFn(download_batch, {x: input_args[x] for x in shared_files}).rv()
     job.addFollowOnJobFn(spawn_batch_jobs, shared_ids, input_args)
 
 
@@ -182,10 +131,11 @@ def spawn_batch_jobs(job, shared_ids, input_args):
         for line in f_in:
             uuid, c_url, t_url = line.strip().split(',')
             samples.append((uuid, c_url, t_url))
-    for sample in samples:
-        job.addChildJobFn(varscan, shared_ids, input_args, sample, cores=cores)
+    metrics = [job.addChildJobFn(varscan, shared_ids, input_args, sample, cores=cores).rv() for sample in samples]
+    job.addFollowOnJobFn(collect_metrics, input_args, metrics)
 
 
+@profiled('varscan')
 def varscan(job, ids, input_args, sample):
     """
     Runs varscan on the input bams for this sample
@@ -196,6 +146,7 @@ def varscan(job, ids, input_args, sample):
     Input4: Sample UUID and urls
     """
     uuid, c_url, t_url = sample
+    job.profile.uuid = uuid
     ids['cnv'] = job.fileStore.getEmptyFileStoreID()
     work_dir = job.fileStore.getLocalTempDir()
     output_dir = input_args['output_dir']
@@ -203,11 +154,15 @@ def varscan(job, ids, input_args, sample):
     cores = input_args['cpu_count']
 
     # I/O
-    return_input_paths(job, work_dir, ids, 'ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed') 
+    shared_files = ['ref.fa', 'ref.fa.fai', 'cent.bed', 'white.bed']
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, f) for f in shared_files]):
+        return_input_paths(job, work_dir, ids, *shared_files)
 
     # Get bams associated with this sample
-    download_S3_file(work_dir, c_url, uuid + ".control.bam")
-    download_S3_file(work_dir, t_url, uuid + ".tumor.bam")
+    bams = [uuid + ".control.bam", uuid + ".tumor.bam"]
+    with job.profile.phase('download', [os.path.join(work_dir, bam) for bam in bams]):
+        download_concurrently([(download_S3_file, (work_dir, c_url, bams[0])),
+                               (download_S3_file, (work_dir, t_url, bams[1]))])
 #    for url in urls:
 #        download_S3_file(work_dir, url, os.path.basename(url))
     #sam_path=input_args['insam']
@@ -230,18 +185,25 @@ def varscan(job, ids, input_args, sample):
     # Piping the output to a file handle
     # check_call blocks progress until finished
     outfile = uuid + '.cnv'
-    with open(os.path.join(work_dir, outfile), 'w') as f_out:
-        subprocess.check_call(docker_cmd + varscan_command, stdout=f_out)
+    with job.profile.phase('compute', [os.path.join(work_dir, outfile)]):
+        with open(os.path.join(work_dir, outfile), 'w') as f_out:
+            record = run_instrumented(docker_cmd + varscan_command, stdout=f_out)
+    job.profile.records.append(dict(record, kind='tool', uuid=uuid, stage='varscan', image=varscan_command[0],
+                                    host=socket.gethostname()))
 
     # Save in JobStore
-    job.fileStore.updateGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
+    with job.profile.phase('store', [os.path.join(work_dir, outfile)]):
+        job.fileStore.updateGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
     # Move file in output_dir
     if input_args['output_dir']:
         move_to_output_dir(work_dir, output_dir, uuid=None, files=[outfile])
     # Copy file to S3
     if input_args['s3_dir']:
-        job.addChildJobFn(upload_file_to_s3, ids, input_args, sample[0], cores=cores)
+        return [job.addChildJobFn(upload_file_to_s3, ids, input_args, sample[0], cores=cores).rv()]
+    return []
+
 
+@profiled('upload_file_to_s3')
 def upload_file_to_s3(job, ids, input_args, uuid):
     """
     Uploads output file from sample to S3
@@ -251,6 +213,7 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     Input3: Input arguments dictionary
     Input4: Sample uuid
     """
+    job.profile.uuid = uuid
     work_dir = job.fileStore.getLocalTempDir()
     # Parse s3_dir to get bucket and s3 path
     s3_dir = input_args['s3_dir']
@@ -260,7 +223,8 @@ def upload_file_to_s3(job, ids, input_args, uuid):
     outfile = uuid + '.cnv'
     url = os.path.join(base_url, bucket_name, bucket_dir, outfile)
     #I/O
-    job.fileStore.readGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
+    with job.profile.phase('stage_inputs', [os.path.join(work_dir, outfile)]):
+        job.fileStore.readGlobalFile(ids['cnv'], os.path.join(work_dir, outfile))
 #    # Generate keyfile for upload
 #    key_path = input_args['ssec']
 #    with open(os.path.join(work_dir, uuid + '.key'), 'wb') as f_out:
@@ -273,7 +237,8 @@ def upload_file_to_s3(job, ids, input_args, uuid):
                     bucket_name,
                     os.path.join(bucket_dir, outfile)]
 
-    subprocess.check_call(s3am_command)
+    with job.profile.phase('upload', [os.path.join(work_dir, outfile)]):
+        subprocess.check_call(s3am_command)
 
 
 if __name__ == "__main__":